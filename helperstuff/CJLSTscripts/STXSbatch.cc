@@ -0,0 +1,65 @@
+#include "Category.h"
+
+// Calls categoryMor18 and stage1_reco_1p1 for n events, the same way as D_STXS_stage1p1 in treewrapper.py,
+// so that python only has to call into C++ once per batch.
+// The jet variables are given the same way as in categoryAC19batch.cc.
+void stage1_reco_1p1batch(
+                          int n,
+                          int* nExtraLep,
+                          int* nExtraZ,
+                          int* nCleanedJetsPt30,
+                          int* nCleanedJetsPt30BTagged_bTagSF,
+                          float* jetQGLikelihood,
+                          int* QGLoffsets,
+                          double* p_JJQCD_SIG_ghg2_1_JHUGen_JECNominal,
+                          double* p_JQCD_SIG_ghg2_1_JHUGen_JECNominal,
+                          double* p_JJVBF_SIG_ghv1_1_JHUGen_JECNominal,
+                          double* p_JVBF_SIG_ghv1_1_JHUGen_JECNominal,
+                          double* pAux_JVBF_SIG_ghv1_1_JHUGen_JECNominal,
+                          double* p_HadWH_SIG_ghw1_1_JHUGen_JECNominal,
+                          double* p_HadZH_SIG_ghz1_1_JHUGen_JECNominal,
+                          double* p_HadWH_mavjj_JECNominal,
+                          double* p_HadWH_mavjj_true_JECNominal,
+                          double* p_HadZH_mavjj_JECNominal,
+                          double* p_HadZH_mavjj_true_JECNominal,
+                          float* jetPhi,
+                          int* phioffsets,
+                          double* ZZMass,
+                          double* PFMET,
+                          bool useVHMETTagged,
+                          bool useQGTagging,
+                          double* DiJetMass,
+                          double* ZZPt,
+                          double* HjjPt,
+                          int* result
+                         )
+{
+  // same as dummyfloatstar in treewrapper.py, used when there are no jets
+  float dummy[1] = {0};
+  for (int i = 0; i < n; i++) {
+    int category = categoryMor18(
+                                 nExtraLep[i],
+                                 nExtraZ[i],
+                                 nCleanedJetsPt30[i],
+                                 nCleanedJetsPt30BTagged_bTagSF[i],
+                                 QGLoffsets[i] == QGLoffsets[i+1] ? dummy : jetQGLikelihood + QGLoffsets[i],
+                                 p_JJQCD_SIG_ghg2_1_JHUGen_JECNominal[i],
+                                 p_JQCD_SIG_ghg2_1_JHUGen_JECNominal[i],
+                                 p_JJVBF_SIG_ghv1_1_JHUGen_JECNominal[i],
+                                 p_JVBF_SIG_ghv1_1_JHUGen_JECNominal[i],
+                                 pAux_JVBF_SIG_ghv1_1_JHUGen_JECNominal[i],
+                                 p_HadWH_SIG_ghw1_1_JHUGen_JECNominal[i],
+                                 p_HadZH_SIG_ghz1_1_JHUGen_JECNominal[i],
+                                 p_HadWH_mavjj_JECNominal[i],
+                                 p_HadWH_mavjj_true_JECNominal[i],
+                                 p_HadZH_mavjj_JECNominal[i],
+                                 p_HadZH_mavjj_true_JECNominal[i],
+                                 phioffsets[i] == phioffsets[i+1] ? dummy : jetPhi + phioffsets[i],
+                                 ZZMass[i],
+                                 PFMET[i],
+                                 useVHMETTagged,
+                                 useQGTagging
+                                );
+    result[i] = stage1_reco_1p1(nCleanedJetsPt30[i], DiJetMass[i], ZZPt[i], category, HjjPt[i]);
+  }
+}
@@ -21,7 +21,8 @@ for rootfile in "FakeRates_SS_2016_Legacy.root", "FakeRates_SS_2017_Legacy.root"
     downloader.add(os.path.join("AnalysisStep/data/FakeRates", rootfile), sha1="7f4ba82b5f36db82350d0f64ba48b85d56067709")
 for rootfile in "newData_FakeRates_SS_2016.root", "newData_FakeRates_SS_2017.root", "newData_FakeRates_SS_2018.root":
     downloader.add(os.path.join("AnalysisStep/data/FakeRates", rootfile))
-for rootfile in "ElectronSF_Legacy_2016_NoGap.root", "ElectronSF_Legacy_2016_Gap.root", "Ele_Reco_2016.root", "Ele_Reco_LowEt_2016.root", "ElectronSF_Legacy_2017_NoGap.root", "ElectronSF_Legacy_2017_Gap.root", "Ele_Reco_2017.root", "Ele_Reco_LowEt_2017.root", "ElectronSF_Legacy_2018_NoGap.root", "ElectronSF_Legacy_2018_Gap.root", "Ele_Reco_2018.root", "Ele_Reco_LowEt_2018.root", "final_HZZ_muon_SF_2016RunB2H_legacy_newLoose_newIso_paper.root", "ScaleFactors_mu_Moriond2017_v2.root", "ScaleFactors_mu_Moriond2018_final.root", "final_HZZ_muon_SF_2018RunA2D_ER_newLoose_newIso_paper.root", "final_HZZ_muon_SF_2018RunA2D_ER_2702.root", "final_HZZ_SF_2017_rereco_mupogsysts_3010.root", "final_HZZ_muon_SF_2017_newLooseIso_mupogSysts_paper.root":
+leptonSFfiles = "ElectronSF_Legacy_2016_NoGap.root", "ElectronSF_Legacy_2016_Gap.root", "Ele_Reco_2016.root", "Ele_Reco_LowEt_2016.root", "ElectronSF_Legacy_2017_NoGap.root", "ElectronSF_Legacy_2017_Gap.root", "Ele_Reco_2017.root", "Ele_Reco_LowEt_2017.root", "ElectronSF_Legacy_2018_NoGap.root", "ElectronSF_Legacy_2018_Gap.root", "Ele_Reco_2018.root", "Ele_Reco_LowEt_2018.root", "final_HZZ_muon_SF_2016RunB2H_legacy_newLoose_newIso_paper.root", "ScaleFactors_mu_Moriond2017_v2.root", "ScaleFactors_mu_Moriond2018_final.root", "final_HZZ_muon_SF_2018RunA2D_ER_newLoose_newIso_paper.root", "final_HZZ_muon_SF_2018RunA2D_ER_2702.root", "final_HZZ_SF_2017_rereco_mupogsysts_3010.root", "final_HZZ_muon_SF_2017_newLooseIso_mupogSysts_paper.root"
+for rootfile in leptonSFfiles:
     downloader.add(os.path.join("AnalysisStep/data/LeptonEffScaleFactors/", rootfile))
 
 with utilities.cd(CJLSTscriptsfolder):
@@ -30,8 +31,10 @@ with utilities.cd(CJLSTscriptsfolder):
 for script in scripts:
     utilities.LoadMacro(os.path.join(CJLSTscriptsfolder, script+".cc+"))
 utilities.LoadMacro(os.path.join(CJLSTscriptsfolder, "FakeRates.cpp+"))
+utilities.LoadMacro(os.path.join(CJLSTscriptsfolder, "categoryAC19batch.cc+"))
+utilities.LoadMacro(os.path.join(CJLSTscriptsfolder, "STXSbatch.cc+"))
 
-from ROOT import categoryAC19, UntaggedAC19, VBF1jTaggedAC19, VBF2jTaggedAC19, VHLeptTaggedAC19, VHHadrTaggedAC19, ttHLeptTaggedAC19, ttHHadrTaggedAC19, VHMETTaggedAC19, BoostedAC19, categoryMor18
+from ROOT import categoryAC19, categoryAC19batch, stage1_reco_1p1batch, UntaggedAC19, VBF1jTaggedAC19, VBF2jTaggedAC19, VHLeptTaggedAC19, VHHadrTaggedAC19, ttHLeptTaggedAC19, ttHHadrTaggedAC19, VHMETTaggedAC19, BoostedAC19, categoryMor18
 
 from ROOT import getDVBF2jetsConstant, getDVBF1jetConstant, getDWHhConstant, getDZHhConstant, getDbkgkinConstant, getDbkgConstant
 from ROOT import getDVBF2jetsWP, getDVBF1jetWP, getDWHhWP, getDZHhWP
@@ -0,0 +1,63 @@
+#include "Category.h"
+
+// Calls categoryAC19 for n events, so that python only has to call into C++ once per batch.
+// The jet variables for event i are jetQGLikelihood[QGLoffsets[i]:QGLoffsets[i+1]]
+// and jetPhi[phioffsets[i]:phioffsets[i+1]].
+void categoryAC19batch(
+                       int n,
+                       int* nExtraLep,
+                       int* nExtraZ,
+                       int* nCleanedJetsPt30,
+                       int* nCleanedJetsPt30BTagged_bTagSF,
+                       float* jetQGLikelihood,
+                       int* QGLoffsets,
+                       double* p_JJQCD_SIG_ghg2_1_JHUGen_JECNominal,
+                       double* p_JQCD_SIG_ghg2_1_JHUGen_JECNominal,
+                       double* p_JJVBF_SIG_ghv1_1_JHUGen_JECNominal,
+                       double* p_JVBF_SIG_ghv1_1_JHUGen_JECNominal,
+                       double* pAux_JVBF_SIG_ghv1_1_JHUGen_JECNominal,
+                       double* p_HadWH_SIG_ghw1_1_JHUGen_JECNominal,
+                       double* p_HadZH_SIG_ghz1_1_JHUGen_JECNominal,
+                       double* p_HadWH_mavjj_JECNominal,
+                       double* p_HadWH_mavjj_true_JECNominal,
+                       double* p_HadZH_mavjj_JECNominal,
+                       double* p_HadZH_mavjj_true_JECNominal,
+                       float* jetPhi,
+                       int* phioffsets,
+                       double* ZZMass,
+                       double* ZZPt,
+                       double* PFMET,
+                       bool useVHMETTagged,
+                       bool useQGTagging,
+                       int* result
+                      )
+{
+  // same as dummyfloatstar in treewrapper.py, used when there are no jets
+  float dummy[1] = {0};
+  for (int i = 0; i < n; i++) {
+    result[i] = categoryAC19(
+                             nExtraLep[i],
+                             nExtraZ[i],
+                             nCleanedJetsPt30[i],
+                             nCleanedJetsPt30BTagged_bTagSF[i],
+                             QGLoffsets[i] == QGLoffsets[i+1] ? dummy : jetQGLikelihood + QGLoffsets[i],
+                             p_JJQCD_SIG_ghg2_1_JHUGen_JECNominal[i],
+                             p_JQCD_SIG_ghg2_1_JHUGen_JECNominal[i],
+                             p_JJVBF_SIG_ghv1_1_JHUGen_JECNominal[i],
+                             p_JVBF_SIG_ghv1_1_JHUGen_JECNominal[i],
+                             pAux_JVBF_SIG_ghv1_1_JHUGen_JECNominal[i],
+                             p_HadWH_SIG_ghw1_1_JHUGen_JECNominal[i],
+                             p_HadZH_SIG_ghz1_1_JHUGen_JECNominal[i],
+                             p_HadWH_mavjj_JECNominal[i],
+                             p_HadWH_mavjj_true_JECNominal[i],
+                             p_HadZH_mavjj_JECNominal[i],
+                             p_HadZH_mavjj_true_JECNominal[i],
+                             phioffsets[i] == phioffsets[i+1] ? dummy : jetPhi + phioffsets[i],
+                             ZZMass[i],
+                             ZZPt[i],
+                             PFMET[i],
+                             useVHMETTagged,
+                             useQGTagging
+                            );
+  }
+}
@@ -1,26 +1,58 @@
 import os
 
+import numpy
 import ROOT
 
 from CJLSTscripts import CJLSTscriptsfolder, convertTGraphstoTH1Fs
-from utilities import cache, KeyDefaultDict
+from constanttables import BinnedFunctionTable
+from utilities import cache, KeyDefaultDict, TFile
+
+fakeratefiles = {
+  (2016, False): os.path.join(CJLSTscriptsfolder, "FakeRates_SS_2016_Legacy.root"),
+  (2017, False): os.path.join(CJLSTscriptsfolder, "FakeRates_SS_2017_Legacy.root"),
+  (2018, False): os.path.join(CJLSTscriptsfolder, "FakeRates_SS_2018_Legacy.root"),
+  (2016, True): os.path.join(CJLSTscriptsfolder, "newData_FakeRates_SS_2016.root"),
+  (2017, True): os.path.join(CJLSTscriptsfolder, "newData_FakeRates_SS_2017.root"),
+  (2018, True): os.path.join(CJLSTscriptsfolder, "newData_FakeRates_SS_2018.root"),
+}
+
+#barrel/endcap boundaries for electrons and muons in FakeRates::GetFakeRate, which aren't in the graphs
+fakerateetaedges = 1.479, 1.2
 
 class FakeRates(ROOT.FakeRates):
   def __init__(self, arg):
-    return super(FakeRates, self).__init__(
-      {
-         (2016, False): os.path.join(CJLSTscriptsfolder, "FakeRates_SS_2016_Legacy.root"),
-         (2017, False): os.path.join(CJLSTscriptsfolder, "FakeRates_SS_2017_Legacy.root"),
-         (2018, False): os.path.join(CJLSTscriptsfolder, "FakeRates_SS_2018_Legacy.root"),
-         (2016, True): os.path.join(CJLSTscriptsfolder, "newData_FakeRates_SS_2016.root"),
-         (2017, True): os.path.join(CJLSTscriptsfolder, "newData_FakeRates_SS_2017.root"),
-         (2018, True): os.path.join(CJLSTscriptsfolder, "newData_FakeRates_SS_2018.root"),
-      }[arg]
-    )
+    return super(FakeRates, self).__init__(fakeratefiles[arg])
 
 __fakerates = KeyDefaultDict(FakeRates)
 
+@cache
+def fakeratetable(year, usenewobjects):
+  ptedges = set()
+  with TFile(fakeratefiles[year, usenewobjects]) as f:
+    for key in f.GetListOfKeys():
+      g = key.ReadObj()
+      if isinstance(g, ROOT.TGraphAsymmErrors):
+        EXlow, EXhigh = g.GetEXlow(), g.GetEXhigh()
+      elif isinstance(g, ROOT.TGraphErrors):
+        EXlow = EXhigh = g.GetEX()
+      else:
+        continue
+      X = g.GetX()
+      for i in xrange(g.GetN()):
+        ptedges.update((X[i] - EXlow[i], X[i] + EXhigh[i]))
+  fakerates = __fakerates[year, usenewobjects]
+  return BinnedFunctionTable(
+    "fake rates {} {}".format(year, "new" if usenewobjects else "old"),
+    lambda ID, pt, eta: fakerates.GetFakeRate(pt, eta, ID),
+    (-13, -11, 11, 13), ptedges, fakerateetaedges + tuple(-eta for eta in fakerateetaedges),
+  )
+
 def getfakerate(year, usenewobjects, leppt, lepeta, leplepid):
+    """
+    leppt, lepeta, and leplepid can also be arrays
+    """
+    if isinstance(leppt, numpy.ndarray):
+        return fakeratetable(year, usenewobjects)(leplepid, leppt, lepeta)
     return __fakerates[year, usenewobjects].GetFakeRate(leppt, lepeta, leplepid)
 
 from ROOT import CRZLLss, test_bit
@@ -74,6 +106,12 @@ class normalizeZX(object):
     }[year][flavor]
 
   def __new__(cls, year, usenewobjects, Z1Flav, Z2Flav):
+    if isinstance(Z1Flav, numpy.ndarray):
+      flavor = Z1Flav*Z2Flav
+      result = numpy.empty(flavor.shape)
+      for f in numpy.unique(flavor).tolist():
+        result[flavor == f] = cls(year, usenewobjects, f, 1)
+      return result
     if usenewobjects:
       return cls.ratio_combination_over_SS_new(year, Z1Flav*Z2Flav)
     else:
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+Calculate the categorizations in TreeWrapper.categorizations for a batch of events at once.
+
+The input is anything that has the variables that the categorizations use as attributes
+(named the same way as in TreeWrapper: nCleanedJetsPt30, p_JJVBF_SIG_ghv1prime2_1_JHUGen_JECNominal,
+g4VBF_m4l, ...) as numpy arrays, and jetQGLikelihood and jetPhi as a sequence of per-event arrays.
+EventArrays wraps a dict or the output of root_numpy.tree2array this way.
+
+The category probabilities (get_pHJJ_function etc.) are evaluated on the whole batch,
+once for each function name, so categorizations that share them (e.g. the btag variations)
+don't recalculate them.  categoryAC19 itself is called in a C++ loop (categoryAC19batch.cc),
+so the categories, including config.useVHMETTagged and config.useQGTagging, are exactly the
+same as in the per-event code.  D_STXS_stage1p1 is done the same way, with categoryMor18 and
+stage1_reco_1p1 in STXSbatch.cc.
+"""
+
+from collections import OrderedDict
+
+import numpy
+
+import CJLSTscripts
+from categorization import BaseSingleCategorization, MultiCategorization, NoCategorization
+import config
+
+#function name: python expression, see get_p_function
+pexpressions = {}
+
+def pexpression(categorization, name):
+    if name not in pexpressions:
+        function = {
+            categorization.pHJJ_function_name: categorization.get_pHJJ_function,
+            categorization.pVBF_function_name: categorization.get_pVBF_function,
+            categorization.pZH_function_name: categorization.get_pZH_function,
+            categorization.pWH_function_name: categorization.get_pWH_function,
+        }[name]()
+        pexpressions[name] = function.expression
+    return pexpressions[name]
+
+def flatten(values):
+    """
+    Concatenates a sequence of per-event arrays for categoryAC19batch.
+    Returns the flat array and the offsets of each event in it.
+    """
+    offsets = numpy.zeros(len(values)+1, dtype=numpy.int32)
+    numpy.cumsum([len(_) for _ in values], out=offsets[1:])
+    if offsets[-1]:
+        flat = numpy.concatenate([numpy.asarray(_, dtype=numpy.float32) for _ in values])
+    else:
+        flat = numpy.zeros(1, dtype=numpy.float32)
+    return flat, offsets
+
+class EventArrays(object):
+    """
+    Gives the columns of a dict or structured array as attributes.
+    """
+    def __init__(self, arrays):
+        self.__arrays = arrays
+    def __len__(self):
+        return len(self.__arrays[self.__arrays.keys()[0]] if isinstance(self.__arrays, dict) else self.__arrays)
+    def __getattr__(self, name):
+        try:
+            return self.__arrays[name]
+        except (KeyError, ValueError):
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+class BatchCategorization(object):
+    """
+    The categories for one batch of events.  batch[categorization] is an array of the category ids.
+    Everything is calculated the first time it's needed and then kept.
+    """
+    def __init__(self, events):
+        self.events = events
+        self.n = len(events)
+        self.__arrays = {}
+        self.__results = {}
+
+    def variable(self, name, dtype):
+        if (name, dtype) not in self.__arrays:
+            self.__arrays[name, dtype] = numpy.ascontiguousarray(getattr(self.events, name), dtype=dtype)
+        return self.__arrays[name, dtype]
+
+    def jets(self, name):
+        if (name, "jets") not in self.__arrays:
+            self.__arrays[name, "jets"] = flatten(getattr(self.events, name))
+        return self.__arrays[name, "jets"]
+
+    def probability(self, categorization, name):
+        if name not in self.__arrays:
+            result = eval(pexpression(categorization, name), {"self_tree": self.events})
+            #the WH probability for L1Zg is just 0
+            self.__arrays[name] = numpy.ascontiguousarray(numpy.zeros(self.n) + result, dtype=numpy.float64)
+        return self.__arrays[name]
+
+    def single(self, categorization):
+        arguments = []
+        for i, (kind, value) in enumerate(categorization.categoryAC19arguments()):
+            if kind == "constant":
+                arguments.append(value)
+            elif kind == "function":
+                arguments.append(self.probability(categorization, value))
+            elif i in (4, 16):
+                #jetQGLikelihood and jetPhi
+                arguments += self.jets(value)
+            elif i < 4:
+                arguments.append(self.variable(value, numpy.int32))
+            else:
+                arguments.append(self.variable(value, numpy.float64))
+        result = numpy.zeros(self.n, dtype=numpy.int32)
+        if self.n:
+            CJLSTscripts.categoryAC19batch(self.n, *(arguments + [result]))
+        return result
+
+    def STXSstage1p1(self, JEC, btag):
+        """
+        D_STXS_stage1p1 with the JEC and b tag variations given by the enums, like in TreeWrapper
+        """
+        jex = JEC.njetsappendname
+        pJEC = "_"+str(JEC)
+        arguments = [
+            self.variable("nExtraLep", numpy.int32),
+            self.variable("nExtraZ", numpy.int32),
+            self.variable("nCleanedJetsPt30"+jex, numpy.int32),
+            self.variable("nCleanedJetsPt30BTagged"+btag.njetsappendname+jex, numpy.int32),
+        ]
+        arguments += self.jets("jetQGLikelihood"+jex)
+        arguments += [
+            self.variable(name+pJEC, numpy.float64) for name in (
+                "p_JJQCD_SIG_ghg2_1_JHUGen",
+                "p_JQCD_SIG_ghg2_1_JHUGen",
+                "p_JJVBF_SIG_ghv1_1_JHUGen",
+                "p_JVBF_SIG_ghv1_1_JHUGen",
+                "pAux_JVBF_SIG_ghv1_1_JHUGen",
+                "p_HadWH_SIG_ghw1_1_JHUGen",
+                "p_HadZH_SIG_ghz1_1_JHUGen",
+                "p_HadWH_mavjj",
+                "p_HadWH_mavjj_true",
+                "p_HadZH_mavjj",
+                "p_HadZH_mavjj_true",
+            )
+        ]
+        arguments += self.jets("jetPhi"+jex)
+        arguments += [
+            self.variable("ZZMass", numpy.float64),
+            self.variable("PFMET_corrected"+jex.replace("jec", "jes"), numpy.float64),
+            config.useVHMETTagged,
+            config.useQGTagging,
+            self.variable("DiJetMass"+jex, numpy.float64),
+            self.variable("ZZPt", numpy.float64),
+            self.variable("HjjPt"+jex, numpy.float64),
+        ]
+        result = numpy.zeros(self.n, dtype=numpy.int32)
+        if self.n:
+            CJLSTscripts.stage1_reco_1p1batch(self.n, *(arguments + [result]))
+        return result
+
+    def multi(self, categorization):
+        #same logic as MultiCategorization.get_category_function
+        singles = [self[_] for _ in sorted(categorization.singles, key=lambda _: _.category_function_name)]
+        VBF = numpy.any([_ == CJLSTscripts.VBF2jTaggedAC19 for _ in singles], axis=0)
+        VH = numpy.any([_ == CJLSTscripts.VHHadrTaggedAC19 for _ in singles], axis=0)
+        for _ in singles[1:]:
+            assert numpy.all(VBF | VH | (_ == singles[0])), categorization
+        return numpy.where(VBF, CJLSTscripts.VBF2jTaggedAC19, numpy.where(VH, CJLSTscripts.VHHadrTaggedAC19, singles[0])).astype(numpy.int32)
+
+    def __getitem__(self, categorization):
+        name = categorization.category_function_name
+        if name not in self.__results:
+            if isinstance(categorization, BaseSingleCategorization):
+                self.__results[name] = self.single(categorization)
+            elif isinstance(categorization, MultiCategorization):
+                self.__results[name] = self.multi(categorization)
+            elif isinstance(categorization, NoCategorization):
+                self.__results[name] = numpy.full(self.n, CJLSTscripts.UntaggedAC19, dtype=numpy.int32)
+            else:
+                raise TypeError("Unknown categorization {!r}".format(categorization))
+        return self.__results[name]
+
+def categorize(events, categorizations):
+    """
+    Returns an OrderedDict of category function name: array of categories
+    """
+    if isinstance(events, dict) or isinstance(events, numpy.ndarray):
+        events = EventArrays(events)
+    batch = BatchCategorization(events)
+    return OrderedDict((_.category_function_name, batch[_]) for _ in categorizations)
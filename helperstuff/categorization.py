@@ -1,4 +1,5 @@
 from abc import ABCMeta, abstractmethod, abstractproperty
+from operator import attrgetter, methodcaller
 from CJLSTscripts import categoryMor18, categoryAC19, UntaggedAC19, VBF2jTaggedAC19, VHHadrTaggedAC19, BoostedAC19
 import config
 from enums import BTagSystematic, Category, categories, HffHypothesis, Hypothesis, JECSystematic
@@ -74,54 +75,46 @@ class BaseSingleCategorization(BaseCategorization):
     @abstractmethod
     def get_pWH_function(self): pass
 
-    def get_category_function(self_categorization):
-        pHJJ_function_name = self_categorization.pHJJ_function_name
-        pVBF_function_name = self_categorization.pVBF_function_name
-        pZH_function_name = self_categorization.pZH_function_name
-        pWH_function_name = self_categorization.pWH_function_name
-
-        pHJ_variable_name = self_categorization.pHJ_variable_name
-        pVBF1j_variable_name = self_categorization.pVBF1j_variable_name
-        pAux_variable_name = self_categorization.pAux_variable_name
-
-        njets_variable_name = self_categorization.njets_variable_name
-        nbtagged_variable_name = self_categorization.nbtagged_variable_name
-        phi_variable_name = self_categorization.phi_variable_name
-        QGL_variable_name = self_categorization.QGL_variable_name
+    def categoryAC19arguments(self_categorization):
+        """
+        The arguments to categoryAC19, as a list of ("variable", name), ("function", name), or ("constant", value)
+        """
+        return [
+            ("variable", "nExtraLep"),
+            ("variable", "nExtraZ"),
+            ("variable", self_categorization.njets_variable_name),
+            ("variable", self_categorization.nbtagged_variable_name),
+            ("variable", self_categorization.QGL_variable_name),
+            ("function", self_categorization.pHJJ_function_name),
+            ("variable", self_categorization.pHJ_variable_name),
+            ("function", self_categorization.pVBF_function_name),
+            ("variable", self_categorization.pVBF1j_variable_name),
+            ("variable", self_categorization.pAux_variable_name),
+            ("function", self_categorization.pWH_function_name),
+            ("function", self_categorization.pZH_function_name),
+            ("variable", self_categorization.p_HadWH_mavjj_variable_name),
+            ("variable", self_categorization.p_HadWH_mavjj_true_variable_name),
+            ("variable", self_categorization.p_HadZH_mavjj_variable_name),
+            ("variable", self_categorization.p_HadZH_mavjj_true_variable_name),
+            ("variable", self_categorization.phi_variable_name),
+            ("variable", "ZZMass"),
+            ("variable", "ZZPt"),
+            ("variable", self_categorization.PFMET_variable_name),
+            ("constant", config.useVHMETTagged),
+            ("constant", config.useQGTagging),
+        ]
 
-        PFMET_variable_name = self_categorization.PFMET_variable_name
-
-        p_HadWH_mavjj_variable_name = self_categorization.p_HadWH_mavjj_variable_name
-        p_HadWH_mavjj_true_variable_name = self_categorization.p_HadWH_mavjj_true_variable_name
-        p_HadZH_mavjj_variable_name = self_categorization.p_HadZH_mavjj_variable_name
-        p_HadZH_mavjj_true_variable_name = self_categorization.p_HadZH_mavjj_true_variable_name
+    def get_category_function(self_categorization):
+        getters = []
+        for kind, value in self_categorization.categoryAC19arguments():
+            if kind == "variable": getters.append(attrgetter(value))
+            elif kind == "function": getters.append(methodcaller(value))
+            elif kind == "constant": getters.append(lambda self_tree, value=value: value)
+            else: assert False, kind
 
         @setname(self_categorization.category_function_name)
         def function(self_tree):
-            result = self_categorization.lastvalue = categoryAC19(
-                self_tree.nExtraLep,
-                self_tree.nExtraZ,
-                  getattr(self_tree, njets_variable_name),
-                  getattr(self_tree, nbtagged_variable_name),
-                  getattr(self_tree, QGL_variable_name),
-                  getattr(self_tree, pHJJ_function_name)(),
-                  getattr(self_tree, pHJ_variable_name),
-                  getattr(self_tree, pVBF_function_name)(),
-                  getattr(self_tree, pVBF1j_variable_name),
-                  getattr(self_tree, pAux_variable_name),
-                  getattr(self_tree, pWH_function_name)(),
-                  getattr(self_tree, pZH_function_name)(),
-                  getattr(self_tree, p_HadWH_mavjj_variable_name),
-                  getattr(self_tree, p_HadWH_mavjj_true_variable_name),
-                  getattr(self_tree, p_HadZH_mavjj_variable_name),
-                  getattr(self_tree, p_HadZH_mavjj_true_variable_name),
-                  getattr(self_tree, phi_variable_name),
-                self_tree.ZZMass,
-                self_tree.ZZPt,
-                  getattr(self_tree, PFMET_variable_name),
-                config.useVHMETTagged,
-                config.useQGTagging,
-            )
+            result = self_categorization.lastvalue = categoryAC19(*[getter(self_tree) for getter in getters])
             return result
 
         return function
@@ -155,6 +148,8 @@ class BaseSingleCategorizationCouplings(BaseSingleCategorization):
         @setname(name)
         def function(self_tree):
             return sum(getattr(self_tree, k)*v for k, v in terms) * multiplier
+        #the same thing as a python expression, for the step2 kernel
+        function.expression = "({}) * {!r}".format(" + ".join(["0"] + ["self_tree.{} * {!r}".format(k, v) for k, v in terms]), multiplier)
         return function
 
     def get_pHJJ_function(self):
@@ -212,6 +207,7 @@ class BaseSingleCategorizationCouplings(BaseSingleCategorization):
         if self.ghzgs1prime2 != 0:
             @setname(self.pWH_function_name)
             def result(self_tree): return 0
+            result.expression = "0"
             return result
         terms = {
                  "p_HadWH_SIG_ghw1_1_JHUGen_{}".format(self.JEC): self.g1**2,
@@ -356,6 +352,9 @@ class SingleCategorizationgm4l(BaseSingleCategorization):
             if usegconstant:
               result *= getattr(self_tree, gconstant)**2
             return result
+        function.expression = "self_tree.{}".format(probability)
+        if usegconstant:
+            function.expression += " * self_tree.{}**2".format(gconstant)
         return function
 
     def get_pHJJ_function(self):
@@ -383,6 +382,7 @@ class SingleCategorizationgm4l(BaseSingleCategorization):
         if self.hypothesis == "L1Zg":
             @setname(self.pWH_function_name)
             def result(self_tree): return 0
+            result.expression = "0"
             return result
         if self.hypothesis == "0+": probability, gconstant = "p_HadWH_SIG_ghw1_1_JHUGen_{}".format(self.JEC), 1
         if self.hypothesis == "a2": probability, gconstant = "p_HadWH_SIG_ghw2_1_JHUGen_{}".format(self.JEC), "g2WH_m4l"
@@ -0,0 +1,910 @@
+#!/usr/bin/env python
+
+"""
+Columnar version of the discriminant calculation in TreeWrapper.
+
+Instead of going through candTree one event at a time, read it in chunks
+into numpy arrays and calculate each discriminant for the whole chunk at once.
+The formulas are the same as in treewrapper.py, but numpy doesn't necessarily
+do the operations in the same order, so the results can differ by rounding.
+Use validatecolumnar to compare them to the legacy ones.
+
+Every output in the production lists, including the categories and STXS with their
+JEC and b tag variations (through batchcategorization), is implemented here, so
+ColumnarTreeWrapper.legacy is empty for them and TreeWrapper.next() never runs.
+Requesting an output that isn't implemented is an error.
+"""
+
+from collections import Counter
+from functools import wraps
+from itertools import izip, izip_longest
+import re
+
+import numpy
+import root_numpy
+import ROOT
+
+from batchcategorization import BatchCategorization
+import CJLSTscripts
+import config
+import constanttables
+from enums import BTagSystematic, JECSystematic
+from treewrapper import TreeWrapper, TreeWrapperBase
+from utilities import product
+
+defaultchunksize = 10000
+
+#suffix of the discriminant name: suffix of the CJLST branch
+JECsuffixes = {
+    "": "JECNominal",
+    "_JECUp": "JECUp",
+    "_JECDn": "JECDn",
+    "_JESUp": "JESUp",
+    "_JESDn": "JESDn",
+    "_JERUp": "JERUp",
+    "_JERDn": "JERDn",
+}
+
+#(attribute, CJLST branch, divide by)
+decayMEs = (
+    ("M2g1_decay",                   "p_GG_SIG_ghg2_1_ghz1_1_JHUGen",                           1),
+    ("M2g4_decay",                   "p_GG_SIG_ghg2_1_ghz4_1_JHUGen",                           1),
+    ("M2g1g4_decay",                 "p_GG_SIG_ghg2_1_ghz1_1_ghz4_1_JHUGen",                    1),
+    ("M2g2_decay",                   "p_GG_SIG_ghg2_1_ghz2_1_JHUGen",                           1),
+    ("M2g1g2_decay",                 "p_GG_SIG_ghg2_1_ghz1_1_ghz2_1_JHUGen",                    1),
+    ("M2g1prime2_decay",             "p_GG_SIG_ghg2_1_ghz1prime2_1E4_JHUGen",                   1e4**2),
+    ("M2g1g1prime2_decay",           "p_GG_SIG_ghg2_1_ghz1_1_ghz1prime2_1E4_JHUGen",            1e4),
+    ("M2ghzgs1prime2_decay",         "p_GG_SIG_ghg2_1_ghza1prime2_1E4_JHUGen",                  1e4**2),
+    ("M2g1ghzgs1prime2_decay",       "p_GG_SIG_ghg2_1_ghz1_1_ghza1prime2_1E4_JHUGen",           1e4),
+    ("M2g2Zg_decay",                 "p_GG_SIG_ghg2_1_ghza2_1_JHUGen",                          1),
+    ("M2g1g2Zg_decay",               "p_GG_SIG_ghg2_1_ghz1_1_ghza2_1_JHUGen",                   1),
+    ("M2g4Zg_decay",                 "p_GG_SIG_ghg2_1_ghza4_1_JHUGen",                          1),
+    ("M2g1g4Zg_decay",               "p_GG_SIG_ghg2_1_ghz1_1_ghza4_1_JHUGen",                   1),
+    ("M2g2gg_decay",                 "p_GG_SIG_ghg2_1_gha2_1_JHUGen",                           1),
+    ("M2g1g2gg_decay",               "p_GG_SIG_ghg2_1_ghz1_1_gha2_1_JHUGen",                    1),
+    ("M2g4gg_decay",                 "p_GG_SIG_ghg2_1_gha4_1_JHUGen",                           1),
+    ("M2g1g4gg_decay",               "p_GG_SIG_ghg2_1_ghz1_1_gha4_1_JHUGen",                    1),
+    ("M2g1prime2ghzgs1prime2_decay", "p_GG_SIG_ghg2_1_ghz1prime2_1E4_ghza1prime2_1E4_JHUGen",   1e4**2),
+)
+
+#{} is replaced by the JEC suffix of the branch
+VBFMEs = (
+    ("M2g1_VBF",                     "p_JJVBF_SIG_ghv1_1_JHUGen_{}",                            1),
+    ("M2g4_VBF",                     "p_JJVBF_SIG_ghv4_1_JHUGen_{}",                            1),
+    ("M2g1g4_VBF",                   "p_JJVBF_SIG_ghv1_1_ghv4_1_JHUGen_{}",                     1),
+    ("M2g2_VBF",                     "p_JJVBF_SIG_ghv2_1_JHUGen_{}",                            1),
+    ("M2g1g2_VBF",                   "p_JJVBF_SIG_ghv1_1_ghv2_1_JHUGen_{}",                     1),
+    ("M2g1prime2_VBF",               "p_JJVBF_SIG_ghv1prime2_1E4_JHUGen_{}",                    1e4**2),
+    ("M2g1g1prime2_VBF",             "p_JJVBF_SIG_ghv1_1_ghv1prime2_1E4_JHUGen_{}",             1e4),
+    ("M2ghzgs1prime2_VBF",           "p_JJVBF_SIG_ghza1prime2_1E4_JHUGen_{}",                   1e4**2),
+    ("M2g1ghzgs1prime2_VBF",         "p_JJVBF_SIG_ghv1_1_ghza1prime2_1E4_JHUGen_{}",            1e4),
+    ("M2g4Zg_VBF",                   "p_JJVBF_SIG_ghza4_1_JHUGen_{}",                           1),
+    ("M2g1g4Zg_VBF",                 "p_JJVBF_SIG_ghv1_1_ghza4_1_JHUGen_{}",                    1),
+    ("M2g2Zg_VBF",                   "p_JJVBF_SIG_ghza2_1_JHUGen_{}",                           1),
+    ("M2g1g2Zg_VBF",                 "p_JJVBF_SIG_ghv1_1_ghza2_1_JHUGen_{}",                    1),
+    ("M2g4gg_VBF",                   "p_JJVBF_SIG_gha4_1_JHUGen_{}",                            1),
+    ("M2g1g4gg_VBF",                 "p_JJVBF_SIG_ghv1_1_gha4_1_JHUGen_{}",                     1),
+    ("M2g2gg_VBF",                   "p_JJVBF_SIG_gha2_1_JHUGen_{}",                            1),
+    ("M2g1g2gg_VBF",                 "p_JJVBF_SIG_ghv1_1_gha2_1_JHUGen_{}",                     1),
+    ("M2g2_HJJ",                     "p_JJQCD_SIG_ghg2_1_JHUGen_{}",                            1),
+)
+
+#these are also multiplied by mavjj / mavjj_true / pConst, except for notrescaled
+HadZHMEs = (
+    ("M2g1_HadZH",                   "p_HadZH_SIG_ghz1_1_JHUGen_{}",                            1),
+    ("M2g4_HadZH",                   "p_HadZH_SIG_ghz4_1_JHUGen_{}",                            1),
+    ("M2g1g4_HadZH",                 "p_HadZH_SIG_ghz1_1_ghz4_1_JHUGen_{}",                     1),
+    ("M2g2_HadZH",                   "p_HadZH_SIG_ghz2_1_JHUGen_{}",                            1),
+    ("M2g1g2_HadZH",                 "p_HadZH_SIG_ghz1_1_ghz2_1_JHUGen_{}",                     1),
+    ("M2g1prime2_HadZH",             "p_HadZH_SIG_ghz1prime2_1E4_JHUGen_{}",                    1e4**2),
+    ("M2g1g1prime2_HadZH",           "p_HadZH_SIG_ghz1_1_ghz1prime2_1E4_JHUGen_{}",             1e4),
+    ("M2ghzgs1prime2_HadZH",         "p_HadZH_SIG_ghza1prime2_1E4_JHUGen_{}",                   1e4**2),
+    ("M2g1ghzgs1prime2_HadZH",       "p_HadZH_SIG_ghz1_1_ghza1prime2_1E4_JHUGen_{}",            1e4),
+    ("M2g4Zg_HadZH",                 "p_HadZH_SIG_ghza4_1_JHUGen_{}",                           1),
+    ("M2g1g4Zg_HadZH",               "p_HadZH_SIG_ghz1_1_ghza4_1_JHUGen_{}",                    1),
+    ("M2g2Zg_HadZH",                 "p_HadZH_SIG_ghza2_1_JHUGen_{}",                           1),
+    ("M2g1g2Zg_HadZH",               "p_HadZH_SIG_ghz1_1_ghza2_1_JHUGen_{}",                    1),
+    ("M2g4gg_HadZH",                 "p_HadZH_SIG_gha4_1_JHUGen_{}",                            1),
+    ("M2g1g4gg_HadZH",               "p_HadZH_SIG_ghz1_1_gha4_1_JHUGen_{}",                     1),
+    ("M2g2gg_HadZH",                 "p_HadZH_SIG_gha2_1_JHUGen_{}",                            1),
+    ("M2g1g2gg_HadZH",               "p_HadZH_SIG_ghz1_1_gha2_1_JHUGen_{}",                     1),
+)
+HadWHMEs = (
+    ("M2g1_HadWH",                   "p_HadWH_SIG_ghw1_1_JHUGen_{}",                            1),
+    ("M2g4_HadWH",                   "p_HadWH_SIG_ghw4_1_JHUGen_{}",                            1),
+    ("M2g1g4_HadWH",                 "p_HadWH_SIG_ghw1_1_ghw4_1_JHUGen_{}",                     1),
+    ("M2g2_HadWH",                   "p_HadWH_SIG_ghw2_1_JHUGen_{}",                            1),
+    ("M2g1g2_HadWH",                 "p_HadWH_SIG_ghw1_1_ghw2_1_JHUGen_{}",                     1),
+    ("M2g1prime2_HadWH",             "p_HadWH_SIG_ghw1prime2_1E4_JHUGen_{}",                    1e4**2),
+    ("M2g1g1prime2_HadWH",           "p_HadWH_SIG_ghw1_1_ghw1prime2_1E4_JHUGen_{}",             1e4),
+)
+#(attribute, JEC) that TreeWrapper.next() doesn't multiply by mavjj / mavjj_true / pConst.
+#That's probably a mistake there, but the columnar engine has to give the same results.
+notrescaled = {
+    ("M2g4Zg_HadZH", "_JECDn"),
+}
+
+#no photon couplings for WH
+HadWHzeros = (
+    "M2ghzgs1prime2_HadWH",
+    "M2g1ghzgs1prime2_HadWH",
+    "M2g4Zg_HadWH",
+    "M2g1g4Zg_HadWH",
+    "M2g2Zg_HadWH",
+    "M2g1g2Zg_HadWH",
+    "M2g4gg_HadWH",
+    "M2g1g4gg_HadWH",
+    "M2g2gg_HadWH",
+    "M2g1g2gg_HadWH",
+)
+
+#arguments to CJLSTscripts.D_bkg_VBFdec and D_bkg_VHdec, in order
+Dbkgkinbranches = (
+    "p_JJVBF_S_SIG_ghv1_1_MCFM_{}",
+    "p_HadZH_S_SIG_ghz1_1_MCFM_{}",
+    "p_HadWH_S_SIG_ghw1_1_MCFM_{}",
+    "p_JJVBF_BKG_MCFM_{}",
+    "p_HadZH_BKG_MCFM_{}",
+    "p_HadWH_BKG_MCFM_{}",
+    "p_JJQCD_BKG_MCFM_{}",
+    "p_HadZH_mavjj_{}",
+    "p_HadZH_mavjj_true_{}",
+    "p_HadWH_mavjj_{}",
+    "p_HadWH_mavjj_true_{}",
+    "pConst_JJVBF_S_SIG_ghv1_1_MCFM_{}",
+    "pConst_HadZH_S_SIG_ghz1_1_MCFM_{}",
+    "pConst_HadWH_S_SIG_ghw1_1_MCFM_{}",
+    "pConst_JJVBF_BKG_MCFM_{}",
+    "pConst_HadZH_BKG_MCFM_{}",
+    "pConst_HadWH_BKG_MCFM_{}",
+    "pConst_JJQCD_BKG_MCFM_{}",
+)
+
+#(attribute, process, coupling)
+gconstants = tuple(
+    ("{}{}_m4l".format(name, process), processname, coupling)
+        for process, processname, couplings in (
+            ("HZZ", "HZZ2e2mu", (("g2", "g2"), ("g4", "g4"), ("g1prime2", "L1"), ("ghzgs1prime2", "L1Zg"))),
+            ("VBF", "VBF",      (("g2", "g2"), ("g4", "g4"), ("g1prime2", "L1"), ("ghzgs1prime2", "L1Zg"), ("g2Zg", "g2Zg"), ("g4Zg", "g4Zg"), ("g2gg", "g2gg"), ("g4gg", "g4gg"))),
+            ("VH",  "VH",       (("g2", "g2"), ("g4", "g4"), ("g1prime2", "L1"), ("ghzgs1prime2", "L1Zg"), ("g2Zg", "g2Zg"), ("g4Zg", "g4Zg"), ("g2gg", "g2gg"), ("g4gg", "g4gg"))),
+            ("ZH",  "ZH",       (("g2", "g2"), ("g4", "g4"), ("g1prime2", "L1"), ("ghzgs1prime2", "L1Zg"))),
+            ("WH",  "WH",       (("g2", "g2"), ("g4", "g4"), ("g1prime2", "L1"))),
+        )
+        for name, coupling in couplings
+) + tuple(
+    ("{}_m4l".format(name), "HZZ2e2mu", coupling)
+        for name, coupling in (("g2HZg", "g2Zg"), ("g4HZg", "g4Zg"), ("g2Hgg", "g2gg"), ("g4Hgg", "g4gg"))
+)
+
+def percandidate(function, *arrays):
+    """
+    Call a scalar function, e.g. one of the C++ functions in CJLSTscripts, for each candidate.
+    """
+    return numpy.array([function(*args) for args in izip(*(a.tolist() for a in arrays))], dtype=float)
+
+class ChunkReader(object):
+    """
+    Reads branches of the tree for entries [start, stop), one branch at a time,
+    so that only the branches that are actually used get read.
+    """
+    def __init__(self, tree, start, stop):
+        self.tree = tree
+        self.start = start
+        self.stop = stop
+        self.__arrays = {}
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, branchname):
+        if branchname not in self.__arrays:
+            result = root_numpy.tree2array(self.tree, branches=[branchname], start=self.start, stop=self.stop)[branchname]
+            #the legacy code does everything in double precision
+            if result.dtype == numpy.float32: result = result.astype(numpy.float64)
+            self.__arrays[branchname] = result
+        return self.__arrays[branchname]
+
+def selectentries(selected, reader):
+    """
+    The entries in the chunk out of selected, which is TreeWrapper.selectedentries() as an array.
+    """
+    return selected[numpy.searchsorted(selected, reader.start):numpy.searchsorted(selected, reader.stop)]
+
+class JECVariables(object):
+    """
+    The variables that depend on the jets, for one JEC shift.
+    """
+    def __init__(self, JEC):
+        self.JEC = JEC
+        self.JECbranch = JECsuffixes[JEC]
+
+class ColumnarChunk(object):
+    """
+    Arrays of the variables that TreeWrapper.next() sets, for the selected events in one chunk.
+    Variables that depend on the jets are in self.jec[JEC]; everything else is an attribute of the chunk.
+    """
+    def __init__(self, treewrapper, reader, entries):
+        self.treewrapper = treewrapper
+        self.entries = entries
+        self.__reader = reader
+        self.__index = entries - reader.start
+        self.__results = {}
+        self.__categories = None
+
+        self.ZZMass = self.branch("ZZMass")
+        self.flavor = abs(self.branch("Z1Flav")*self.branch("Z2Flav"))
+
+        self.cconstantforDbkgkin = constanttables.cconstantforDbkgkin(self.flavor, self.ZZMass)
+        self.cconstantforDbkg = constanttables.cconstantforDbkg(self.flavor, self.ZZMass)
+        self.cconstantforD2jet = constanttables.cconstantforD2jet(self.ZZMass)
+        self.cconstantforDHadWH = constanttables.cconstantforDHadWH(self.ZZMass)
+        self.cconstantforDHadZH = constanttables.cconstantforDHadZH(self.ZZMass)
+
+        self.p_m4l_BKG = self.branch("p_m4l_BKG")
+        self.p_m4l_SIG = self.branch("p_m4l_SIG")
+        for a in "SIG", "BKG":
+            for b in "Scale", "Res":
+                for c in "Up", "Down":
+                    attr = "p_m4l_{}_{}{}".format(a, b, c)
+                    setattr(self, attr, self.branch(attr))
+
+        self.M2qqZZ = self.branch("p_QQB_BKG_MCFM")
+        for attr, branchname, divideby in decayMEs:
+            setattr(self, attr, self.branch(branchname) / divideby)
+
+        for attr, process, coupling in gconstants:
+            setattr(self, attr, constanttables.gconstant(process, coupling, self.ZZMass))
+
+        self.jec = {}
+        for JEC in JECsuffixes:
+            if JEC == "" or "JEC" in JEC and treewrapper.useJEC or "JES" in JEC and treewrapper.useJES or "JER" in JEC and treewrapper.useJER:
+                self.jec[JEC] = self.jetvariables(JEC)
+
+    def jetvariables(self, JEC):
+        v = JECVariables(JEC)
+        for attr, branchname, divideby in VBFMEs + HadZHMEs + HadWHMEs:
+            setattr(v, attr, self.branch(branchname.format(v.JECbranch)) / divideby)
+        for VH, MEs in ("ZH", HadZHMEs), ("WH", HadWHMEs):
+            mavjj = self.branch("p_Had{}_mavjj_{}".format(VH, v.JECbranch))
+            mavjj_true = self.branch("p_Had{}_mavjj_true_{}".format(VH, v.JECbranch))
+            pConst = self.branch("pConst_Had{0}_SIG_gh{1}1_1_JHUGen_{2}".format(VH, VH[0].lower(), v.JECbranch))
+            setattr(v, "pConst_Had{}_SIG".format(VH), pConst)
+            for attr, branchname, divideby in MEs:
+                if (attr, JEC) in notrescaled: continue
+                setattr(v, attr, getattr(v, attr) * (mavjj / mavjj_true / pConst))
+        for attr in HadWHzeros:
+            setattr(v, attr, numpy.zeros(len(self)))
+        v.notdijet = v.M2g1_VBF <= 0
+        return v
+
+    def __len__(self):
+        return len(self.entries)
+
+    def branch(self, branchname):
+        return self.__reader[branchname][self.__index]
+
+    @property
+    def overallEventWeight(self):
+        return self.branch("overallEventWeight")
+
+    @property
+    def categories(self):
+        if self.__categories is None:
+            self.__categories = BatchCategorization(CategoryVariables(self.branch, len(self), self.treewrapper.GEN))
+        return self.__categories
+
+    def evaluate(self, name):
+        if name not in self.__results:
+            function, JEC = discriminantfunctions[name]
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                self.__results[name] = function(self, self.jec[JEC])
+        return self.__results[name]
+
+    def __getattr__(self, attr):
+        #so that functions written for TreeWrapper, like config.blindcut, can call self.D_bkg()
+        if attr in discriminantfunctions:
+            return lambda: self.evaluate(attr)
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, attr))
+
+#TreeWrapper attribute: (CJLST branch, divide by), for the MEs that are rescaled
+rescaledMEs = {
+    branchname.replace("1E4", "1"): (branchname, divideby)
+        for attr, branchname, divideby in VBFMEs + HadZHMEs + HadWHMEs
+        if divideby != 1
+}
+
+#TreeWrapper attribute: (process, coupling)
+gconstantsbyname = {attr: (process, coupling) for attr, process, coupling in gconstants}
+
+def jagged(values, dtype):
+    """
+    Concatenates a sequence of per-event arrays.  Returns the flat array and the offsets of each event in it.
+    """
+    offsets = numpy.zeros(len(values)+1, dtype=numpy.int64)
+    numpy.cumsum([len(_) for _ in values], out=offsets[1:])
+    if offsets[-1]:
+        flat = numpy.concatenate([numpy.asarray(_, dtype=dtype) for _ in values])
+    else:
+        flat = numpy.zeros(0, dtype=dtype)
+    return flat, offsets
+
+def ptetaphim(pt, eta, phi, m):
+    """
+    Four-vectors as an array of (px, py, pz, E), the same way as TLorentzVector::SetPtEtaPhiM
+    """
+    pt = abs(pt)
+    px, py, pz = pt*numpy.cos(phi), pt*numpy.sin(phi), pt*numpy.sinh(eta)
+    p2 = px**2 + py**2 + pz**2
+    E = numpy.where(m >= 0, numpy.sqrt(p2 + m**2), numpy.sqrt(numpy.maximum(p2 - m**2, 0)))
+    return numpy.array([px, py, pz, E])
+
+def invariantmass(vector):
+    """TLorentzVector::M, which is negative for spacelike vectors"""
+    px, py, pz, E = vector
+    m2 = E**2 - px**2 - py**2 - pz**2
+    return numpy.sign(m2) * numpy.sqrt(abs(m2))
+
+def transversemomentum(vector):
+    px, py, pz, E = vector
+    return numpy.sqrt(px**2 + py**2)
+
+class CategoryVariables(object):
+    """
+    The variables that the categorizations use, named the same way as in TreeWrapper,
+    for batchcategorization.  branch(branchname) gives the CJLST branch for the events.
+    """
+    JECbranchsuffix = re.compile("^(.*_)({})$".format("|".join(JECsuffixes.itervalues())))
+    jetsystematicname = re.compile("^(nCleanedJetsPt30BTagged_bTagSF|jetQGLikelihood|jetPhi)(_je[cs](?:Up|Dn))$")
+    dijetname = re.compile("^(DiJetMass|HjjPt)(_je[cs](?:Up|Dn))$")
+
+    def __init__(self, branch, n, GEN):
+        self.__branch = branch
+        self.__n = n
+        self.__GEN = GEN
+        self.__cache = {}
+        self.__jetsystematics = {}
+        self.__dijets = {}
+        self.__jets = None
+        self.__shiftedjets = None
+
+    def __len__(self):
+        return self.__n
+
+    def branch(self, branchname):
+        return self.__branch(branchname)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        if name not in self.__cache:
+            self.__cache[name] = self.variable(name)
+        return self.__cache[name]
+
+    def variable(self, name):
+        GEN = self.__GEN
+        if name == "jetPhi":
+            return self.branch("JetPhi")
+        if name == "jetQGLikelihood":
+            #TreeWrapper uses dummyfloatstar for GEN
+            return [[0.]]*len(self) if GEN else self.branch("JetQGLikelihood")
+        if name == "PFMET_corrected" and GEN:
+            return self.branch("PFMET")
+        if name.startswith("nCleanedJetsPt30BTagged") and GEN:
+            return numpy.zeros(len(self), dtype=int)
+        if name in gconstantsbyname:
+            process, coupling = gconstantsbyname[name]
+            return constanttables.gconstant(process, coupling, self.branch("ZZMass"))
+        match = self.jetsystematicname.match(name)
+        if match:
+            variable, jex = match.groups()
+            if jex not in self.__jetsystematics:
+                self.__jetsystematics[jex] = self.jetsystematic(jex)
+            return self.__jetsystematics[jex][variable]
+        if name == "HjjPt":
+            return self.dijet("")["HjjPt"]
+        match = self.dijetname.match(name)
+        if match:
+            return self.dijet(match.group(2))[name]
+        match = self.JECbranchsuffix.match(name)
+        if match and match.group(1)+"{}" in rescaledMEs:
+            branchname, divideby = rescaledMEs[match.group(1)+"{}"]
+            return self.branch(branchname.format(match.group(2))) / divideby
+        return self.branch(name)
+
+    @property
+    def jets(self):
+        """
+        (pt, eta, phi, mass, offsets) of all the jets, flattened with jagged
+        """
+        if self.__jets is None:
+            pt, offsets = jagged(self.branch("JetPt"), numpy.float64)
+            eta, phi, m = (jagged(self.branch(_), numpy.float64)[0] for _ in ("JetEta", "JetPhi", "JetMass"))
+            self.__jets = pt, eta, phi, m, offsets
+        return self.__jets
+
+    @property
+    def shiftedjets(self):
+        """
+        The jets in order of decreasing pt*(1+sigma), which is what TreeWrapper.next() does
+        for all the JEC and JES variations, up and down.  Ties are in decreasing index, like sorted(..., reverse=True).
+        Returns (offsets, index, pt): index[offsets[i]:offsets[i+1]] are the indices of event i's jets
+        in that order, and pt[offsets[i]:offsets[i+1]] are their shifted pts.
+        """
+        if self.__shiftedjets is None:
+            pt, eta, phi, m, offsets = self.jets
+            sigma, offsets = jagged(self.branch("JetSigma"), numpy.float64)
+            shifted = pt * (1+sigma)
+            event = numpy.repeat(numpy.arange(len(self)), numpy.diff(offsets))
+            index = numpy.arange(len(shifted)) - offsets[event]
+            order = numpy.lexsort((-index, -shifted, event))
+            self.__shiftedjets = offsets, index[order], shifted[order]
+        return self.__shiftedjets
+
+    def jetsystematic(self, jex):
+        """
+        nCleanedJetsPt30BTagged_bTagSF, jetQGLikelihood, and jetPhi for one JEC or JES variation (jex = _jecUp etc.),
+        the same way as in TreeWrapper.next(): if the number of jets with pt > 30 changes, the b tagged jets
+        are counted again and the jets are put in the new order.
+        """
+        offsets, index, shiftedpt = self.shiftedjets
+        njets = self.branch("nCleanedJetsPt30")
+        njetsshifted = self.branch("nCleanedJetsPt30"+jex)
+        nbtagged = numpy.array(self.nCleanedJetsPt30BTagged_bTagSF, dtype=int)
+        QGL = list(self.jetQGLikelihood)
+        phi = list(self.jetPhi)
+        changed = numpy.flatnonzero(njets != njetsshifted)
+        if len(changed):
+            btagged, allQGL, allphi = (self.branch(_) for _ in ("JetIsBtaggedWithSF", "JetQGLikelihood", "JetPhi"))
+        for i in changed:
+            indices = index[offsets[i]:offsets[i+1]][shiftedpt[offsets[i]:offsets[i+1]] > 30]
+            nbtagged[i] = int(numpy.asarray(btagged[i], dtype=numpy.float64)[indices].sum())
+            if not numpy.array_equal(indices, numpy.arange(njetsshifted[i])):
+                QGL[i] = numpy.asarray(allQGL[i], dtype=numpy.float32)[indices]
+                phi[i] = numpy.asarray(allphi[i], dtype=numpy.float32)[indices]
+        return {"nCleanedJetsPt30BTagged_bTagSF": nbtagged, "jetQGLikelihood": QGL, "jetPhi": phi}
+
+    def dijet(self, jex):
+        """
+        DiJetMass and HjjPt for a JEC or JES variation, or for the nominal jets if jex is "",
+        the same way as in TreeWrapper.next(), from the first two jets in shiftedjets or in the tree.
+        For the nominal jets, DiJetMass is taken from the tree instead.
+        """
+        if jex not in self.__dijets:
+            pt, eta, phi, m, offsets = self.jets
+            nCleanedJets = self.branch("nCleanedJets")
+            if jex:
+                offsets, index, shiftedpt = self.shiftedjets
+                selected = numpy.flatnonzero(self.branch("nCleanedJetsPt30"+jex) >= 2)
+            else:
+                selected = numpy.flatnonzero(nCleanedJets >= 2)
+            first = offsets[selected]
+
+            jets = []
+            for position in first, first+1:
+                if jex:
+                    jet = first + index[position]
+                    jetpt = shiftedpt[position]
+                else:
+                    jet = position
+                    jetpt = pt[jet]
+                jets.append(ptetaphim(jetpt, eta[jet], phi[jet], m[jet]))
+            H = ptetaphim(*(self.branch(_)[selected] for _ in ("ZZPt", "ZZEta", "ZZPhi", "ZZMass")))
+
+            DiJetMass = numpy.full(len(self), -99.)
+            DiJetMass[selected] = invariantmass(jets[0] + jets[1])
+            HjjPt = numpy.full(len(self), -99.)
+            HjjPt[selected] = numpy.where(nCleanedJets[selected] >= 2, transversemomentum(H + jets[0] + jets[1]), -99.)
+            self.__dijets[jex] = {"DiJetMass"+jex: DiJetMass, "HjjPt"+jex: HjjPt}
+        return self.__dijets[jex]
+
+##########
+#formulas#
+##########
+
+def divide(numerator, denominator):
+    """
+    numerator / denominator, or 0 where the denominator is 0
+    (the legacy functions catch ZeroDivisionError and return 0)
+    """
+    return numpy.where(denominator == 0, 0., numerator / denominator)
+
+def pure(SM, BSM, g):
+    return divide(SM, SM + BSM*g**2)
+def interference(SM, BSM, SMBSM, g):
+    return divide(SMBSM*g, SM + BSM*g**2)
+def interference_new(SM, BSM, SMBSM, g):
+    return divide(SMBSM*g, 2 * numpy.sqrt(SM * BSM*g**2))
+
+def dijet(function):
+    """the legacy functions return -999 if notdijet"""
+    @wraps(function)
+    def newfunction(c, v):
+        return numpy.where(v.notdijet, -999, function(c, v))
+    return newfunction
+
+discriminantfunctions = {}
+
+def register(name, JEC=""):
+    def inner_register(function):
+        assert name+JEC not in discriminantfunctions, name+JEC
+        discriminantfunctions[name+JEC] = function, JEC
+        return function
+    return inner_register
+
+def registerbkg():
+    for syst in "", "_ResUp", "_ResDown", "_ScaleUp", "_ScaleDown":
+        @register("D_bkg"+syst)
+        def D_bkg(c, v, syst=syst):
+            p_m4l_SIG, p_m4l_BKG = getattr(c, "p_m4l_SIG"+syst), getattr(c, "p_m4l_BKG"+syst)
+            return numpy.where(
+              p_m4l_SIG <= 0, -999,
+              c.M2g1_decay*p_m4l_SIG / (c.M2g1_decay*p_m4l_SIG  + c.M2qqZZ*p_m4l_BKG*c.cconstantforDbkg)
+            )
+
+    for prod, Dbkgkin in ("VBF", CJLSTscripts.D_bkg_VBFdec), ("HadVH", CJLSTscripts.D_bkg_VHdec):
+        for JEC in JECsuffixes:
+            @register("D_bkg_kin_{}decay".format(prod), JEC)
+            def D_bkg_kin(c, v, Dbkgkin=Dbkgkin):
+                result = numpy.full(len(c), -999.)
+                isdijet = ~v.notdijet
+                args = [c.branch(branchname.format(v.JECbranch))[isdijet] for branchname in Dbkgkinbranches] + [c.flavor[isdijet], c.ZZMass[isdijet]]
+                result[isdijet] = percandidate(Dbkgkin, *args)
+                return result
+
+            @register("D_bkg_{}decay".format(prod), JEC)
+            def D_bkg_proddecay(c, v, prod=prod):
+                return D_bkg_proddecay_withm4l(c, v, prod, "", v.JEC)
+
+        for syst in "_ResUp", "_ResDown", "_ScaleUp", "_ScaleDown":
+            @register("D_bkg_{}decay{}".format(prod, syst))
+            def D_bkg_proddecay_syst(c, v, prod=prod, syst=syst):
+                return D_bkg_proddecay_withm4l(c, v, prod, syst, "")
+
+def D_bkg_proddecay_withm4l(c, v, prod, syst, JEC):
+    p_m4l_SIG, p_m4l_BKG = getattr(c, "p_m4l_SIG"+syst), getattr(c, "p_m4l_BKG"+syst)
+
+    #result = signal / (signal+bkg) = 1 / (1+bkg/signal)
+    #1/result - 1 = bkg/signal
+
+    result = c.evaluate("D_bkg_kin_{}decay{}".format(prod, JEC))
+
+    result = 1/result - 1
+    result *= p_m4l_BKG / p_m4l_SIG * c.cconstantforDbkg / c.cconstantforDbkgkin
+    result = 1/(1+result)
+
+    return numpy.where(v.notdijet | (p_m4l_SIG <= 0), -999, result)
+
+def registerjetdiscriminants():
+    #(name, BSM coupling, coupling for the g constant)
+    for name, BSM, g in (
+      ("0plus", "g1", None),
+      ("0minus", "g4", "g4"),
+      ("a2", "g2", "g2"),
+      ("L1", "g1prime2", "g1prime2"),
+      ("L1Zg", "ghzgs1prime2", "ghzgs1prime2"),
+    ):
+        @register("D_2jet_"+name)
+        @dijet
+        def D_2jet(c, v, BSM=BSM, g=g):
+            numerator = getattr(v, "M2{}_VBF".format(BSM))
+            if g is not None: numerator = numerator*getattr(c, "{}VBF_m4l".format(g))**2
+            return numerator / (numerator + v.M2g2_HJJ*c.cconstantforD2jet)
+
+        for VH in "WH", "ZH":
+            @register("D_Had{}_{}".format(VH, name))
+            @dijet
+            def D_HadVH(c, v, BSM=BSM, g=g, VH=VH):
+                if VH == "WH" and BSM == "ghzgs1prime2": return numpy.zeros(len(c))
+                numerator = getattr(v, "M2{}_Had{}".format(BSM, VH))
+                if g is not None: numerator = numerator*getattr(c, "{}{}_m4l".format(g, VH))**2
+                return numerator / (numerator + v.M2g2_HJJ*getattr(c, "cconstantforDHad"+VH) / getattr(v, "pConst_Had{}_SIG".format(VH)))
+
+#pure BSM name, interference name, whether there's an old-style interference discriminant,
+#BSM |M|^2, interference |M|^2, g constant for decay, g constant for production ({} = VBF or VH)
+anomalouscouplings = (
+    ("0minus",    "CP",      True,  "g4",           "g1g4",           "g4HZZ",           "g4{}"),
+    ("0hplus",    "int",     True,  "g2",           "g1g2",           "g2HZZ",           "g2{}"),
+    ("L1",        "L1int",   True,  "g1prime2",     "g1g1prime2",     "g1prime2HZZ",     "g1prime2{}"),
+    ("L1Zg",      "L1Zgint", True,  "ghzgs1prime2", "g1ghzgs1prime2", "ghzgs1prime2HZZ", "ghzgs1prime2{}"),
+    ("0minus_Zg", "CP_Zg",   False, "g4Zg",         "g1g4Zg",         "g4HZg",           "g4Zg{}"),
+    ("0hplus_Zg", "int_Zg",  False, "g2Zg",         "g1g2Zg",         "g2HZg",           "g2Zg{}"),
+    ("0minus_gg", "CP_gg",   False, "g4gg",         "g1g4gg",         "g4Hgg",           "g4gg{}"),
+    ("0hplus_gg", "int_gg",  False, "g2gg",         "g1g2gg",         "g2Hgg",           "g2gg{}"),
+)
+#couplings that exist for WH
+WHcouplings = "g4", "g2", "g1prime2"
+
+def registeranomalouscouplings():
+    for purename, intname, oldinterference, BSM, SMBSM, gdecay, gproduction in anomalouscouplings:
+        gdecay = gdecay+"_m4l"
+        gVBF = gproduction.format("VBF")+"_m4l"
+        gVH = gproduction.format("VH")+"_m4l"
+
+        #decay
+        @register("D_{}_decay".format(purename))
+        def D_pure_decay(c, v, BSM=BSM, gdecay=gdecay):
+            return pure(c.M2g1_decay, getattr(c, "M2{}_decay".format(BSM)), getattr(c, gdecay))
+        @register("D_{}_decay_new".format(intname))
+        def D_int_decay_new(c, v, BSM=BSM, SMBSM=SMBSM, gdecay=gdecay):
+            return interference_new(c.M2g1_decay, getattr(c, "M2{}_decay".format(BSM)), getattr(c, "M2{}_decay".format(SMBSM)), getattr(c, gdecay))
+        if oldinterference:
+            @register("D_{}_decay".format(intname))
+            def D_int_decay(c, v, BSM=BSM, SMBSM=SMBSM, gdecay=gdecay):
+                return interference(c.M2g1_decay, getattr(c, "M2{}_decay".format(BSM)), getattr(c, "M2{}_decay".format(SMBSM)), getattr(c, gdecay))
+
+        for JEC in JECsuffixes:
+            #VBF
+            @register("D_{}_VBF".format(purename), JEC)
+            @dijet
+            def D_pure_VBF(c, v, BSM=BSM, gVBF=gVBF):
+                return pure(v.M2g1_VBF, getattr(v, "M2{}_VBF".format(BSM)), getattr(c, gVBF))
+            @register("D_{}_VBF_new".format(intname), JEC)
+            @dijet
+            def D_int_VBF_new(c, v, BSM=BSM, SMBSM=SMBSM, gVBF=gVBF):
+                return interference_new(v.M2g1_VBF, getattr(v, "M2{}_VBF".format(BSM)), getattr(v, "M2{}_VBF".format(SMBSM)), getattr(c, gVBF))
+            if oldinterference:
+                @register("D_{}_VBF".format(intname), JEC)
+                @dijet
+                def D_int_VBF(c, v, BSM=BSM, SMBSM=SMBSM, gVBF=gVBF):
+                    return interference(v.M2g1_VBF, getattr(v, "M2{}_VBF".format(BSM)), getattr(v, "M2{}_VBF".format(SMBSM)), getattr(c, gVBF))
+
+            #HadVH
+            @register("D_{}_HadVH".format(purename), JEC)
+            @dijet
+            def D_pure_HadVH(c, v, BSM=BSM, gVH=gVH):
+                return pure(
+                  v.M2g1_HadWH + v.M2g1_HadZH,
+                  getattr(v, "M2{}_HadWH".format(BSM)) + getattr(v, "M2{}_HadZH".format(BSM)),
+                  getattr(c, gVH),
+                )
+            @register("D_{}_HadVH_new".format(intname), JEC)
+            @dijet
+            def D_int_HadVH_new(c, v, BSM=BSM, SMBSM=SMBSM):
+                #no g constants here, and the legacy function returns 0 if either one divides by 0
+                ZHdenominator = 2 * numpy.sqrt(v.M2g1_HadZH * getattr(v, "M2{}_HadZH".format(BSM)))
+                if BSM not in WHcouplings:
+                    return divide(getattr(v, "M2{}_HadZH".format(SMBSM)), ZHdenominator)
+                WHdenominator = 2 * numpy.sqrt(v.M2g1_HadWH * getattr(v, "M2{}_HadWH".format(BSM)))
+                return numpy.where(
+                  (WHdenominator == 0) | (ZHdenominator == 0), 0.,
+                  .5 * (
+                      getattr(v, "M2{}_HadWH".format(SMBSM)) / WHdenominator
+                     +
+                      getattr(v, "M2{}_HadZH".format(SMBSM)) / ZHdenominator
+                  )
+                )
+            if oldinterference:
+                @register("D_{}_HadVH".format(intname), JEC)
+                @dijet
+                def D_int_HadVH(c, v, BSM=BSM, SMBSM=SMBSM, gVH=gVH):
+                    return interference(
+                      v.M2g1_HadWH + v.M2g1_HadZH,
+                      getattr(v, "M2{}_HadWH".format(BSM)) + getattr(v, "M2{}_HadZH".format(BSM)),
+                      getattr(v, "M2{}_HadWH".format(SMBSM)) + getattr(v, "M2{}_HadZH".format(SMBSM)),
+                      getattr(c, gVH),
+                    )
+
+            #VBFdecay and HadVHdecay
+            @register("D_{}_VBFdecay".format(purename), JEC)
+            @dijet
+            def D_pure_VBFdecay(c, v, BSM=BSM, gdecay=gdecay, gVBF=gVBF):
+                return divide(
+                  v.M2g1_VBF*c.M2g1_decay,
+                  v.M2g1_VBF*c.M2g1_decay + getattr(v, "M2{}_VBF".format(BSM))*getattr(c, "M2{}_decay".format(BSM)) * (getattr(c, gVBF)*getattr(c, gdecay))**2
+                )
+            @register("D_{}_HadVHdecay".format(purename), JEC)
+            @dijet
+            def D_pure_HadVHdecay(c, v, BSM=BSM, gdecay=gdecay, gVH=gVH):
+                return divide(
+                  (v.M2g1_HadWH + v.M2g1_HadZH)*c.M2g1_decay,
+                  (v.M2g1_HadWH + v.M2g1_HadZH)*c.M2g1_decay
+                  + (getattr(v, "M2{}_HadWH".format(BSM)) + getattr(v, "M2{}_HadZH".format(BSM)))*getattr(c, gVH)**2
+                       *getattr(c, "M2{}_decay".format(BSM))*getattr(c, gdecay)**2
+                )
+
+def registerL1L1Zg():
+    @register("D_L1L1Zg_decay")
+    def D_L1L1Zg_decay(c, v):
+        return divide(
+          c.M2g1prime2_decay*c.g1prime2HZZ_m4l**2,
+          c.M2g1prime2_decay*c.g1prime2HZZ_m4l**2 + c.M2ghzgs1prime2_decay*c.ghzgs1prime2HZZ_m4l**2
+        )
+    @register("D_L1L1Zgint_decay")
+    def D_L1L1Zgint_decay(c, v):
+        return divide(
+          c.M2g1prime2ghzgs1prime2_decay*c.g1prime2HZZ_m4l*c.ghzgs1prime2HZZ_m4l,
+          c.M2g1prime2_decay*c.g1prime2HZZ_m4l**2 + c.M2ghzgs1prime2_decay*c.ghzgs1prime2HZZ_m4l**2
+        )
+    @register("D_L1L1Zgint_decay_new")
+    def D_L1L1Zgint_decay_new(c, v):
+        return divide(
+          c.M2g1prime2ghzgs1prime2_decay*c.g1prime2HZZ_m4l*c.ghzgs1prime2HZZ_m4l,
+          2 * numpy.sqrt(c.M2g1prime2_decay*c.g1prime2HZZ_m4l**2 * c.M2ghzgs1prime2_decay*c.ghzgs1prime2HZZ_m4l**2)
+        )
+
+def D_4couplings_general_raw(c, *variables_and_bins):
+    result = numpy.zeros(len(c), dtype=int)
+    for variablename, binning in variables_and_bins:
+        result *= len(binning)+1
+        variable = c.evaluate(variablename)
+        for bin in binning:
+            result += variable > bin
+    return result
+
+def D_4couplings_general(c, variables_and_bins, foldbins):
+    result = D_4couplings_general_raw(c, *variables_and_bins)
+    result = numpy.where(numpy.in1d(result, foldbins), product(len(bins)+1 for variable, bins in variables_and_bins), result)
+    for foldbin in foldbins:
+        result = numpy.where(result > foldbin, result-1, result)
+    return result
+
+def register4couplings():
+    register("D_4couplings_decay_raw")(lambda c, v: D_4couplings_general_raw(c, *TreeWrapper.binning_4couplings_decay))
+    register("D_4couplings_photons_decay_raw")(lambda c, v: D_4couplings_general_raw(c, *TreeWrapper.binning_4couplings_photons_decay))
+    register("D_4couplings_decay")(lambda c, v: D_4couplings_general(c, TreeWrapper.binning_4couplings_decay, TreeWrapper.foldbins_4couplings_decay))
+
+    for JEC in JECsuffixes:
+        for name in "VBFdecay", "HadVHdecay", "photons_VBF", "photons_VBFdecay", "photons_HadVH", "photons_HadVHdecay":
+            binning = getattr(TreeWrapper, "binning_4couplings_{}{}".format(name, JEC))
+            register("D_4couplings_{}_raw".format(name), JEC)(dijet(lambda c, v, binning=binning: D_4couplings_general_raw(c, *binning)))
+            if not name.startswith("photons"):
+                foldbins = getattr(TreeWrapper, "foldbins_4couplings_{}".format(name))
+                register("D_4couplings_{}".format(name), JEC)(dijet(lambda c, v, binning=binning, foldbins=foldbins: D_4couplings_general(c, binning, foldbins)))
+
+#vector branches with one entry per lepton
+leptonbranches = "LepLepId", "LepPt", "LepEta"
+
+def leptonarray(values):
+    """
+    (4, ncandidates) array from a vector branch, so that [i] gives lepton i for all candidates,
+    the same way it does for one candidate in TreeWrapper
+    """
+    return numpy.array([list(_) for _ in values]).reshape(len(values), 4).T
+
+class ChunkBranches(object):
+    """
+    Branches of the chunk as attributes, like TreeWrapper.tree
+    """
+    def __init__(self, chunk):
+        self.__chunk = chunk
+    def __getattr__(self, branchname):
+        return self.__chunk.branch(branchname)
+
+class WeightView(object):
+    """
+    The TreeWrapperBase weight functions only do arithmetic on the per-event quantities,
+    so they also work on arrays.  This gives them the attributes they need.
+    """
+    def __init__(self, chunk):
+        treewrapper = chunk.treewrapper
+        for attr in "productionmode", "GEN", "doL1prefiringweight", "doleptonSF", "useNNLOPSweight", "isggZZoffshell", "genxsec", "genBR", "nevents", "year":
+            setattr(self, attr, getattr(treewrapper, attr))
+        if treewrapper.isdata or treewrapper.isZX:
+            #TreeWrapper.next() sets it to 1 for all the events that pass
+            self.overallEventWeight = 1
+        else:
+            self.overallEventWeight = chunk.overallEventWeight
+        if treewrapper.isZX:
+            self.usenewobjects = treewrapper.usenewobjects
+            self.tree = ChunkBranches(chunk)
+        for kfactor in treewrapper.kfactors:
+            if kfactor in leptonbranches:
+                setattr(self, kfactor, leptonarray(chunk.branch(kfactor)))
+            else:
+                setattr(self, kfactor, chunk.branch(kfactor))
+    per_event_scale_factor = TreeWrapperBase.per_event_scale_factor.im_func
+    MC_weight_nominal = TreeWrapperBase.MC_weight_nominal.im_func
+
+def registerweights():
+    #for data, MC_weight_nominal is just 1
+    register("MC_weight_nominal")(lambda c, v: WeightView(c).MC_weight_nominal() * numpy.ones(len(c)))
+    for name in "p_Gen_ttH_SIG_kappa_1_JHUGen", "p_Gen_ttH_SIG_kappa_tilde_1_JHUGen", "p_Gen_ttH_SIG_kappa_1_kappa_tilde_1_JHUGen":
+        #these only depend on the sample
+        register(name)(lambda c, v, name=name: numpy.full(len(c), getattr(c.treewrapper, name)(), dtype=float))
+
+def registercategories():
+    for categorization in TreeWrapper.categorizations:
+        register(categorization.category_function_name)(lambda c, v, categorization=categorization: c.categories[categorization])
+
+def registerSTXS():
+    for JEC, JECbranch in JECsuffixes.iteritems():
+        register("D_STXS_stage1p1", JEC)(lambda c, v, JEC=JECSystematic(JECbranch): c.categories.STXSstage1p1(JEC, BTagSystematic("Nominal")))
+    for btag in "Up", "Dn":
+        register("D_STXS_stage1p1_bTagSF"+btag)(lambda c, v, btag=BTagSystematic(btag): c.categories.STXSstage1p1(JECSystematic("Nominal"), btag))
+
+registerbkg()
+registerjetdiscriminants()
+registeranomalouscouplings()
+registerL1L1Zg()
+register4couplings()
+registerweights()
+registercategories()
+registerSTXS()
+
+def supportscolumnar(treewrapper, name):
+    return name in discriminantfunctions
+
+class ColumnarTreeWrapper(object):
+    """
+    Wraps a TreeWrapper and calculates its discriminants one chunk at a time.
+    """
+    def __init__(self, treewrapper, chunksize=defaultchunksize):
+        if not isinstance(treewrapper, TreeWrapper):
+            raise TypeError("The columnar engine only works for TreeWrapper, not {}".format(type(treewrapper).__name__))
+        self.treewrapper = treewrapper
+        self.chunksize = chunksize
+        alldiscriminants = treewrapper.toaddtotree + treewrapper.toaddtotree_int + treewrapper.toaddtotree_float
+        self.columnar = [_ for _ in alldiscriminants if supportscolumnar(treewrapper, _)]
+        self.legacy = [_ for _ in alldiscriminants if not supportscolumnar(treewrapper, _)]
+
+        if not treewrapper.isdummy:
+            #separate TFile, so that reading with root_numpy doesn't interfere with treewrapper.tree
+            self.f = ROOT.TFile.Open(treewrapper.tree.GetCurrentFile().GetName())
+            self.tree = self.f.Get("{}/candTree".format(treewrapper.treesample.TDirectoryname()))
+
+    def chunks(self):
+        treewrapper = self.treewrapper
+        first, last = treewrapper.minevent, treewrapper.minevent + treewrapper.nentries
+        selected = numpy.array(treewrapper.selectedentries(), dtype=numpy.int64)
+        for start in xrange(first, last, self.chunksize):
+            stop = min(start+self.chunksize, last)
+            reader = ChunkReader(self.tree, start, stop)
+            chunk = ColumnarChunk(treewrapper, reader, selectentries(selected, reader))
+            if treewrapper.isdata and not treewrapper.unblind:
+                chunk = ColumnarChunk(treewrapper, reader, chunk.entries[config.blindcut(chunk)])
+            print stop - first, "/", treewrapper.nentries
+            yield chunk
+
+    def iterfill(self, discriminants):
+        """
+        discriminants is a dict of name: buffer, like the one in adddiscriminants.
+        For each selected event, this loads the entry in treewrapper.tree, sets the buffers,
+        and yields the entry number, so that the caller can fill its tree.
+        All the discriminants have to be columnar.
+        """
+        treewrapper = self.treewrapper
+        legacy = [_ for _ in self.legacy if _ in discriminants]
+        if legacy:
+            raise ValueError("These outputs aren't implemented in the columnar engine, use the legacy one:\n" + "\n".join("  "+_ for _ in legacy))
+        columnar = [_ for _ in self.columnar if _ in discriminants]
+
+        for chunk in self.chunks():
+            values = [(discriminants[name], chunk.evaluate(name).tolist()) for name in columnar]
+            for i, entry in enumerate(chunk.entries.tolist()):
+                treewrapper.tree.GetEntry(entry)
+                for buffer, value in values:
+                    buffer[0] = value[i]
+                yield entry
+
+def validatecolumnar(sample, nevents=1000, chunksize=defaultchunksize, rtol=1e-9, atol=1e-12):
+    """
+    Compare the columnar discriminants to the legacy ones for the first nevents entries of the sample.
+    """
+    maxevent = nevents - 1
+    legacy = TreeWrapper(sample, maxevent=maxevent)
+    legacy.prunebranches()
+    columnar = ColumnarTreeWrapper(TreeWrapper(sample, maxevent=maxevent), chunksize=chunksize)
+    columnar.treewrapper.prunebranches()
+    discriminants = {name: [None] for name in columnar.columnar}
+
+    mismatches = Counter()
+    nchecked = 0
+    for entry, legacyentry in izip_longest(columnar.iterfill(discriminants), legacy):
+        if entry is None or legacyentry is None:
+            raise ValueError("{}: columnar and legacy select different numbers of events".format(sample))
+        if columnar.treewrapper.tree.ZZMass != legacy.ZZMass:
+            raise ValueError("{}: columnar and legacy are out of sync at entry {}".format(sample, entry))
+        nchecked += 1
+        for name, (value,) in discriminants.iteritems():
+            expected = getattr(legacy, name)()
+            if value == expected or numpy.isnan(value) and numpy.isnan(expected) or numpy.isclose(value, expected, rtol=rtol, atol=atol):
+                continue
+            if not mismatches[name]:
+                print "{}: {} = {} (columnar) vs. {} (legacy) at entry {}".format(sample, name, value, expected, entry)
+            mismatches[name] += 1
+
+    print "{}: checked {} discriminants for {} events".format(sample, len(discriminants), nchecked)
+    if columnar.legacy:
+        print "not implemented in the columnar engine:", ", ".join(columnar.legacy)
+    if mismatches:
+        raise ValueError("{}: columnar and legacy results are different for:\n".format(sample) + "\n".join("  {} ({} events)".format(name, n) for name, n in sorted(mismatches.iteritems())))
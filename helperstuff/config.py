@@ -102,6 +102,12 @@ minimainlegend = True
 LHEsmearptelectron = 2.399/6
 LHEsmearptmuon = 2.169/6
 LHEsmearptjet = 18./6
+#bytes, for the raw templates in histogramcache.py.  0 to turn it off
+rawtemplatecachemaxsize = 10*1024**3
+#for templatefiller.py: templates with weights that are linear combinations of the same terms are filled
+#together by the StreamingAccumulator if there are at least this many, reading this many events at a time
+streamingminimumtemplates = 10
+streamingbatchsize = 100000
 
 usedata = True
 showblinddistributions = True
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+"""
+Lookup tables for the constants that only depend on ZZMass (and the flavor):
+the c-constants from CJLSTscripts and the g-constants from gconstants.
+
+Each function is sampled once on a ZZMass grid and the table is stored as a .npz
+file in this folder.  The grid starts with a spacing of initialstep and is refined
+wherever linear interpolation misses the function at the midpoint of an interval
+by more than atol + rtol*|value|.  Lookups work for scalars and for numpy arrays.
+Outside [m4lmin, m4lmax], the original function is called.
+
+BinnedFunctionTable does the same for functions of (lepton ID, pt, eta) that
+are constant in bins, like the lepton scale factors and the Z+X fake rates.
+"""
+
+from itertools import izip
+import json
+import os
+import random
+
+import numpy
+
+from .. import CJLSTscripts
+from .. import config
+from ..gconstants.gconstantclass import GConstant, gconstants
+from ..utilities import cache, OneAtATime
+
+rtol = 1e-6
+atol = 1e-12
+m4lmin, m4lmax = 70., 3500.
+initialstep = 1.
+minstep = 1e-4
+
+#increment to remake all the tables
+version = 1
+
+tablefolder = os.path.dirname(os.path.abspath(__file__))
+
+class ConstantTable(object):
+    """
+    function(ZZMass), sampled on a grid of ZZMass.
+    key should change whenever the function does, so that the table gets remade.
+    """
+    def __init__(self, name, function, key):
+        self.name = name
+        self.function = function
+        self.key = json.dumps([version, key, m4lmin, m4lmax, initialstep, minstep, rtol, atol])
+        self.grid = self.values = None
+
+    @property
+    def filename(self):
+        return os.path.join(tablefolder, self.name+".npz")
+
+    def load(self):
+        with OneAtATime(self.filename+".tmp", 5, task="making the constant table for "+self.name):
+            try:
+                with open(self.filename, "rb") as f:
+                    npz = numpy.load(f)
+                    if npz["key"].item() != self.key: raise IOError
+                    grid, values = npz["grid"], npz["values"]
+            except (IOError, KeyError, ValueError):
+                grid, values = self.build()
+                tmpfilename = self.filename.replace(".npz", "_tmp.npz")
+                numpy.savez(tmpfilename, key=self.key, grid=grid, values=values)
+                os.rename(tmpfilename, self.filename)
+        self.grid, self.values = grid, values
+
+    def build(self):
+        print "making the constant table for", self.name
+        initialgrid = numpy.linspace(m4lmin, m4lmax, int(round((m4lmax-m4lmin) / initialstep)) + 1).tolist()
+        points = {m4l: self.function(m4l) for m4l in initialgrid}
+        intervals = zip(initialgrid[:-1], initialgrid[1:])
+        bad = []
+        while intervals:
+            newintervals = []
+            for low, high in intervals:
+                middle = (low + high) / 2
+                value = self.function(middle)
+                if abs((points[low] + points[high]) / 2 - value) <= atol + rtol*abs(value):
+                    continue
+                if high - low < 2*minstep:
+                    bad.append(middle)
+                    continue
+                points[middle] = value
+                newintervals += [(low, middle), (middle, high)]
+            intervals = newintervals
+
+        if bad:
+            print "Warning: the constant table for {} is not within the tolerance near ZZMass = {}".format(self.name, ", ".join("{:.4f}".format(_) for _ in bad[:10]))
+
+        grid = numpy.array(sorted(points), dtype=float)
+        values = numpy.array([points[m4l] for m4l in grid.tolist()], dtype=float)
+        print "  {} points".format(len(grid))
+        return grid, values
+
+    def __call__(self, ZZMass):
+        if self.grid is None: self.load()
+        if isinstance(ZZMass, numpy.ndarray):
+            result = numpy.interp(ZZMass, self.grid, self.values)
+            outside = (ZZMass < m4lmin) | (ZZMass > m4lmax)
+            if outside.any():
+                result[outside] = [self.function(_) for _ in ZZMass[outside].tolist()]
+            return result
+        if not m4lmin <= ZZMass <= m4lmax:
+            return self.function(ZZMass)
+        return float(numpy.interp(ZZMass, self.grid, self.values))
+
+class FlavorConstantTable(object):
+    """
+    function(flavor, ZZMass), with one ConstantTable for each flavor.
+    flavor is abs(Z1Flav*Z2Flav).
+    """
+    flavors = 121, 169, 143
+
+    def __init__(self, name, function, key):
+        self.function = function
+        self.tables = {
+            flavor: ConstantTable("{}_{}".format(name, flavor), lambda ZZMass, flavor=flavor: function(flavor, ZZMass), key)
+                for flavor in self.flavors
+        }
+
+    def __call__(self, flavor, ZZMass):
+        if isinstance(ZZMass, numpy.ndarray):
+            result = numpy.empty(ZZMass.shape)
+            for f in numpy.unique(flavor).tolist():
+                mask = flavor == f
+                if f in self.tables:
+                    result[mask] = self.tables[f](ZZMass[mask])
+                else:
+                    result[mask] = [self.function(f, _) for _ in ZZMass[mask].tolist()]
+            return result
+        if flavor not in self.tables:
+            return self.function(flavor, ZZMass)
+        return self.tables[flavor](ZZMass)
+
+class FixedConstant(object):
+    """
+    For the g-constants that don't depend on ZZMass.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, ZZMass):
+        if isinstance(ZZMass, numpy.ndarray):
+            return numpy.full(ZZMass.shape, self.value, dtype=float)
+        return self.value
+
+class BinnedFunctionTable(object):
+    """
+    function(ID, pt, eta) for a function that is constant in each (pt, eta) cell,
+    e.g. a histogram lookup.  The edges have to include every place where the function jumps.
+    The function is evaluated once in each cell for each ID, and the table is then compared
+    to the function at random points and at the edges.  If they disagree anywhere, the table
+    is not used and every lookup calls the function.
+    """
+    def __init__(self, name, function, IDs, ptedges, etaedges, ncheck=1000):
+        self.name = name
+        self.function = function
+        self.ptedges = numpy.array(sorted(set(ptedges)), dtype=float)
+        self.etaedges = numpy.array(sorted(set(etaedges)), dtype=float)
+        ptcenters, etacenters = self.centers(self.ptedges), self.centers(self.etaedges)
+        self.values = {
+            ID: numpy.array([[function(ID, pt, eta) for eta in etacenters] for pt in ptcenters], dtype=float)
+                for ID in IDs
+        }
+        self.check(ncheck)
+
+    @staticmethod
+    def centers(edges):
+        edges = edges.tolist()
+        return [edges[0] - 1] + [(low + high) / 2 for low, high in izip(edges[:-1], edges[1:])] + [edges[-1] + 1]
+
+    def check(self, ncheck):
+        r = random.Random(0)
+        ptmax, etamax = 1.2 * numpy.max(numpy.abs(self.ptedges)), 1.2 * numpy.max(numpy.abs(self.etaedges))
+        points = [(r.uniform(0, ptmax), r.uniform(-etamax, etamax)) for i in xrange(ncheck)]
+        points += [(pt, r.uniform(-etamax, etamax)) for pt in self.ptedges.tolist()]
+        points += [(r.uniform(0, ptmax), eta) for eta in self.etaedges.tolist()]
+        for ID in self.values:
+            for pt, eta in points:
+                if self(ID, pt, eta) != self.function(ID, pt, eta):
+                    print "Warning: the table for {} doesn't agree with the function for ID={} pt={} eta={}.  Not using it.".format(self.name, ID, pt, eta)
+                    self.values = {}
+                    return
+
+    def __call__(self, ID, pt, eta):
+        if isinstance(pt, numpy.ndarray):
+            ipt = numpy.searchsorted(self.ptedges, pt, side="right")
+            ieta = numpy.searchsorted(self.etaedges, eta, side="right")
+            result = numpy.empty(pt.shape)
+            for i in numpy.unique(ID).tolist():
+                mask = ID == i
+                if i in self.values:
+                    result[mask] = self.values[i][ipt[mask], ieta[mask]]
+                else:
+                    result[mask] = [self.function(i, p, e) for p, e in izip(pt[mask].tolist(), eta[mask].tolist())]
+            return result
+        if ID not in self.values:
+            return self.function(ID, pt, eta)
+        return float(self.values[ID][numpy.searchsorted(self.ptedges, pt, side="right"), numpy.searchsorted(self.etaedges, eta, side="right")])
+
+cconstantkey = [CJLSTscripts.downloader.SHA1]
+shiftWPkey = cconstantkey + [config.useQGTagging, 0.5]
+
+cconstantforDbkgkin = FlavorConstantTable("cconstantforDbkgkin", CJLSTscripts.getDbkgkinConstant, cconstantkey)
+cconstantforDbkg = FlavorConstantTable("cconstantforDbkg", CJLSTscripts.getDbkgConstant, cconstantkey)
+cconstantforD2jet = ConstantTable("cconstantforD2jet", lambda ZZMass: CJLSTscripts.getDVBF2jetsConstant_shiftWP(ZZMass, config.useQGTagging, 0.5), shiftWPkey)
+cconstantforDHadWH = ConstantTable("cconstantforDHadWH", lambda ZZMass: CJLSTscripts.getDWHhConstant_shiftWP(ZZMass, config.useQGTagging, 0.5), shiftWPkey)
+cconstantforDHadZH = ConstantTable("cconstantforDHadZH", lambda ZZMass: CJLSTscripts.getDZHhConstant_shiftWP(ZZMass, config.useQGTagging, 0.5), shiftWPkey)
+
+@cache
+def gconstanttable(process, coupling):
+    gconstant = GConstant(process, coupling)
+    if gconstant.filename is None:
+        return FixedConstant(gconstant.getvalue(None))
+    return ConstantTable("gconstant_{}_{}".format(gconstant.process, gconstant.hypothesis), gconstant.getvalue, [GConstant.commit, gconstant.filename, gconstant.splinename])
+
+def gconstant(process, coupling, m4l):
+    """
+    Same as gconstants.gconstant, but m4l can also be an array.
+    """
+    return gconstanttable(process, coupling)(m4l)
+
+def validate(ntest=10000):
+    """
+    Compare the tables to the original functions at random values of ZZMass.
+    """
+    tables = [cconstantforD2jet, cconstantforDHadWH, cconstantforDHadZH]
+    for flavortable in cconstantforDbkgkin, cconstantforDbkg:
+        tables += flavortable.tables.values()
+    for _ in gconstants():
+        table = gconstanttable(str(_.process), str(_.hypothesis))
+        if isinstance(table, ConstantTable): tables.append(table)
+
+    result = True
+    for table in tables:
+        ZZMass = numpy.array([random.uniform(m4lmin, m4lmax) for i in xrange(ntest)])
+        exact = numpy.array([table.function(_) for _ in ZZMass.tolist()])
+        deviation = numpy.abs(table(ZZMass) - exact)
+        relative = numpy.max(deviation / numpy.maximum(numpy.abs(exact), atol))
+        ok = numpy.all(deviation <= atol + rtol*numpy.abs(exact))
+        print "{:40} max relative deviation {:.2g}{}".format(table.name, relative, "" if ok else "  <-- outside the tolerance")
+        result = result and ok
+    return result
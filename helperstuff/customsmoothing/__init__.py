@@ -29,7 +29,10 @@ def callfunction(hsmooth, rawprojections, **kwargs):
     else:
         if kwargs: raise ValueError("No function name given! {}".format(kwargs))
         name = "donothing"
-    return functions[name](hsmooth, rawprojections, **kwargs)
+    result = functions[name](hsmooth, rawprojections, **kwargs)
+    #the functions change the contents through numpy views, so the statistics have to be redone
+    hsmooth.ResetStats()
+    return result
 
 def customsmoothing(hsmooth, rawprojections, templatedirectory, controlplotsdirectory, **kwargs):
     makenewcontrolplots = callfunction(hsmooth, rawprojections, **kwargs)
@@ -0,0 +1,52 @@
+"""
+NumPy views of the contents and sum of squared weights of a histogram, without copying them.
+Writing to the views changes the histogram.
+
+The arrays are indexed [x, y, z] like GetBinContent, including the underflow and overflow,
+so bin 1 is index 1 and the bins in range are [1:-1].
+"""
+
+import numpy
+
+def dtype(h):
+    for arrayclass, result in ("TArrayD", numpy.float64), ("TArrayF", numpy.float32), ("TArrayI", numpy.int32), ("TArrayS", numpy.int16), ("TArrayC", numpy.int8):
+        if h.InheritsFrom(arrayclass):
+            return result
+    raise TypeError("Don't know the array type of {}".format(type(h).__name__))
+
+def view(buffer, dtype, h):
+    size = h.GetSize()
+    buffer.SetSize(size)
+    result = numpy.frombuffer(buffer, dtype=dtype, count=size)
+    #global bin = x + (nx+2) * (y + (ny+2) * z)
+    shape = [h.GetNbinsZ()+2, h.GetNbinsY()+2, h.GetNbinsX()+2][3-h.GetDimension():]
+    return result.reshape(shape).T
+
+def contents(h):
+    return view(h.GetArray(), dtype(h), h)
+
+def sumw2(h):
+    """
+    The squared errors.  If the histogram doesn't have them yet, they're made from the contents.
+    """
+    if not h.GetSumw2N(): h.Sumw2()
+    return view(h.GetSumw2().GetArray(), numpy.float64, h)
+
+def inrange(array):
+    return array[(slice(1, -1),) * array.ndim]
+
+def integral(array):
+    """same as Integral() with no arguments"""
+    return float(inrange(array).sum())
+
+def projection(array, axis):
+    """
+    Contents of Projection(axis), including the underflow and overflow of the other axes
+    """
+    return array.sum(axis=tuple(_ for _ in xrange(array.ndim) if _ != axis))
+
+def slices(array, axis):
+    """
+    View with the bins in range of the other axes and all the bins of axis, which is moved to the end
+    """
+    return numpy.moveaxis(array, axis, -1)[(slice(1, -1),) * (array.ndim-1)]
@@ -1,4 +1,4 @@
-import ROOT
+from histogramarrays import contents, inrange
 
 def redointerference(hsmooth, rawprojections, templatesandfactors, mirrorjsn, newf):
     hsmooth.Reset("M")
@@ -26,13 +26,7 @@ def redointerference(hsmooth, rawprojections, templatesandfactors, mirrorjsn, ne
             if antisymmetric: sign = -1
             else: sign = 1
 
-            tmp = hsmooth.Clone("tmp"+hsmooth.GetName())
-            for binx in range(1, tmp.GetNbinsX()+1):
-                for biny in range(1, tmp.GetNbinsY()+1):
-                    for binz in range(1, tmp.GetNbinsZ()+1):
-                        hsmooth.SetBinContent(binx, biny, binz,
-                                              tmp.GetBinContent(binx, biny, binz)
-                                                + sign*tmp.GetBinContent(binx, tmp.GetNbinsY()-biny+1, binz)
-                                             )
+            content = inrange(contents(hsmooth))
+            content[...] = content + sign*content[:, ::-1, :]
 
     return True #do make new control plots
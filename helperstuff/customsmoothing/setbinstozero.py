@@ -1,11 +1,10 @@
-import ROOT
+import numpy
 
-def SetBinContent(hist3d, binx, biny, binz, content):
-    #wrapper to allow kwargs
-    return hist3d.SetBinContent(binx, biny, binz, content)
+from histogramarrays import contents, integral
 
 def setbinstozero(hsmooth, rawprojections, axes, nbinsonleft, nbinsonright):
-    integral = hsmooth.Integral()
+    content = contents(hsmooth)
+    originalintegral = integral(content)
     nbinsonleft = {int(k): v for k, v in nbinsonleft.iteritems()}
     nbinsonright = {int(k): v for k, v in nbinsonright.iteritems()}
     for axis in (nbinsonleft.keys()+nbinsonright.keys()):
@@ -19,17 +18,10 @@ def setbinstozero(hsmooth, rawprojections, axes, nbinsonleft, nbinsonright):
         nright = nbinsonright.get(axis, 0)
         binsto0 = [1+_ for _ in range(nleft)] + [nbins-_ for _ in range(nright)]
 
-        thisaxis = "xyz"[axis]
-        otheraxes = [axisname for axisname in "xyz" if axisname != thisaxis]
-        assert len(otheraxes) == 2
+        index = [slice(1, -1)] * content.ndim
+        index[axis] = binsto0
+        content[tuple(index)] = 0
 
-        kwargs = {"binx": None, "biny": None, "binz": None, "content": 0}
-
-        for kwargs["bin"+otheraxes[0]] in xrange(1, getattr(hsmooth, "GetNbins{}".format(otheraxes[0].upper()))()+1):
-            for kwargs["bin"+otheraxes[1]] in xrange(1, getattr(hsmooth, "GetNbins{}".format(otheraxes[1].upper()))()+1):
-                for kwargs["bin"+thisaxis] in binsto0:
-                    SetBinContent(hsmooth, **kwargs)
-
-    hsmooth.Scale(integral / hsmooth.Integral())
+    hsmooth.Scale(originalintegral / integral(content))
 
     return True #do make new control plots
@@ -1,12 +1,6 @@
-from itertools import product
-import ROOT
+import numpy
 
-def Integral(hist3d, binx1, binx2, biny1, biny2, binz1, binz2, option=""):
-    #wrapper to allow kwargs
-    return hist3d.Integral(binx1, binx2, biny1, biny2, binz1, binz2, option)
-def SetBinContent(hist3d, binx, biny, binz, content):
-    #wrapper to allow kwargs
-    return hist3d.SetBinContent(binx, biny, binz, content)
+from histogramarrays import contents, inrange, integral, sumw2
 
 def useDbkgorthogonal(hsmooth, rawprojections):
     """
@@ -14,22 +8,18 @@ def useDbkgorthogonal(hsmooth, rawprojections):
     For each xy bin that has a z bin with zero content,
     keep the integral over z, but copy the shape from the overall z shape
     """
-    totalintegral = hsmooth.Integral()
+    content = inrange(contents(hsmooth))
+    totalintegral = content.sum()
     if not totalintegral:
-        assert hsmooth.GetMaximum() == hsmooth.GetMinimum() == 0
+        assert content.max() == content.min() == 0
         return True
-    zprojection = rawprojections[2]
-    for xbin, ybin in product(xrange(1, hsmooth.GetNbinsX()+1), xrange(1, hsmooth.GetNbinsY()+1)):
-        for zbin in xrange(1, hsmooth.GetNbinsZ()+1):
-            if hsmooth.GetBinContent(xbin, ybin, zbin) == 0:
-                break  #process this slice
-        else:
-            continue   #don't process this slice
+    zprojection = inrange(contents(rawprojections[2]))
 
-        sliceintegral = Integral(hsmooth, xbin, xbin, ybin, ybin, 1, hsmooth.GetNbinsZ())
-        for zbin in xrange(1, hsmooth.GetNbinsZ()+1):
-            bincontent = zprojection.GetBinContent(zbin) * sliceintegral / totalintegral
-            hsmooth.SetBinContent(xbin, ybin, zbin, bincontent)
-            hsmooth.SetBinError(xbin, ybin, zbin, bincontent)
+    process = numpy.any(content == 0, axis=2)
+    sliceintegral = content.sum(axis=2)
+    newcontent = zprojection[numpy.newaxis, numpy.newaxis, :] * (sliceintegral / totalintegral)[:, :, numpy.newaxis]
+
+    content[process] = newcontent[process]
+    inrange(sumw2(hsmooth))[process] = newcontent[process]**2
 
     return True #do make new control plots
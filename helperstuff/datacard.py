@@ -14,6 +14,7 @@ from collections import Counter
 from itertools import chain, izip, product
 from math import pi
 
+import numpy
 import ROOT
 
 from rootoverloads import histogramfloor
@@ -22,6 +23,7 @@ import config
 import utilities
 
 from combinehelpers import discriminants, getdatatree, gettemplate, getnobserved, getrate, Luminosity, mixturesign, sigmaioversigma1, zerotemplate
+from customsmoothing.histogramarrays import contents, inrange, sumw2
 from enums import Analysis, categories, Category, Channel, channels, EnumItem, Hypothesis, MultiEnum, MyEnum, Production, ProductionMode, ShapeSystematic, SystematicDirection, WorkspaceShapeSystematic
 from samples import ReweightingSample
 from templates import TemplatesFile
@@ -30,6 +32,20 @@ from yields import YieldSystematic, YieldSystematicValue
 
 names = set()
 
+@cache
+def unrolledmirrorbins(nbinsx, ycenters, nbinsz):
+    """
+    For the bins of a 3D histogram unrolled like in makehistograms (z fastest, then y, then x), starting from 0:
+    whether the bin has y center >= 0, and the bin with the same x and z and the opposite y center
+    """
+    ybin = {ycenter: i for i, ycenter in enumerate(ycenters)}
+    othery = numpy.array([ybin[-ycenter] if ycenter >= 0 else -1 for ycenter in ycenters])
+    nbinsy = len(ycenters)
+    x, y, z = numpy.indices((nbinsx, nbinsy, nbinsz))
+    positive = (numpy.array(ycenters)[y] >= 0).ravel()
+    otherbin = (x*nbinsy*nbinsz + othery[y]*nbinsz + z).ravel()
+    return positive, otherbin
+
 def makename(name):
     if not isinstance(name, basestring): raise ValueError("I think you are confused, '{!r}' is not a string!".format(name))
     if name in names: raise ValueError("Name '{}' is already taken!".format(name))
@@ -530,15 +546,11 @@ class _Datacard(MultiEnum):
 
                 t = getattr(ROOT, type(t3D).__name__.replace("3", "1"))(name, name, nbinsxyz, 0, nbinsxyz)
 
-                binindices = {}
-
-                xyz = 1
-                for x, y, z in product(xrange(1, nbinsx+1), xrange(1, nbinsy+1), xrange(1, nbinsz+1)):
-                    binindices[t3D.GetXaxis().GetBinCenter(x), t3D.GetYaxis().GetBinCenter(y), t3D.GetZaxis().GetBinCenter(z)] = xyz
-                    binindices[xyz] = t3D.GetXaxis().GetBinCenter(x), t3D.GetYaxis().GetBinCenter(y), t3D.GetZaxis().GetBinCenter(z)
-                    t.SetBinContent(xyz, t3D.GetBinContent(x, y, z))
-                    t.SetBinError(xyz, t3D.GetBinError(x, y, z))
-                    xyz += 1
+                #the contents are indexed [x, y, z], so this puts z fastest, then y, then x
+                inrange(contents(t))[...] = inrange(contents(t3D)).ravel()
+                inrange(sumw2(t))[...] = inrange(sumw2(t3D)).ravel()
+                t.ResetStats()
+                t.SetEntries(nbinsxyz)
 
                 t3D.SetDirectory(f)
                 assert t3D.GetName() not in cache, t3D.GetName()
@@ -551,30 +563,35 @@ class _Datacard(MultiEnum):
                 if systematic is None or systematic == "shift_pm4l": self.histogramintegrals[name] = t.Integral()
 
                 if systematic is None and config.usebinbybin and p != "data" and p.isbkg:
+                    if t.GetNbinsX() > config.staticmaxbins:
+                        raise ValueError("config.staticmaxbins is not big enough.  If you want to use bin by bin uncertainties, increase it.")
+                    if domirror:
+                        positive, otherbin = unrolledmirrorbins(nbinsx, tuple(t3D.GetYaxis().GetBinCenter(y) for y in xrange(1, nbinsy+1)), nbinsz)
+
+                    #everything is made from these, including the underflow and overflow
+                    basecontent = numpy.array(contents(t), dtype=numpy.float64)
+                    basesumw2 = numpy.array(sumw2(t))
+                    error = numpy.sqrt(basesumw2)
+                    upcontent = basecontent + error
+                    dncontent = numpy.maximum(basecontent - error, basecontent/2)
+
                     for i in xrange(1, t.GetNbinsX()+1):
-                        if i > config.staticmaxbins:
-                            raise ValueError("config.staticmaxbins is not big enough.  If you want to use bin by bin uncertainties, increase it.")
-                        xcenter, ycenter, zcenter = binindices[i]
                         systname = "binbybin_{self.category}_{self.channel}_background_{}".format(i, self=self)
                         newname = name + "_" + systname
+                        changebins = [i]
                         if domirror:
-                            if ycenter<0: continue
-                            otheri = binindices[xcenter, -ycenter, zcenter]
-
-                        up = t.Clone(newname+"Up")
-                        dn = t.Clone(newname+"Down")
-
-                        up.SetBinContent(i, t.GetBinContent(i) + t.GetBinError(i))
-                        dn.SetBinContent(i, max(t.GetBinContent(i) - t.GetBinError(i), t.GetBinContent(i)/2))
-
-                        if domirror:
-                            up.SetBinContent(otheri, t.GetBinContent(otheri) + t.GetBinError(otheri))
-                            dn.SetBinContent(otheri, max(t.GetBinContent(otheri) - t.GetBinError(otheri), t.GetBinContent(otheri)/2))
-
-                        up.SetDirectory(f)
-                        cache[up.GetName()] = up
-                        dn.SetDirectory(f)
-                        cache[dn.GetName()] = dn
+                            if not positive[i-1]: continue
+                            changebins.append(otherbin[i-1]+1)
+
+                        for direction, newcontent in ("Up", upcontent), ("Down", dncontent):
+                            new = getattr(ROOT, type(t).__name__)(newname+direction, newname+direction, nbinsxyz, 0, nbinsxyz)
+                            contents(new)[...] = basecontent
+                            sumw2(new)[...] = basesumw2
+                            contents(new)[changebins] = newcontent[changebins]
+                            new.ResetStats()
+                            new.SetEntries(t.GetEntries())
+                            new.SetDirectory(f)
+                            cache[new.GetName()] = new
 
                         self.binbybinuncertainties.append(systname)
 
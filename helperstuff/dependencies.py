@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Keeps track of what each templates file in step7_templates was made from,
+so that only the ones whose inputs changed have to be remade.
+
+The record for a TemplatesFile has a hash of the json that getjson() makes, the size and
+modification time of each input tree in that json, and the smoothing parameters of its
+templates.  It's written next to the templates file, as .deps.json, when it's built.
+"""
+
+import hashlib
+import json
+import os
+
+from utilities import mkdir_p
+
+def jsonstring(templatesfile):
+    return json.dumps(templatesfile.getjson(), sort_keys=True, indent=4, separators=(',', ': '))
+
+def writejson(templatesfile, string=None):
+    if string is None: string = jsonstring(templatesfile)
+    filename = templatesfile.jsonfile()
+    mkdir_p(os.path.dirname(filename))
+    with open(filename, "w") as f:
+        f.write(string)
+
+def depsfile(templatesfile):
+    return templatesfile.templatesfile().replace(".root", ".deps.json")
+
+def fileinfo(filename):
+    """
+    [size, mtime], or None if the file doesn't exist
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+class Dependencies(object):
+    def __init__(self, templatesfile):
+        self.templatesfile = templatesfile
+        self.jsonstring = jsonstring(templatesfile)
+
+    @property
+    def jsonhash(self):
+        return hashlib.sha1(self.jsonstring).hexdigest()
+
+    @property
+    def inputs(self):
+        return sorted({filename for template in json.loads(self.jsonstring)["templates"] for filelist in template["files"] for filename in filelist})
+
+    @property
+    def smoothingparameters(self):
+        return [template.smoothingparameters for template in self.templatesfile.templates() if template.productionmode != "data"]
+
+    def current(self):
+        result = {
+            "jsonhash": self.jsonhash,
+            "inputs": {filename: fileinfo(filename) for filename in self.inputs},
+            "smoothingparameters": self.smoothingparameters,
+        }
+        #so that it compares equal to what's read back from the file
+        return json.loads(json.dumps(result))
+
+    def recorded(self):
+        try:
+            with open(depsfile(self.templatesfile)) as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def record(self):
+        with open(depsfile(self.templatesfile), "w") as f:
+            json.dump(self.current(), f, sort_keys=True, indent=4, separators=(',', ': '))
+
+    def changes(self):
+        """
+        Reasons why the templates file is out of date (empty if it's not),
+        or None if nothing was recorded for it
+        """
+        recorded = self.recorded()
+        if recorded is None: return None
+        current = self.current()
+        result = []
+        if current["jsonhash"] != recorded.get("jsonhash"):
+            result.append("json changed")
+        changedinputs = [filename for filename in sorted(set(current["inputs"]) | set(recorded.get("inputs", {})))
+                                    if current["inputs"].get(filename) != recorded.get("inputs", {}).get(filename)]
+        if changedinputs:
+            result.append("inputs changed: " + ", ".join(changedinputs))
+        if current["smoothingparameters"] != recorded.get("smoothingparameters"):
+            result.append("smoothing parameters changed")
+        return result
+
+def isbuilt(templatesfile):
+    return os.path.exists(templatesfile.templatesfile()) and os.path.exists(templatesfile.templatesfile().replace(".root", ".done"))
+
+class RebuildPlan(object):
+    """
+    What has to be remade for templatesfiles:
+      json: json files that don't exist or are different from what getjson makes now
+      templates: templates files that don't exist or whose inputs changed
+      untracked: templates files that exist but were made before anything was recorded for them.
+                 They're left alone; record() them if they're known to be up to date.
+    Each is a list of (templatesfile, reason).
+    """
+    def __init__(self, templatesfiles):
+        self.json = []
+        self.templates = []
+        self.untracked = []
+        self.dependencies = {}
+        for templatesfile in templatesfiles:
+            if templatesfile.copyfromothertemplatesfile is not None: continue
+            if "Ulascan" in str(templatesfile.production): continue
+            dependencies = self.dependencies[templatesfile] = Dependencies(templatesfile)
+
+            if not os.path.exists(templatesfile.jsonfile()):
+                self.json.append((templatesfile, "doesn't exist"))
+            else:
+                with open(templatesfile.jsonfile()) as f:
+                    if f.read() != dependencies.jsonstring:
+                        self.json.append((templatesfile, "changed"))
+
+            if not isbuilt(templatesfile):
+                self.templates.append((templatesfile, "doesn't exist"))
+                continue
+            changes = dependencies.changes()
+            if changes is None:
+                self.untracked.append((templatesfile, "nothing recorded"))
+            elif changes:
+                self.templates.append((templatesfile, "; ".join(changes)))
+
+    def __str__(self):
+        lines = []
+        for name, lst in ("json files to write", self.json), ("templates files to build", self.templates), ("untracked templates files", self.untracked):
+            lines.append("{} ({}):".format(name, len(lst)))
+            lines += ["    {}: {}".format(templatesfile, reason) for templatesfile, reason in lst]
+        return "\n".join(lines)
+
+    def execute(self):
+        """
+        Writes the json files and removes the templates files that are out of date,
+        so that step6 will make them again
+        """
+        for templatesfile, reason in self.json:
+            writejson(templatesfile, self.dependencies[templatesfile].jsonstring)
+        for templatesfile, reason in self.templates:
+            for filename in (
+                templatesfile.templatesfile(),
+                templatesfile.templatesfile(firststep=True),
+                templatesfile.templatesfile().replace(".root", ".done"),
+                depsfile(templatesfile),
+            ):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def recorduntracked(self):
+        for templatesfile, reason in self.untracked:
+            self.dependencies[templatesfile].record()
+        self.untracked = []
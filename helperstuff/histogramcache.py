@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+On disk cache of the raw templates that templatefiller fills, before the postprocessing.
+
+The key is a hash of everything in the template json that goes into filling it: the files,
+with their sizes and modification times, the tree, variables, weights, selection, and binning.
+The name and postprocessing aren't in it, so when only the scale factor, mirroring, or
+smoothing of a templates file change, it can be remade without reading the trees again.
+If an input tree is remade, the key changes and the old entry just isn't used anymore.
+
+Each entry is a root file in histogramcache/.  When they add up to more than maxsize bytes,
+the ones that were used least recently are removed.  Other jobs can remove entries
+at any time while pruning, so an entry that disappears is treated as a miss.
+
+  python histogramcache.py list
+  python histogramcache.py prune [maxsize]
+  python histogramcache.py clear
+"""
+
+import argparse
+import errno
+import hashlib
+import json
+import os
+
+import config
+from dependencies import fileinfo
+from utilities import mkdir_p, TFile
+
+cachefolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "histogramcache")
+
+def makekey(template):
+    weights = template.get("weight")
+    if weights is None or isinstance(weights, basestring):
+        weights = [weights] * len(template["files"])
+    stuff = {
+        "files": [[[filename, fileinfo(filename)] for filename in filelist] for filelist in template["files"]],
+        "tree": template["tree"],
+        "variables": template["variables"],
+        "weights": weights,
+        "selection": template["selection"],
+        "binning": template["binning"]["bins"],
+    }
+    return hashlib.sha1(json.dumps(stuff, sort_keys=True)).hexdigest()
+
+def ignoremissing(function, *args):
+    """
+    Calls function(*args), or returns None if it fails because the file doesn't exist
+    """
+    try:
+        return function(*args)
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            return None
+        raise
+
+class HistogramCache(object):
+    def __init__(self, folder=cachefolder, maxsize=None):
+        if maxsize is None: maxsize = config.rawtemplatecachemaxsize
+        self.folder = folder
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+
+    @property
+    def enabled(self):
+        return bool(self.maxsize)
+
+    def filename(self, key):
+        return os.path.join(self.folder, key+".root")
+
+    def get(self, template):
+        """
+        Returns the cached raw histogram for the template json, or None if it's not there
+        """
+        if not self.enabled: return None
+        filename = self.filename(makekey(template))
+        if not os.path.exists(filename):
+            self.misses += 1
+            return None
+        try:
+            with TFile(filename) as f:
+                h = f.Get("h").Clone()
+                h.SetDirectory(0)
+        except IOError:
+            #removed by another job since the check above
+            if os.path.exists(filename): raise
+            self.misses += 1
+            return None
+        ignoremissing(os.utime, filename, None)
+        self.hits += 1
+        return h
+
+    def set(self, template, h):
+        if not self.enabled: return
+        mkdir_p(self.folder)
+        filename = self.filename(makekey(template))
+        #other jobs can be reading it, so write it somewhere else and then move it
+        tmpfilename = "{}.{}.tmp.root".format(filename, os.getpid())
+        with TFile(tmpfilename, "recreate", deleteifbad=True) as f:
+            clone = h.Clone("h")
+            clone.SetDirectory(f)
+        os.rename(tmpfilename, filename)
+
+    def entries(self):
+        """
+        [(filename, size, last used)], least recently used first
+        """
+        if not os.path.exists(self.folder): return []
+        result = []
+        for basename in os.listdir(self.folder):
+            if not basename.endswith(".root") or basename.endswith(".tmp.root"): continue
+            filename = os.path.join(self.folder, basename)
+            stat = ignoremissing(os.stat, filename)
+            if stat is None: continue
+            result.append((filename, stat.st_size, stat.st_mtime))
+        return sorted(result, key=lambda entry: entry[2])
+
+    def prune(self, maxsize=None):
+        if maxsize is None: maxsize = self.maxsize
+        entries = self.entries()
+        size = sum(entrysize for filename, entrysize, lastused in entries)
+        for filename, entrysize, lastused in entries:
+            if size <= maxsize: break
+            ignoremissing(os.remove, filename)
+            size -= entrysize
+
+    def __str__(self):
+        entries = self.entries()
+        return "{} raw templates, {:.1f} MB, in {}".format(len(entries), sum(size for filename, size, lastused in entries) / 1024.**2, self.folder)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("action", choices=("list", "prune", "clear"))
+    p.add_argument("maxsize", nargs="?", type=int, help="for prune, in bytes (default config.rawtemplatecachemaxsize)")
+    args = p.parse_args()
+    cache = HistogramCache()
+    if args.action == "prune":
+        cache.prune(args.maxsize)
+    elif args.action == "clear":
+        cache.prune(0)
+    print cache
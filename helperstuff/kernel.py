@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+"""
+Generate one function that calculates all the discriminants for an event.
+
+step2 normally calls each discriminant method of the TreeWrapper separately with getattr.
+Many of them read the same attributes, and some of them call each other (e.g. D_bkg_VBFdecay
+and all its systematics call D_bkg_kin_VBFdecay).  The kernel instead
+ - reads each attribute that the discriminants use once, into a local variable
+ - inlines the body of each discriminant method, including the JEC/JES/JER/btag variants
+   that MakeSystematics makes with exec
+ - calculates each discriminant once, even if other discriminants use it
+ - writes out the categorization functions, with the couplings as constants,
+   and calculates each category probability once
+Methods that can't be inlined (loops, nested functions, name-mangled attributes, ...)
+are called the same way as before.
+
+The generated module is cached in the kernels folder, named by a hash of everything it's made from.
+"""
+
+import __future__
+from collections import OrderedDict
+from cStringIO import StringIO
+import hashlib
+import inspect
+import os
+import token
+import tokenize
+
+import categorization
+from CJLSTscripts import categoryAC19
+
+#increment when the generated code changes
+version = 1
+
+kernelfolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kernels")
+
+class CantInline(Exception): pass
+
+def getsource(function):
+    try:
+        #set by MakeSystematics
+        return function.source
+    except AttributeError:
+        pass
+    try:
+        return inspect.getsource(function)
+    except (IOError, TypeError):
+        raise CantInline("can't get the source")
+
+def codenames(code):
+    """
+    global and attribute names used in code, including nested code (lambdas, generator expressions)
+    """
+    result = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            result |= codenames(const)
+    return result
+
+class KernelFunction(object):
+    """
+    One discriminant, parsed so that its body can be written into the kernel.
+    """
+    def __init__(self, name, function, source):
+        self.name = name
+        self.function = function
+        self.source = source
+
+        code = function.func_code
+        if code.co_flags & __future__.division.compiler_flag:
+            raise CantInline("uses from __future__ import division")
+        if function.func_closure:
+            raise CantInline("has a closure")
+        self.globalnames = {_ for _ in codenames(code) if _ in function.func_globals}
+        self.localnames = set(code.co_varnames) - {"self"}
+
+        tokens = list(tokenize.generate_tokens(StringIO(source).readline))
+        i = 0
+        while not (tokens[i][0] == token.NAME and tokens[i][1] == "def"): i += 1
+        if [t[1] for t in tokens[i+2:i+6]] != ["(", "self", ")", ":"]:
+            raise CantInline("isn't defined as def {}(self):".format(name))
+        body = tokens[i+6:]
+
+        if body[0][0] == token.NEWLINE:
+            j = 1
+            while body[j][0] in (tokenize.NL, tokenize.COMMENT): j += 1
+            assert body[j][0] == token.INDENT, body[j]
+            self.indent = body[j][1]
+            depth = 0
+            for k in xrange(j, len(body)):
+                if body[k][0] == token.INDENT: depth += 1
+                elif body[k][0] == token.DEDENT:
+                    depth -= 1
+                    if depth == 0: break
+            self.body = body[j+1:k]
+        else:
+            #def name(self): return ...
+            self.indent = None
+            k = next(k for k, t in enumerate(body) if t[0] == token.NEWLINE)
+            self.body = body[:k+1]
+
+        self.attributes, self.calls = set(), set()
+        depth = 0
+        statementstart = True
+        for i, (toktype, tokstring) in enumerate(t[:2] for t in self.body):
+            if toktype == token.INDENT and not tokstring.startswith(self.indent):
+                raise CantInline("inconsistent indentation")
+            if toktype == token.NAME:
+                if tokstring in ("def", "class", "yield", "global", "exec", "super"):
+                    raise CantInline("uses "+tokstring)
+                if statementstart and tokstring in ("for", "while"):
+                    raise CantInline("has a loop")
+                if tokstring.startswith("self_") or tokstring.startswith("value_"):
+                    raise CantInline("uses a name that the kernel uses")
+                attribute = self.selfattribute(i)
+                if attribute is not None:
+                    if attribute.startswith("__") and not attribute.endswith("__"):
+                        raise CantInline("uses a name-mangled attribute")
+                    following = [t[1] for t in self.body[i+3:i+5]]
+                    if following and following[0] in ("=", "+=", "-=", "*=", "/=", "**=", "%=", "//=", "&=", "|=", "^=", "<<=", ">>="):
+                        raise CantInline("assigns to self."+attribute)
+                    if following == ["(", ")"]:
+                        self.calls.add(attribute)
+                    else:
+                        self.attributes.add(attribute)
+            if toktype == token.OP:
+                if tokstring in "([{": depth += 1
+                elif tokstring in ")]}": depth -= 1
+            statementstart = (
+                toktype in (token.NEWLINE, token.INDENT, token.DEDENT)
+                or toktype == token.OP and tokstring in (":", ";") and depth == 0
+                or statementstart and toktype in (tokenize.NL, tokenize.COMMENT)
+            )
+
+    def selfattribute(self, i):
+        """if self.body[i:i+3] is self.attribute, returns attribute"""
+        if [t[:2] for t in self.body[i:i+2]] == [(token.NAME, "self"), (token.OP, ".")] and (i == 0 or self.body[i-1][1] != "."):
+            return self.body[i+2][1]
+        return None
+
+    def tokens(self, baseindent, hoisted, computed):
+        """
+        The body as
+            while True:
+                ...
+        where each return sets value_name and breaks
+        """
+        result = [(token.NAME, "while"), (token.NAME, "True"), (token.OP, ":"), (token.NEWLINE, "\n"), (token.INDENT, baseindent+"    ")]
+        value = "value_"+self.name
+        depth = 0
+        statementstart = True
+        inreturn = False
+        skip = 0
+        for i, (toktype, tokstring) in enumerate(t[:2] for t in self.body):
+            if skip:
+                skip -= 1
+                continue
+
+            if inreturn and depth == 0 and (toktype in (token.NEWLINE, tokenize.COMMENT) or toktype == token.OP and tokstring == ";"):
+                result += [(token.OP, ";"), (token.NAME, "break")]
+                inreturn = False
+
+            attribute = self.selfattribute(i) if toktype == token.NAME else None
+            if attribute in computed and attribute in self.calls and [t[1] for t in self.body[i+3:i+5]] == ["(", ")"]:
+                result.append((token.NAME, "value_"+attribute))
+                skip = 4
+            elif attribute in hoisted:
+                result.append((token.NAME, "self_"+attribute))
+                skip = 2
+            elif toktype == token.NAME and tokstring == "return" and statementstart:
+                result += [(token.NAME, value), (token.OP, "=")]
+                nexttoken = self.body[i+1]
+                if nexttoken[0] in (token.NEWLINE, tokenize.COMMENT) or nexttoken[1] == ";":
+                    result.append((token.NAME, "None"))
+                inreturn = True
+            elif toktype == token.INDENT:
+                result.append((token.INDENT, baseindent+"    "+tokstring[len(self.indent):]))
+            else:
+                result.append((toktype, tokstring))
+
+            if toktype == token.OP:
+                if tokstring in "([{": depth += 1
+                elif tokstring in ")]}": depth -= 1
+            statementstart = (
+                toktype in (token.NEWLINE, token.INDENT, token.DEDENT)
+                or toktype == token.OP and tokstring in (":", ";") and depth == 0
+                or statementstart and toktype in (tokenize.NL, tokenize.COMMENT)
+            )
+
+        if result[-1][0] != token.NEWLINE:
+            result.append((token.NEWLINE, "\n"))
+        #in case it gets to the end without returning
+        result += [(token.NAME, value), (token.OP, "="), (token.NAME, "None"), (token.OP, ";"), (token.NAME, "break"), (token.NEWLINE, "\n"), (token.DEDENT, "")]
+        return result
+
+def linetokens(line):
+    return [t[:2] for t in tokenize.generate_tokens(StringIO(line).readline) if t[0] != token.ENDMARKER]
+
+class Kernel(object):
+    """
+    Calculates the discriminants in names for treewrapper's current event: kernel(treewrapper) returns
+    a tuple of the values.  This has to be created after the first event is loaded, because it
+    looks at which attributes the treewrapper has.
+    """
+    def __init__(self, treewrapper, names):
+        self.names = list(names)
+        cls = type(treewrapper)
+
+        self.namespace = {}
+        pseudofunctions = {}
+        categorizations = [_ for _ in getattr(cls, "categorizations", []) if isinstance(_, categorization.BaseSingleCategorization)]
+        for i, c in enumerate(categorizations):
+            arguments = []
+            for kind, argument in c.categoryAC19arguments():
+                if kind == "variable": arguments.append("self.{}".format(argument))
+                elif kind == "function": arguments.append("self.{}()".format(argument))
+                elif kind == "constant": arguments.append(repr(argument))
+                else: assert False, kind
+            pseudofunctions[c.category_function_name] = "def {}(self):\n    result = categorization_{}.lastvalue = categoryAC19({})\n    return result\n".format(c.category_function_name, i, ", ".join(arguments))
+            self.namespace["categorization_{}".format(i)] = c
+            for pname in c.pHJJ_function_name, c.pVBF_function_name, c.pZH_function_name, c.pWH_function_name:
+                pseudofunctions[pname] = "def {}(self):\n    return {}\n".format(pname, getattr(cls, pname).im_func.expression.replace("self_tree.", "self."))
+        pseudonamespace = {"categoryAC19": categoryAC19}
+        pseudonamespace.update(self.namespace)
+
+        def kernelfunction(name):
+            if name in treewrapper.__dict__:
+                raise CantInline("is an instance attribute")
+            if name in pseudofunctions:
+                source = pseudofunctions[name]
+                namespace = dict(pseudonamespace)
+                exec source in namespace
+                return KernelFunction(name, namespace[name], source)
+            method = getattr(cls, name)
+            if not inspect.ismethod(method):
+                raise CantInline("isn't a method")
+            return KernelFunction(name, method.im_func, getsource(method.im_func))
+
+        #figure out what to inline, in an order where everything is calculated before it's used
+        self.functions = OrderedDict()
+        self.fallback = {}
+        internal = set(pseudofunctions) - set(self.names)
+        def add(name):
+            if name in self.functions or name in self.fallback: return
+            try:
+                function = kernelfunction(name)
+            except CantInline as e:
+                self.fallback[name] = str(e)
+                self.functions[name] = None
+                return
+            for call in sorted(function.calls):
+                if call in self.names or call in internal:
+                    add(call)
+            self.functions[name] = function
+        for name in self.names:
+            add(name)
+
+        #all the inlined code shares one namespace, so check that the names don't conflict
+        localnames = set.union(set(), *(f.localnames for f in self.functions.itervalues() if f is not None))
+        for name, function in self.functions.items():
+            if function is None: continue
+            for globalname in function.globalnames:
+                if globalname in localnames or self.namespace.get(globalname, function.function.func_globals[globalname]) is not function.function.func_globals[globalname]:
+                    self.fallback[name] = "global name {} conflicts with another function".format(globalname)
+                    self.functions[name] = None
+                    break
+            else:
+                for globalname in function.globalnames:
+                    self.namespace[globalname] = function.function.func_globals[globalname]
+        #category probabilities are only needed if a category function that uses them was inlined
+        used = set.union(set(), *(f.calls for f in self.functions.itervalues() if f is not None))
+        for name in internal - used:
+            self.functions.pop(name, None)
+            self.fallback.pop(name, None)
+
+        #attributes to read once at the beginning
+        self.hoisted = set()
+        for function in self.functions.itervalues():
+            if function is None: continue
+            for attribute in function.attributes:
+                if attribute in treewrapper.__dict__:
+                    self.hoisted.add(attribute)
+                    continue
+                for klass in cls.__mro__:
+                    if attribute in klass.__dict__:
+                        if not hasattr(klass.__dict__[attribute], "__get__"):
+                            self.hoisted.add(attribute)
+                        break
+
+        self.hash = hashlib.sha1(repr([
+            version, self.names,
+            [(name, None if function is None else function.source) for name, function in self.functions.iteritems()],
+            sorted(self.hoisted),
+        ])).hexdigest()
+        self.filename = os.path.join(kernelfolder, "kernel_{}.py".format(self.hash))
+
+        try:
+            with open(self.filename) as f:
+                self.source = f.read()
+        except IOError:
+            self.source = self.generate()
+            tmpfilename = self.filename+".{}.tmp".format(os.getpid())
+            with open(tmpfilename, "w") as f:
+                f.write(self.source)
+            os.rename(tmpfilename, self.filename)
+
+        exec compile(self.source, self.filename, "exec", 0, True) in self.namespace
+        self.kernel = self.namespace["kernel"]
+
+    def generate(self):
+        tokens = linetokens("def kernel(self):\n")
+        tokens.append((token.INDENT, "    "))
+        for attribute in sorted(self.hoisted):
+            tokens += linetokens("self_{0} = self.{0}\n".format(attribute))
+        computed = set()
+        for name, function in self.functions.iteritems():
+            tokens.append((tokenize.COMMENT, "#"+name))
+            tokens.append((tokenize.NL, "\n"))
+            if function is None:
+                tokens += linetokens("value_{0} = self.{0}()\n".format(name))
+            else:
+                tokens += function.tokens("    ", self.hoisted, computed)
+            computed.add(name)
+        tokens += linetokens("return ({},)\n".format(", ".join("value_"+name for name in self.names)))
+        tokens.append((token.DEDENT, ""))
+
+        header = "#generated by helperstuff/kernel.py, do not edit\n#not inlined:\n" + "".join("#  {}: {}\n".format(name, reason) for name, reason in sorted(self.fallback.iteritems()))
+        return header + tokenize.untokenize(tokens)
+
+    def __call__(self, treewrapper):
+        return self.kernel(treewrapper)
+
+def validatekernel(sample, nevents=1000):
+    """
+    Compare the kernel to calling the methods one at a time for the first nevents entries of the sample.
+    """
+    from treewrapper import TreeWrapper
+    treewrapper = TreeWrapper(sample, maxevent=nevents-1)
+    treewrapper.prunebranches()
+    names = treewrapper.toaddtotree + treewrapper.toaddtotree_int + treewrapper.toaddtotree_float
+
+    kernel = None
+    mismatches = {}
+    nchecked = 0
+    for _ in treewrapper:
+        if kernel is None:
+            kernel = Kernel(treewrapper, names)
+        nchecked += 1
+        for name, value in zip(kernel.names, kernel(treewrapper)):
+            expected = getattr(treewrapper, name)()
+            if value == expected or value != value and expected != expected: continue
+            if name not in mismatches:
+                print "{}: {} = {} (kernel) vs. {} (legacy) at entry {}".format(sample, name, value, expected, treewrapper.tree.GetReadEntry())
+            mismatches[name] = mismatches.get(name, 0) + 1
+
+    if kernel is not None:
+        print "{}: checked {} discriminants for {} events, {} of them are not inlined".format(sample, len(kernel.names), nchecked, len(kernel.fallback))
+    if mismatches:
+        raise ValueError("{}: kernel and legacy results are different for:\n".format(sample) + "\n".join("  {} ({} events)".format(name, n) for name, n in sorted(mismatches.iteritems())))
@@ -1,13 +1,55 @@
+import os
+
+import numpy
 import ROOT
 
 import CJLSTscripts
-from utilities import cache, KeyDefaultDict
+from constanttables import BinnedFunctionTable
+from utilities import cache, KeyDefaultDict, TFile
 
 @cache
 def LeptonSFHelper():
   return ROOT.LeptonSFHelper()
 
+def axisedges(axis):
+  return [axis.GetBinLowEdge(i) for i in xrange(1, axis.GetNbins()+2)]
+
+@cache
+def leptonSFedges():
+  ptedges, etaedges = set(), set()
+  for filename in CJLSTscripts.leptonSFfiles:
+    with TFile(os.path.join(CJLSTscripts.CJLSTscriptsfolder, filename)) as f:
+      for key in f.GetListOfKeys():
+        h = key.ReadObj()
+        if isinstance(h, ROOT.TH2):
+          etaedges.update(axisedges(h.GetXaxis()))
+          ptedges.update(axisedges(h.GetYaxis()))
+  return ptedges, etaedges
+
+@cache
+def leptonSFtable(year):
+  helper = LeptonSFHelper()
+  ptedges, etaedges = leptonSFedges()
+  return BinnedFunctionTable(
+    "lepton SF {}".format(year),
+    lambda ID, pt, eta: helper.getSF(year, ID, pt, eta, eta, False),
+    (-13, -11, 11, 13), ptedges, etaedges,
+  )
+
 def fixleptonscalefactor(year, LepLepId, LepPt, LepEta, dataMCWeight):
+  """
+  LepLepId, LepPt, and LepEta can also be arrays of shape (4, nevents)
+  """
+  if isinstance(LepPt, numpy.ndarray):
+    table = leptonSFtable(year)
+    updatedSF = (
+      table(LepLepId[0], LepPt[0], LepEta[0]) *
+      table(LepLepId[1], LepPt[1], LepEta[1]) *
+      table(LepLepId[2], LepPt[2], LepEta[2]) *
+      table(LepLepId[3], LepPt[3], LepEta[3])
+    )
+    return updatedSF / dataMCWeight
+
   helper = LeptonSFHelper()
   updatedSF = (
     helper.getSF(year, LepLepId[0], LepPt[0], LepEta[0], LepEta[0], False) *
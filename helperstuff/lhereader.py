@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+Streaming reader for LHE files.  The events are read in chunks, so the memory use
+doesn't depend on the size of the file, and each chunk is parsed into numpy arrays
+of shape (nevents, maxparticles+1).  Particle i of an event (counting from 1, like
+the mother indices in the file) is in column i.  Column 0 and the columns after the
+last particle of an event are padding, with id = status = 0 and mothers = -1.
+
+The classification into mothers, daughters, and associated particles is the same
+as in LHEEvent, but done for the whole chunk at once.  The smearing and cuts are
+done per event in LHEEvent, because each replica has its own seeded random.Random.
+"""
+
+import numpy
+
+#columns of a particle line
+nparticlecolumns = 13
+#columns of the first line of an event
+neventcolumns = 6
+
+class LHEChunk(object):
+  def __init__(self, eventstrings):
+    self.eventstrings = eventstrings
+
+    headers, particlelines, nparticles = [], [], []
+    for event in eventstrings:
+      #same as LHEEvent
+      lines = [line.split("#")[0] for line in event.split("\n") if not ("<event>" in line or "</event>" in line or not line.split("#")[0].strip())]
+      n = int(lines[0].split()[0])
+      if n != len(lines)-1:
+        raise ValueError("Wrong number of particles! Should be {}, have {}".format(n, len(lines)-1))
+      headers.append(lines[0])
+      particlelines += lines[1:]
+      nparticles.append(n)
+
+    header = numpy.fromstring(" ".join(headers), sep=" ").reshape(-1, neventcolumns)
+    particles = numpy.fromstring(" ".join(particlelines), sep=" ").reshape(-1, nparticlecolumns)
+
+    self.nparticles = numpy.array(nparticles, dtype=int)
+    self.weight = header[:,2]
+
+    nevents = len(self)
+    width = (self.nparticles.max() if nevents else 0) + 1
+    rows = numpy.repeat(numpy.arange(nevents), self.nparticles)
+    offsets = numpy.concatenate(([0], numpy.cumsum(self.nparticles)[:-1])) if nevents else numpy.zeros(0, dtype=int)
+    columns = numpy.arange(len(particles)) - numpy.repeat(offsets, self.nparticles) + 1
+
+    def padded(column, fill, dtype):
+      result = numpy.full((nevents, width), fill, dtype=dtype)
+      result[rows, columns] = particles[:,column]
+      return result
+
+    self.id = padded(0, 0, int)
+    self.status = padded(1, 0, int)
+    self.mother1 = padded(2, -1, int)
+    self.mother2 = padded(3, -1, int)
+    self.px = padded(6, 0, float)
+    self.py = padded(7, 0, float)
+    self.pz = padded(8, 0, float)
+    self.E = padded(9, 0, float)
+
+    self.ismother = self.isdaughter = self.isassociated = None
+
+  def __len__(self):
+    return len(self.nparticles)
+
+  def classify(self, bkg4l=False):
+    """
+    Sets ismother, isdaughter, and isassociated, following the mother chains
+    the same way as LHEEvent.__init__, for all the particles at once.
+    """
+    id, absid = self.id, abs(self.id)
+    self.ismother = self.status == -1
+    final = (self.status == 1) & (((1 <= absid) & (absid <= 6)) | ((11 <= absid) & (absid <= 16)) | (absid == 21) | (absid == 22))
+    self.isdaughter = numpy.zeros(id.shape, dtype=bool)
+    self.isassociated = numpy.zeros(id.shape, dtype=bool)
+
+    undecided = final
+    if bkg4l:
+      if numpy.any((id == 25) & ~self.ismother):
+        raise ValueError("Can't have explicit Higgs for bkg4l")
+      self.isdaughter |= final & (11 <= absid) & (absid <= 16)
+      undecided = final & ~self.isdaughter
+
+    rows = numpy.arange(len(self))[:,numpy.newaxis]
+    mother1, mother2 = self.mother1, self.mother2
+    for i in xrange(id.shape[1]+2):
+      if not undecided.any(): break
+      associated = undecided & ((mother1 != mother2) | (mother1 < 0))
+      self.isassociated |= associated
+      undecided = undecided & ~associated
+
+      index = numpy.where(mother1 < 0, 0, mother1)
+      daughter = undecided & (id[rows, index] == 25)
+      self.isdaughter |= daughter
+      undecided = undecided & ~daughter
+
+      mother1, mother2 = numpy.where(undecided, self.mother1[rows, index], mother1), numpy.where(undecided, self.mother2[rows, index], mother2)
+    else:
+      raise ValueError("Loop in the mother chain")
+
+    if bkg4l:
+      ndaughters = self.isdaughter.sum(axis=1)
+      if numpy.any(ndaughters != 4):
+        raise ValueError("{} leptons instead of 4 for bkg4l!".format(ndaughters[ndaughters != 4][0]))
+
+  def particles(self, i, mask):
+    """
+    (id, px, py, pz, E) for the particles of event i where mask is true, in the order of the file
+    """
+    columns = numpy.flatnonzero(mask[i])
+    return zip(self.id[i, columns].tolist(), self.px[i, columns].tolist(), self.py[i, columns].tolist(), self.pz[i, columns].tolist(), self.E[i, columns].tolist())
+
+def iterchunks(filename, chunksize=10000):
+  """
+  Yields LHEChunks of up to chunksize events from filename
+  """
+  with open(filename) as f:
+    events = []
+    event = ""
+    for line in f:
+      if "<event>" not in line and not event: continue
+      event += line
+      if "</event>" in line:
+        events.append(event)
+        event = ""
+        if len(events) == chunksize:
+          yield LHEChunk(events)
+          events = []
+    if events:
+      yield LHEChunk(events)
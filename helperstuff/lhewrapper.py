@@ -1,15 +1,20 @@
 #!/usr/bin/env python
 
 from abc import abstractmethod
+import hashlib
 import inspect
+from itertools import islice, izip
+import multiprocessing
 import os
 import random
 import sys
+import traceback
 
 import ROOT
 
 import CJLSTscripts
 import config
+from lhereader import iterchunks
 from makesystematics import MakeSystematics
 from samples import ReweightingSample
 from treewrapper import TreeWrapperBase
@@ -19,7 +24,17 @@ requirecmsenv(os.path.join(config.repositorydir, "CMSSW_8_0_20"))
 
 from ZZMatrixElement.MELA.mela import Mela, SimpleParticle_t, SimpleParticleCollection_t, TVar
 
+def smearingseed(seed, replica, ievent):
+  """
+  Seed for the smearing of one replica of one event, so that it doesn't depend
+  on the order in which anything else is smeared
+  """
+  return int(hashlib.sha1("{} {} {}".format(seed, replica, ievent)).hexdigest(), 16)
+
 class LHEEvent(object):
+  #replaced by a random.Random in replica()
+  random = random
+
   def __init__(self, event, bkg4l=False):
     self.eventstr = event
 
@@ -61,8 +76,34 @@ class LHEEvent(object):
     if bkg4l and len(daughters) != 4:
       raise ValueError("{} leptons instead of 4 for bkg4l!".format(len(daughters)))
 
+  @classmethod
+  def fromchunk(cls, chunk, i):
+    """
+    Event i of an lhereader.LHEChunk, after chunk.classify().
+    Same as LHEEvent(str(event)), without parsing the string again.
+    """
+    self = cls.__new__(cls)
+    self.eventstr = chunk.eventstrings[i]
+    self.weight = float(chunk.weight[i])
+    self.gendaughters, self.genmothers, self.genassociated = (
+      particlesfromtuples(chunk.particles(i, mask))
+        for mask in (chunk.isdaughter, chunk.ismother, chunk.isassociated)
+    )
+    return self
+
+  def replica(self, seed):
+    """
+    A copy of the event with the same gen particles, which is smeared
+    independently with its own random number generator
+    """
+    result = type(self).__new__(type(self))
+    result.eventstr, result.weight = self.eventstr, self.weight
+    result.gendaughters, result.genmothers, result.genassociated = self.gendaughters, self.genmothers, self.genassociated
+    result.random = random.Random(seed)
+    return result
+
   @staticmethod
-  def smear(particle):
+  def smear(particle, random=random):
     id, p = particle
     if abs(id) == 11:
       newid = id
@@ -100,14 +141,14 @@ class LHEEvent(object):
   @property
   @cache_instancemethod
   def recodaughters(self):
-    result = [self.smear(_) for _ in self.gendaughters]
+    result = [self.smear(_, self.random) for _ in self.gendaughters]
     result = [_ for _ in result if self.passparticlecuts(_)]
     return result
 
   @property
   @cache_instancemethod
   def recoassociated(self):
-    result = [self.smear(_) for _ in self.genassociated]
+    result = [self.smear(_, self.random) for _ in self.genassociated]
     result = [_ for _ in result if self.passparticlecuts(_)]
     return result
 
@@ -124,6 +165,11 @@ class LHEEvent(object):
   def recomelaargs(self):
     return SimpleParticleCollection_t(self.recodaughters), SimpleParticleCollection_t(self.recoassociated), 0, False
 
+  @property
+  def recoparticles(self):
+    #same as recomelaargs, for recoMEsworker
+    return particlestuple(self.recodaughters), particlestuple(self.recoassociated)
+
   @property
   @cache_instancemethod
   def passcuts(self):
@@ -144,155 +190,220 @@ class LHEEvent(object):
   def njets(self):
     return sum(id == 0 for id, p in self.recoassociated)
 
-class TreeWrapperMELA(TreeWrapperBase):
-  def __init__(self, treesample, minevent=0, maxevent=None):
-    self.mela = self.initmela()
-    self.dofa3stuff = False#(treesample.productionmode == "qqZZ")
-    super(TreeWrapperMELA, self).__init__(treesample, minevent, maxevent)
+class RecoMEs(object):
+  """
+  The matrix elements and decay angles for one event, from computerecoMEs.
+  This is what the worker processes send back in the parallel mode.
+  """
 
-  @staticmethod
-  @cache
-  def initmela(*args, **kwargs):
-    return Mela(*args, **kwargs)
+def computerecoMEs(m, setinputeventargs, dofa3stuff, njets):
+  result = RecoMEs()
+  m.setInputEvent(*setinputeventargs)
 
-  def calcrecoMEs(self, *setinputeventargs):
-    m = self.mela
-    m.setInputEvent(*setinputeventargs)
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = m.ghz1 = 1
+  result.M2g1_decay = m.computeP(True)
 
-    m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = m.ghz1 = 1
-    self.M2g1_decay = m.computeP(True)
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = m.ghz2 = 1
+  result.M2g2_decay = m.computeP(True)
 
-    m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = m.ghz2 = 1
-    self.M2g2_decay = m.computeP(True)
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = 1; m.ghz1_prime2 = 1e4
+  result.M2g1prime2_decay = m.computeP(True)
 
-    m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = 1; m.ghz1_prime2 = 1e4
-    self.M2g1prime2_decay = m.computeP(True)
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = 1; m.ghzgs1_prime2 = 1e4
+  result.M2ghzgs1prime2_decay = m.computeP(True)
 
-    m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = 1; m.ghzgs1_prime2 = 1e4
-    self.M2ghzgs1prime2_decay = m.computeP(True)
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = m.ghz1 = 1; m.ghz1_prime2 = 1e4
+  result.M2g1g1prime2_decay = m.computeP(True) - result.M2g1_decay - result.M2g1prime2_decay
 
-    m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = m.ghz1 = 1; m.ghz1_prime2 = 1e4
-    self.M2g1g1prime2_decay = m.computeP(True) - self.M2g1_decay - self.M2g1prime2_decay
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = m.ghz1 = 1; m.ghzgs1_prime2 = 1e4
+  result.M2g1ghzgs1prime2_decay = m.computeP(True) - result.M2g1_decay - result.M2ghzgs1prime2_decay
 
-    m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = m.ghz1 = 1; m.ghzgs1_prime2 = 1e4
-    self.M2g1ghzgs1prime2_decay = m.computeP(True) - self.M2g1_decay - self.M2ghzgs1prime2_decay
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = 1; m.ghz1_prime2 = m.ghzgs1_prime2 = 1e4
+  result.M2g1prime2ghzgs1prime2_decay = m.computeP(True) - result.M2g1prime2_decay - result.M2ghzgs1prime2_decay
 
-    m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = 1; m.ghz1_prime2 = m.ghzgs1_prime2 = 1e4
-    self.M2g1prime2ghzgs1prime2_decay = m.computeP(True) - self.M2g1prime2_decay - self.M2ghzgs1prime2_decay
+  ###############
+  #contact terms#
+  ###############
 
-    ###############
-    #contact terms#
-    ###############
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = m.ghzzp1 = m.ezp_L_E = m.ezp_L_M = m.ezp_L_T = 1
+  result.M2eL_decay = m.computeP(True)
 
-    m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = m.ghzzp1 = m.ezp_L_E = m.ezp_L_M = m.ezp_L_T = 1
-    self.M2eL_decay = m.computeP(True)
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = m.ghzzp1 = m.ezp_R_E = m.ezp_R_M = m.ezp_R_T = 1
+  result.M2eR_decay = m.computeP(True)
 
-    m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = m.ghzzp1 = m.ezp_R_E = m.ezp_R_M = m.ezp_R_T = 1
-    self.M2eR_decay = m.computeP(True)
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = m.ghz1 = m.ghzzp1 = m.ezp_L_E = m.ezp_L_M = m.ezp_L_T = 1
+  result.M2g1eL_decay = m.computeP(True) - result.M2eL_decay - result.M2g1_decay
 
-    m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = m.ghz1 = m.ghzzp1 = m.ezp_L_E = m.ezp_L_M = m.ezp_L_T = 1
-    self.M2g1eL_decay = m.computeP(True) - self.M2eL_decay - self.M2g1_decay
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = m.ghz1 = m.ghzzp1 = m.ezp_R_E = m.ezp_R_M = m.ezp_R_T = 1
+  result.M2g1eR_decay = m.computeP(True) - result.M2eR_decay - result.M2g1_decay
+
+  m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
+  m.ghg2 = m.ghzzp1 = m.ezp_L_E = m.ezp_L_M = m.ezp_L_T = m.ezp_R_E = m.ezp_R_M = m.ezp_R_T = 1
+  result.M2eLeR_decay = m.computeP(True) - result.M2eL_decay - result.M2eR_decay
+
+  ############
+  #Dbkg stuff#
+  ############
+
+  m.setProcess(TVar.HSMHiggs, TVar.JHUGen, TVar.ZZGG)
+  result.p_m4l_SIG = m.computePM4l(TVar.SMSyst_None)
+
+  m.setProcess(TVar.bkgZZ, TVar.JHUGen, TVar.ZZGG)
+  result.p_m4l_BKG = m.computePM4l(TVar.SMSyst_None)
+
+  m.setProcess(TVar.bkgZZ, TVar.MCFM, TVar.ZZQQB)
+  result.M2qqZZ = m.computeP(True)
+
+  result.M2g1prime2_decay /= 1e4**2
+  result.M2ghzgs1prime2_decay /= 1e4**2
+  result.M2g1g1prime2_decay /= 1e4
+  result.M2g1ghzgs1prime2_decay /= 1e4
+  result.M2g1prime2ghzgs1prime2_decay /= 1e4**2
+
+  result.decayangles = m.computeDecayAngles()
 
+  if dofa3stuff:
     m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = m.ghz1 = m.ghzzp1 = m.ezp_R_E = m.ezp_R_M = m.ezp_R_T = 1
-    self.M2g1eR_decay = m.computeP(True) - self.M2eR_decay - self.M2g1_decay
+    m.ghg2 = m.ghz4 = 1
+    result.M2g4_decay = m.computeP(True)
 
     m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-    m.ghg2 = m.ghzzp1 = m.ezp_L_E = m.ezp_L_M = m.ezp_L_T = m.ezp_R_E = m.ezp_R_M = m.ezp_R_T = 1
-    self.M2eLeR_decay = m.computeP(True) - self.M2eL_decay - self.M2eR_decay
+    m.ghg2 = m.ghz1 = m.ghz4 = 1
+    result.M2g1g4_decay = m.computeP(True) - result.M2g1_decay - result.M2g4_decay
 
-    ############
-    #Dbkg stuff#
-    ############
+    if njets >= 2:
+      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.JJVBF)
+      m.ghz1 = 1
+      result.M2g1_VBF = m.computeProdP(True)
 
-    m.setProcess(TVar.HSMHiggs, TVar.JHUGen, TVar.ZZGG)
-    self.p_m4l_SIG = m.computePM4l(TVar.SMSyst_None)
+      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.JJVBF)
+      m.ghz4 = 1
+      result.M2g4_VBF = m.computeProdP(True)
 
-    m.setProcess(TVar.bkgZZ, TVar.JHUGen, TVar.ZZGG)
-    self.p_m4l_BKG = m.computePM4l(TVar.SMSyst_None)
+      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.JJVBF)
+      m.ghz1 = m.ghz4 = 1
+      result.M2g1g4_VBF = m.computeProdP(True) - result.M2g1_VBF - result.M2g4_VBF
 
-    m.setProcess(TVar.bkgZZ, TVar.MCFM, TVar.ZZQQB)
-    self.M2qqZZ = m.computeP(True)
+      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_ZH)
+      m.ghz1 = 1
+      result.M2g1_HadZH = m.computeProdP(True)
 
-    assert not config.useQGTagging
-    self.cconstantforDbkg = CJLSTscripts.getDbkgConstant(self.ZZFlav(), self.ZZMass())
-    self.cconstantforD2jet = CJLSTscripts.getDVBF2jetsConstant_shiftWP(self.ZZMass(), config.useQGTagging, 0.5)
-    self.cconstantforDHadWH = CJLSTscripts.getDWHhConstant_shiftWP(self.ZZMass(), config.useQGTagging, 0.5)
-    self.cconstantforDHadZH = CJLSTscripts.getDZHhConstant_shiftWP(self.ZZMass(), config.useQGTagging, 0.5)
+      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_ZH)
+      m.ghz4 = 1
+      result.M2g4_HadZH = m.computeProdP(True)
 
-    self.M2g1prime2_decay /= 1e4**2
-    self.M2ghzgs1prime2_decay /= 1e4**2
-    self.M2g1g1prime2_decay /= 1e4
-    self.M2g1ghzgs1prime2_decay /= 1e4
-    self.M2g1prime2ghzgs1prime2_decay /= 1e4**2
+      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_ZH)
+      m.ghz1 = m.ghz4 = 1
+      result.M2g1g4_HadZH = m.computeProdP(True) - result.M2g1_HadZH - result.M2g4_HadZH
 
-    self.decayangles = m.computeDecayAngles()
+      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_WH)
+      m.ghz1 = 1
+      result.M2g1_HadWH = m.computeProdP(True)
 
-    if self.dofa3stuff:
-      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-      m.ghg2 = m.ghz4 = 1
-      self.M2g4_decay = m.computeP(True)
+      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_WH)
+      m.ghz4 = 1
+      result.M2g4_HadWH = m.computeProdP(True)
 
-      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG)
-      m.ghg2 = m.ghz1 = m.ghz4 = 1
-      self.M2g1g4_decay = m.computeP(True) - self.M2g1_decay - self.M2g4_decay
+      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_WH)
+      m.ghz1 = m.ghz4 = 1
+      result.M2g1g4_HadWH = m.computeProdP(True) - result.M2g1_HadWH - result.M2g4_HadWH
 
-      if self.event.njets >= 2:
-        m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.JJVBF)
-        m.ghz1 = 1
-        self.M2g1_VBF = m.computeProdP(True)
+      m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.JJQCD)
+      m.ghg2 = 1
+      result.M2g2_HJJ = m.computeProdP(True)
 
-        m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.JJVBF)
-        m.ghz4 = 1
-        self.M2g4_VBF = m.computeProdP(True)
+      result.notdijet = False
+    else:
+      result.notdijet = True
 
-        m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.JJVBF)
-        m.ghz1 = m.ghz4 = 1
-        self.M2g1g4_VBF = m.computeProdP(True) - self.M2g1_VBF - self.M2g4_VBF
+  m.resetInputEvent()
+  return result
 
-        m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_ZH)
-        m.ghz1 = 1
-        self.M2g1_HadZH = m.computeProdP(True)
+def particlestuple(particles):
+  """
+  Picklable version of a list of SimpleParticle_t, to send to the worker processes
+  """
+  return tuple((id, p.Px(), p.Py(), p.Pz(), p.E()) for id, p in particles)
 
-        m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_ZH)
-        m.ghz4 = 1
-        self.M2g4_HadZH = m.computeProdP(True)
+def particlesfromtuples(particles):
+  return [SimpleParticle_t(id, ROOT.TLorentzVector(px, py, pz, E)) for id, px, py, pz, E in particles]
 
-        m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_ZH)
-        m.ghz1 = m.ghz4 = 1
-        self.M2g1g4_HadZH = m.computeProdP(True) - self.M2g1_HadZH - self.M2g4_HadZH
+def particlesfromtuple(particles):
+  return SimpleParticleCollection_t(particlesfromtuples(particles))
 
-        m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_WH)
-        m.ghz1 = 1
-        self.M2g1_HadWH = m.computeProdP(True)
+def recoMEsworker(args):
+  """
+  Runs in the worker processes.  Each one has its own Mela from initmela.
+  """
+  try:
+    daughters, associated, dofa3stuff, njets = args
+    return computerecoMEs(TreeWrapperMELA.initmela(), (particlesfromtuple(daughters), particlesfromtuple(associated), 0, False), dofa3stuff, njets)
+  except:
+    raise Exception("".join(traceback.format_exception(*sys.exc_info())))
 
-        m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_WH)
-        m.ghz4 = 1
-        self.M2g4_HadWH = m.computeProdP(True)
+class TreeWrapperMELA(TreeWrapperBase):
+  #events per worker process in each batch for parallelrecoMEs
+  batchsize = 100
 
-        m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.Had_WH)
-        m.ghz1 = m.ghz4 = 1
-        self.M2g1g4_HadWH = m.computeProdP(True) - self.M2g1_HadWH - self.M2g4_HadWH
+  def __init__(self, treesample, minevent=0, maxevent=None, nprocesses=1):
+    self.mela = self.initmela()
+    self.dofa3stuff = False#(treesample.productionmode == "qqZZ")
+    self.nprocesses = nprocesses
+    super(TreeWrapperMELA, self).__init__(treesample, minevent, maxevent)
 
-        m.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.JJQCD)
-        m.ghg2 = 1
-        self.M2g2_HJJ = m.computeProdP(True)
+  @staticmethod
+  @cache
+  def initmela(*args, **kwargs):
+    return Mela(*args, **kwargs)
 
-        self.notdijet = False
-      else:
-        self.notdijet = True
+  def calcrecoMEs(self, *setinputeventargs):
+    self.setrecoMEs(computerecoMEs(self.mela, setinputeventargs, self.dofa3stuff, self.event.njets))
 
-    m.resetInputEvent()
+  def setrecoMEs(self, MEs):
+    for name, value in vars(MEs).iteritems():
+      setattr(self, name, value)
+
+    assert not config.useQGTagging
+    self.cconstantforDbkg = CJLSTscripts.getDbkgConstant(self.ZZFlav(), self.ZZMass())
+    self.cconstantforD2jet = CJLSTscripts.getDVBF2jetsConstant_shiftWP(self.ZZMass(), config.useQGTagging, 0.5)
+    self.cconstantforDHadWH = CJLSTscripts.getDWHhConstant_shiftWP(self.ZZMass(), config.useQGTagging, 0.5)
+    self.cconstantforDHadZH = CJLSTscripts.getDZHhConstant_shiftWP(self.ZZMass(), config.useQGTagging, 0.5)
+
+  def parallelrecoMEs(self, events):
+    """
+    Yields (event, MEs) for each event, with the MEs calculated in a pool of nprocesses workers,
+    each with its own Mela.  The events are sent in batches, and the next batch is sent before
+    the current one is returned, so that reading the file overlaps with the MELA calculation.
+    The results are in the same order as the events.
+    """
+    pool = multiprocessing.Pool(processes=self.nprocesses)
+    try:
+      pending = None
+      while True:
+        batch = list(islice(events, self.batchsize * self.nprocesses))
+        if batch:
+          result = pool.map_async(recoMEsworker, [event.recoparticles + (self.dofa3stuff, event.njets) for event in batch], chunksize=max(self.batchsize // 10, 1))
+        if pending is not None:
+          pendingbatch, pendingresult = pending
+          for _ in izip(pendingbatch, pendingresult.get()):
+            yield _
+        if not batch:
+          break
+        pending = batch, result
+    finally:
+      pool.terminate()
+      pool.join()
 
   @classmethod
   def initsystematics(cls):
@@ -352,18 +463,27 @@ class TreeWrapperPythia(TreeWrapperMELA):
 
 @callclassinitfunctions("initweightfunctions", "initsystematics")
 class LHEWrapper(TreeWrapperMELA):
-  def __init__(self, treesample, minevent=0, maxevent=None):
+  """
+  If nsmearings is given, each event in the LHE file is smeared nsmearings times, each
+  time with a random number generator seeded from smearingseed, the replica number, and
+  the event number, and each replica that passes the cuts is a separate entry.
+  The smearingreplica branch says which replica it is, so selecting one value of it
+  gives the same thing as one normal run with a different seed.
+  """
+  def __init__(self, treesample, minevent=0, maxevent=None, nprocesses=1, nsmearings=None, smearingseed=0):
     assert minevent == 0 and maxevent is None
     self.event = None
     self.sumofweights = None
     self.bkg4l = (treesample.productionmode == "qqZZ")
-    super(LHEWrapper, self).__init__(treesample, minevent, maxevent)
+    self.nsmearings = nsmearings
+    self.smearingseed = smearingseed
+    super(LHEWrapper, self).__init__(treesample, minevent, maxevent, nprocesses=nprocesses)
     self.preliminaryloop()
 
   @cache_instancemethod
   def __len__(self):
     with open(self.treesample.LHEfile) as f:
-      return f.read().count("</event>")
+      return sum(line.count("</event>") for line in f)
 
   @property
   @cache_instancemethod
@@ -382,53 +502,64 @@ class LHEWrapper(TreeWrapperMELA):
     i = 0
     sumofweights = 0
     weightfunction = self.treesample.get_MC_weight_function(reweightingonly=True, LHE=True)
-    with open(self.treesample.LHEfile) as f:
-      event = ""
-      for line in f:
-        if "<event>" not in line and not event: continue
-        event += line
-        if "</event>" in line:
-          self.event = event = LHEEvent(event, bkg4l=self.bkg4l)
-          sumofweights += weightfunction(self)
-          event = ""
-          i += 1
-          if i % self.printevery == 0 or i == len(self):
-            print i, "/", len(self), "(preliminary loop)"
-            #break
+    for chunk in iterchunks(self.treesample.LHEfile):
+      chunk.classify(bkg4l=self.bkg4l)
+      for j in xrange(len(chunk)):
+        self.event = LHEEvent.fromchunk(chunk, j)
+        sumofweights += weightfunction(self)
+        i += 1
+        if i % self.printevery == 0 or i == len(self):
+          print i, "/", len(self), "(preliminary loop)"
+          #break
     self.sumofweights = sumofweights
     self.event = None
 
+  def iterevents(self):
+    """
+    Yields the events in the LHE file (or their replicas, for nsmearings) that pass the cuts.
+    The smearing happens here, in this process, so it's the same with or without nprocesses.
+    """
+    i = 0
+    for chunk in iterchunks(self.treesample.LHEfile):
+      chunk.classify(bkg4l=self.bkg4l)
+      for j in xrange(len(chunk)):
+        i += 1
+        if i > len(self): assert False, (i, len(self))
+        if i % self.printevery == 0 or i == len(self):
+          print i, "/", len(self)
+        event = LHEEvent.fromchunk(chunk, j)
+        if self.nsmearings is None:
+          if event.passcuts:
+            yield event
+          continue
+        for replica in xrange(self.nsmearings):
+          replicaevent = event.replica(smearingseed(self.smearingseed, replica, i))
+          replicaevent.smearingreplica = replica
+          if replicaevent.passcuts:
+            yield replicaevent
+
   def __iter__(self):
-    self.__i = 0
-    self.__f = open(self.treesample.LHEfile)
+    self.__events = self.iterevents()
+    if self.nprocesses > 1:
+      self.__events = self.parallelrecoMEs(self.__events)
     return super(LHEWrapper, self).__iter__()
 
   def next(self):
-    if self.__i > len(self): assert False, (self.__i, len(self))
-    self.__i += 1
-    m = self.mela
-    m.resetInputEvent()
-    event = ""
-    if self.__i % self.printevery == 0 or self.__i == len(self):
-      print self.__i, "/", len(self)
-      #raise StopIteration
-    for line in self.__f:
-      if "<event>" not in line and not event:
-        continue
-      event += line
-      if "</event>" in line:
-        self.event = event = LHEEvent(event, bkg4l=self.bkg4l)
-        if not event.passcuts:
-          return next(self)
-
-        self.calcrecoMEs(*event.recomelaargs)
-        return self
-    raise StopIteration
+    self.mela.resetInputEvent()
+    if self.nprocesses > 1:
+      self.event, MEs = next(self.__events)
+      self.setrecoMEs(MEs)
+    else:
+      self.event = next(self.__events)
+      self.calcrecoMEs(*self.event.recomelaargs)
+    return self
 
   def ZZMass(self):
     return self.event.ZZMass #has to happen before doing all the MELA stuff, so can't use computeDecayAngles
   def ZZFlav(self):
     return self.event.ZZFlav
+  def smearingreplica(self):
+    return self.event.smearingreplica
 
   def __del__(self):
     self.mela.resetInputEvent()
@@ -483,6 +614,7 @@ class LHEWrapper(TreeWrapperMELA):
       "D_int_decay",
 
       "allsamples",
+      "batchsize",
       "bkg4l",
       "cconstantforDbkg",
       "cconstantforD2jet",
@@ -501,14 +633,20 @@ class LHEWrapper(TreeWrapperMELA):
       "isbkg",
       "isdata",
       "isZX",
+      "iterevents",
       "maxevent",
       "mela",
       "minevent",
       "next",
+      "nprocesses",
+      "nsmearings",
+      "parallelrecoMEs",
       "preliminaryloop",
       "printevery",
       "productionmode",
+      "setrecoMEs",
       "Show",
+      "smearingseed",
       "sumofweights",
       "toaddtotree",
       "toaddtotree_float",
@@ -537,6 +675,10 @@ class LHEWrapper(TreeWrapperMELA):
     self.toaddtotree_int = [
       "ZZFlav",
     ]
+    if self.nsmearings is None:
+      self.exceptions.append("smearingreplica")
+    else:
+      self.toaddtotree_int.append("smearingreplica")
 
     self.toaddtotree_float = []
 
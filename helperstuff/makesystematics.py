@@ -45,6 +45,10 @@ class MakeSystematics(object):
         Up.__name__ = self.upname
         Dn.__name__ = self.dnname
 
+        #inspect.getsource can't find code that was made with exec
+        Up.source = code.format(UpDn="Up")
+        Dn.source = code.format(UpDn="Dn")
+
         return self.otheralternates + [Up, Dn]
 
     @abstractmethod
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+Finds what the code that calculates a TreeWrapper discriminant depends on, for step2's
+source hashes (which discriminants have to be recalculated in --incremental) and for
+TreeWrapper.inputbranches (which branches of the input tree have to be read).
+
+A discriminant is followed through its bytecode: the functions and methods it calls, its
+defaults and closure, the values of the non-function globals it uses, and the values of
+module attributes like config.something.  Anything that's not python code (e.g. the C++
+category functions) is only included by name.  The attributes of self that aren't class
+attributes are set in next(), so the statements of next() that set them are included too,
+along with whatever those statements use, and so on.  The other statements of next() aren't
+included, except for the ones that can change what happens to everything after them:
+returns, raises, and calls (e.g. GetEntry or a dynamic setattr).
+"""
+
+import ast
+import dis
+import hashlib
+import inspect
+import textwrap
+import types
+
+import numpy
+
+from utilities import cache
+
+def globalattributes(code):
+    """
+    (global name, attribute) for each global.attribute in the bytecode
+    """
+    co_code = code.co_code
+    ops = []
+    i = 0
+    while i < len(co_code):
+        op = ord(co_code[i])
+        if op >= dis.HAVE_ARGUMENT:
+            ops.append((op, ord(co_code[i+1]) + 256*ord(co_code[i+2])))
+            i += 3
+        else:
+            ops.append((op, None))
+            i += 1
+    for (op1, arg1), (op2, arg2) in zip(ops, ops[1:]):
+        if op1 in (dis.opmap["LOAD_GLOBAL"], dis.opmap["LOAD_NAME"]) and op2 == dis.opmap["LOAD_ATTR"]:
+            yield code.co_names[arg1], code.co_names[arg2]
+
+def targetnames(node):
+    """
+    Names of the attributes of self and local variables that an assignment sets
+    """
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "self":
+        return {node.attr}
+    if isinstance(node, ast.Name):
+        return {node.id}
+    if isinstance(node, (ast.Tuple, ast.List)):
+        return set().union(*(targetnames(_) for _ in node.elts))
+    if isinstance(node, ast.Subscript):
+        return targetnames(node.value)
+    return set()
+
+childfields = "body", "orelse", "finalbody"
+
+@cache
+def parsenext(cls):
+    """
+    (statements of cls.next, its globals)
+    """
+    next = cls.next
+    if isinstance(next, types.MethodType): next = next.im_func
+    return ast.parse(textwrap.dedent(inspect.getsource(next))).body[0].body, next.func_globals
+
+def children(statement):
+    result = [getattr(statement, field) for field in childfields if isinstance(getattr(statement, field, None), list)]
+    result += [handler.body for handler in getattr(statement, "handlers", ())]
+    return result
+
+def headerstring(statement):
+    """
+    ast.dump of a compound statement without its body
+    """
+    result = [type(statement).__name__]
+    for field, value in ast.iter_fields(statement):
+        if field in childfields: continue
+        if field == "handlers":
+            for handler in value:
+                result.append(ast.dump(handler.type) if handler.type is not None else "")
+                result.append(ast.dump(handler.name) if isinstance(handler.name, ast.AST) else repr(handler.name))
+        elif isinstance(value, ast.AST):
+            result.append(ast.dump(value))
+        elif isinstance(value, list):
+            result += [ast.dump(_) if isinstance(_, ast.AST) else repr(_) for _ in value]
+        else:
+            result.append(repr(value))
+    return " ".join(result)
+
+class SourceDependencies(object):
+    def __init__(self, cls):
+        self.cls = cls
+        self.hasher = hashlib.sha1()
+        self.seen = set()
+        #attributes of self that aren't class attributes, and local variables in next()
+        self.names = set()
+        #attributes of other things in the selected statements of next(), e.g. t.ZZMass
+        self.attributes = set()
+        self.nextbody, self.nextglobals = parsenext(cls)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    def addcode(self, code, globals):
+        self.hasher.update(code.co_code)
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                self.addcode(const, globals)
+            else:
+                self.addobject(const)
+        for attr in code.co_names:
+            self.hasher.update(attr)
+            if hasattr(self.cls, attr):
+                self.addobject(getattr(self.cls, attr))
+            elif attr in globals:
+                if not isinstance(globals[attr], types.ModuleType):
+                    self.addobject(globals[attr])
+            else:
+                self.names.add(attr)
+        for name, attr in globalattributes(code):
+            self.addmoduleattribute(globals, name, attr)
+
+    def addmoduleattribute(self, globals, name, attr):
+        module = globals.get(name)
+        if isinstance(module, types.ModuleType) and hasattr(module, attr):
+            self.hasher.update("{}.{}".format(name, attr))
+            self.addobject(getattr(module, attr))
+
+    def addobject(self, obj):
+        if isinstance(obj, types.MethodType):
+            obj = obj.im_func
+        if isinstance(obj, property):
+            obj = obj.fget
+        if isinstance(obj, types.FunctionType):
+            if obj in self.seen: return
+            self.seen.add(obj)
+            self.addcode(obj.func_code, obj.func_globals)
+            for thing in (obj.func_defaults or ()) + tuple(cell.cell_contents for cell in obj.func_closure or ()):
+                self.addobject(thing)
+        elif isinstance(obj, (basestring, int, long, float, bool, type(None))):
+            self.hasher.update(repr(obj))
+        elif isinstance(obj, (tuple, list)):
+            for _ in obj: self.addobject(_)
+        elif isinstance(obj, (set, frozenset)):
+            for _ in sorted(obj, key=repr): self.addobject(_)
+        elif isinstance(obj, dict):
+            for key in sorted(obj, key=repr):
+                self.addobject(key)
+                self.addobject(obj[key])
+        elif isinstance(obj, numpy.ndarray):
+            self.hasher.update(repr(obj.shape))
+            self.hasher.update(obj.tostring())
+        else:
+            self.hasher.update(type(obj).__name__)
+
+    def isneeded(self, statement):
+        if isinstance(statement, (ast.Return, ast.Raise, ast.Break, ast.Continue, ast.Expr)):
+            return True
+        if isinstance(statement, ast.Assign):
+            targets = set().union(*(targetnames(_) for _ in statement.targets))
+        elif isinstance(statement, ast.AugAssign):
+            targets = targetnames(statement.target)
+        else:
+            return False
+        return bool(targets & self.names)
+
+    def selectstatements(self, statements):
+        """
+        [(statement, None for a simple statement or the selected statements in each of its bodies)]
+        """
+        result = []
+        for statement in statements:
+            bodies = children(statement)
+            if bodies:
+                selected = [self.selectstatements(_) for _ in bodies]
+                if any(selected):
+                    result.append((statement, selected))
+            elif self.isneeded(statement):
+                result.append((statement, None))
+        return result
+
+    def headernodes(self, statement, bodies):
+        if bodies is None:
+            return [statement]
+        result = []
+        for field, value in ast.iter_fields(statement):
+            if field in childfields: continue
+            if field == "handlers":
+                result += [handler.type for handler in value if handler.type is not None]
+            elif isinstance(value, ast.AST):
+                result.append(value)
+            elif isinstance(value, list):
+                result += [_ for _ in value if isinstance(_, ast.AST)]
+        return result
+
+    def addnames(self, statement, bodies):
+        """
+        Adds what a selected statement of next() uses (not including its bodies)
+        """
+        for header in self.headernodes(statement, bodies):
+            for node in ast.walk(header):
+                if isinstance(node, ast.Attribute):
+                    if isinstance(node.value, ast.Name) and node.value.id == "self":
+                        if hasattr(self.cls, node.attr):
+                            self.addobject(getattr(self.cls, node.attr))
+                        else:
+                            self.names.add(node.attr)
+                    elif isinstance(node.value, ast.Name):
+                        self.addmoduleattribute(self.nextglobals, node.value.id, node.attr)
+                        self.attributes.add(node.attr)
+                    else:
+                        self.attributes.add(node.attr)
+                elif isinstance(node, ast.Name):
+                    self.names.add(node.id)
+                    if node.id in self.nextglobals and not isinstance(self.nextglobals[node.id], types.ModuleType):
+                        self.addobject(self.nextglobals[node.id])
+        for body in bodies or ():
+            for _ in body:
+                self.addnames(*_)
+
+    def addnext(self):
+        """
+        Adds the statements of next() that set the attributes in self.names,
+        after adding everything that goes into them
+        """
+        while True:
+            before = len(self.names), len(self.seen)
+            selected = self.selectstatements(self.nextbody)
+            for _ in selected:
+                self.addnames(*_)
+            if (len(self.names), len(self.seen)) == before:
+                break
+        self.hashstatements(selected)
+
+    def hashstatements(self, selected):
+        for statement, bodies in selected:
+            if bodies is None:
+                self.hasher.update(ast.dump(statement))
+            else:
+                self.hasher.update(headerstring(statement))
+                for body in bodies:
+                    self.hasher.update("{")
+                    self.hashstatements(body)
+                    self.hasher.update("}")
+
+def sourcehash(cls, name):
+    """
+    Hash of the code that calculates a discriminant and of the values of the globals and config settings it uses
+    """
+    result = SourceDependencies(cls)
+    result.addobject(getattr(cls, name))
+    result.addnext()
+    return result.hexdigest()
+
+def usednames(cls, names):
+    """
+    Names of the attributes and variables that the discriminants in names use, directly
+    or through next(), which includes the branches of the input tree that they read
+    """
+    result = SourceDependencies(cls)
+    for name in names:
+        result.addobject(getattr(cls, name))
+    result.addnext()
+    return result.names | result.attributes
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Fills many templates with the same binning, whose weights are all linear combinations of the same
+terms (e.g. the 70 hypotheses and interference terms of a 4 coupling VBF or VH basis, which are all
+MC_weight_nominal * sum of coefficient * reweighting weight).
+
+The events are given in batches.  For each batch, the weights of every event for every template are
+one matrix product, (n_templates x n_terms) x (n_terms x n_events), and they're all added into the
+bins with one bincount.  The content and sumw2 of all the templates are kept in memory until the end,
+so the memory use is that, 16 bytes per bin per template, plus one batch of events.
+"""
+
+from itertools import izip
+
+import numpy
+
+class StreamingAccumulator(object):
+    def __init__(self, binning, matrix):
+        """
+        binning: [nbins, min, max] for each axis, like in the template json
+        matrix: (n_templates x n_terms), the coefficients of each term in each template's weight
+        """
+        self.binning = [binning[i:i+3] for i in xrange(0, len(binning), 3)]
+        self.matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        self.nbins = int(numpy.prod([nbins+2 for nbins, min, max in self.binning]))
+        #indexed [template, global bin number]
+        self.content = numpy.zeros((self.ntemplates, self.nbins))
+        self.sumw2 = numpy.zeros((self.ntemplates, self.nbins))
+
+    @property
+    def ntemplates(self):
+        return self.matrix.shape[0]
+
+    @property
+    def nterms(self):
+        return self.matrix.shape[1]
+
+    def binindex(self, variables):
+        """
+        Global bin numbers, including the underflow and overflow.  Each axis is the same as TAxis::FindBin:
+        x < min is the underflow, anything else that's not < max (including nan) is the overflow,
+        and the rest is 1 + int(nbins*(x-min)/(max-min)), in that order, so that it rounds the same way.
+        """
+        result = numpy.zeros(variables.shape[1], dtype=numpy.int64)
+        stride = 1
+        for values, (nbins, min, max) in izip(variables, self.binning):
+            values = numpy.asarray(values, dtype=numpy.float64)
+            min, max = float(min), float(max)
+            with numpy.errstate(invalid="ignore"):
+                underflow = values < min
+                inrange = ~underflow & (values < max)
+            index = numpy.where(underflow, 0, nbins+1)
+            index[inrange] = 1 + (nbins*(values[inrange]-min)/(max-min)).astype(numpy.int64)
+            result += index * stride
+            stride *= nbins+2
+        return result
+
+    def fill(self, variables, prefactor, terms):
+        """
+        Adds a batch of events that pass the selection, given as (n_dimensions x n_events),
+        (n_events), and (n_terms x n_events) arrays
+        """
+        if not len(prefactor): return
+        bins = self.binindex(variables)
+        weights = self.matrix.dot(terms * prefactor).ravel()
+        indices = (numpy.arange(self.ntemplates)[:, numpy.newaxis] * self.nbins + bins).ravel()
+        self.content += numpy.bincount(indices, weights=weights, minlength=self.content.size).reshape(self.content.shape)
+        self.sumw2 += numpy.bincount(indices, weights=weights**2, minlength=self.sumw2.size).reshape(self.sumw2.shape)
@@ -0,0 +1,76 @@
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include "TH1.h"
+#include "TH2.h"
+#include "TH3.h"
+#include "TTree.h"
+#include "TTreeFormula.h"
+
+// Fills many histograms in one pass over the entries [firstentry, firstentry+nentries) of t.
+// Histogram i is filled with the formulas variables[variableoffsets[i]:variableoffsets[i+1]] (x, y, z)
+// and weight the product of the formulas factors[factoroffsets[i]:factoroffsets[i+1]],
+// if that's not 0.  The numbers in variables and factors are indices in formulas.
+// Each formula is evaluated at most once per entry, no matter how many histograms use it,
+// and the factors are evaluated in order until one of them is 0.
+void fillmultiple(
+                  TTree* t,
+                  Long64_t firstentry,
+                  Long64_t nentries,
+                  const std::vector<std::string>& formulas,
+                  const std::vector<TH1*>& histograms,
+                  const std::vector<int>& variables,
+                  const std::vector<int>& variableoffsets,
+                  const std::vector<int>& factors,
+                  const std::vector<int>& factoroffsets
+                 ) {
+  std::vector<TTreeFormula*> treeformulas;
+  for (size_t k = 0; k < formulas.size(); k++) {
+    treeformulas.push_back(new TTreeFormula(Form("templatefiller%zu", k), formulas[k].c_str(), t));
+    // same check as TTree::Draw: the formula couldn't be compiled, e.g. a branch is missing
+    if (!treeformulas.back()->GetNdim()) {
+      for (size_t l = 0; l < treeformulas.size(); l++) delete treeformulas[l];
+      throw std::invalid_argument("Invalid formula for " + std::string(t->GetName()) + ": " + formulas[k]);
+    }
+  }
+  std::vector<double> values(formulas.size());
+  std::vector<bool> evaluated(formulas.size());
+
+  for (Long64_t entry = firstentry; entry < firstentry + nentries; entry++) {
+    if (t->LoadTree(entry) < 0) break;
+    for (size_t k = 0; k < formulas.size(); k++) evaluated[k] = false;
+
+    for (size_t i = 0; i < histograms.size(); i++) {
+      double weight = 1;
+      for (int j = factoroffsets[i]; j < factoroffsets[i+1] && weight != 0; j++) {
+        int k = factors[j];
+        if (!evaluated[k]) {
+          treeformulas[k]->GetNdata();
+          values[k] = treeformulas[k]->EvalInstance();
+          evaluated[k] = true;
+        }
+        weight *= values[k];
+      }
+      if (weight == 0) continue;
+
+      double x[3];
+      int ndimensions = variableoffsets[i+1] - variableoffsets[i];
+      for (int j = 0; j < ndimensions; j++) {
+        int k = variables[variableoffsets[i]+j];
+        if (!evaluated[k]) {
+          treeformulas[k]->GetNdata();
+          values[k] = treeformulas[k]->EvalInstance();
+          evaluated[k] = true;
+        }
+        x[j] = values[k];
+      }
+
+      if (ndimensions == 1) histograms[i]->Fill(x[0], weight);
+      else if (ndimensions == 2) ((TH2*)histograms[i])->Fill(x[0], x[1], weight);
+      else ((TH3*)histograms[i])->Fill(x[0], x[1], x[2], weight);
+    }
+  }
+
+  for (size_t k = 0; k < treeformulas.size(); k++) delete treeformulas[k];
+}
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+
+"""
+Fills the templates described by jsons from TemplatesFile.getjson() in this process,
+instead of running buildTemplates.py.
+
+Each template is the sum over its "files" lists, each with the corresponding "weight":
+the files in one list are filled with that weight and the selection.  All the templates
+in all the jsons are grouped by input tree, and each chunk of entries of each tree is read
+once, in fillmultiple (templatefiller.cc), filling every histogram that uses that tree.
+The weights and selections are split into their factors (MC_weight_nominal, the
+reweighting weight, the selection, ...), and each distinct factor or variable is evaluated
+once per entry, however many templates use it.  The chunks are done in a pool of processes.
+Then the "postprocessing" (rescale, floor, mirror) is applied and the histograms are written
+to outputFile with the template names, same as buildTemplates.py.
+
+Templates that share their files, variables, binning, and selection, and whose weights are all
+linear combinations of the same terms (like the hypotheses and interference terms of a
+multiparameter VBF or VH basis), are instead filled together by the StreamingAccumulator
+(streamingaccumulator.py), which projects each batch of config.streamingbatchsize events
+onto all of them with one matrix product.
+
+The raw histograms, before the postprocessing, are kept in the HistogramCache
+(histogramcache.py), so templates whose inputs didn't change aren't filled again.
+
+The constraints (e.g. oneparameterHVV) are not implemented, so jsons that have any
+have to go through buildTemplates.py.  canfill() tells which ones can be done here.
+"""
+
+from collections import OrderedDict
+from itertools import izip
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+
+import numpy
+import ROOT
+import root_numpy
+
+import config
+from customsmoothing.histogramarrays import contents, inrange, sumw2
+from histogramcache import HistogramCache
+from streamingaccumulator import StreamingAccumulator
+from utilities import LoadMacro, mkdir_p, TFile
+
+LoadMacro(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templatefiller.cc+"))
+
+def canfill(jsn):
+    return not jsn.get("constraints")
+
+def makehistogram(name, binning):
+    ndimensions = len(binning) // 3
+    cls = {1: ROOT.TH1F, 2: ROOT.TH2F, 3: ROOT.TH3F}[ndimensions]
+    h = cls(name, name, *binning)
+    h.Sumw2()
+    return h
+
+def stripparentheses(expression):
+    expression = expression.strip()
+    while expression.startswith("(") and matchingparenthesis(expression, 0) == len(expression)-1:
+        expression = expression[1:-1].strip()
+    return expression
+
+def isexponentsign(expression, i):
+    #the - in 1e-05
+    return expression[i] in "+-" and i >= 2 and expression[i-1] in "eE" and expression[i-2].isdigit()
+
+def factors(expression):
+    """
+    Splits expression into the things that are multiplied together at the top level,
+    without the parentheses around each one.  If there's anything at the top level that
+    binds less tightly than * (+, &&, ==, ...), the expression is one factor.
+    """
+    expression = stripparentheses(expression)
+    result = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(expression):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif depth == 0 and char in "+-<>=!&|?:%" and not isexponentsign(expression, i):
+            return [expression]
+        elif depth == 0 and char == "*":
+            result.append(expression[start:i])
+            start = i+1
+    result.append(expression[start:])
+    if len(result) == 1:
+        return result
+    return sum((factors(_) for _ in result), [])
+
+def matchingparenthesis(expression, i):
+    depth = 0
+    for j in xrange(i, len(expression)):
+        if expression[j] == "(": depth += 1
+        if expression[j] == ")": depth -= 1
+        if depth == 0: return j
+    raise ValueError("Unmatched parenthesis in {}".format(expression))
+
+def splittoplevel(expression, separator):
+    result = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(expression):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif depth == 0 and char == separator and not isexponentsign(expression, i):
+            result.append(expression[start:i])
+            start = i+1
+    result.append(expression[start:])
+    return result
+
+def linearcombination(expression):
+    """
+    {term: coefficient} if expression is a sum of term*number (like SumOfSamples.MC_weight),
+    otherwise None
+    """
+    result = OrderedDict()
+    for summand in splittoplevel(stripparentheses(expression), "+"):
+        coefficient = 1.
+        names = []
+        for part in splittoplevel(stripparentheses(summand), "*"):
+            part = stripparentheses(part)
+            try:
+                coefficient *= float(part)
+            except ValueError:
+                if not part or any(_ in part for _ in "+-/<>=!&|?:%()"): return None
+                names.append(part)
+        if not names: return None
+        term = "*".join(names)
+        result[term] = result.get(term, 0) + coefficient
+    return result
+
+def linearweight(weight):
+    """
+    (prefactor, {term: coefficient}) if weight is something times a linear combination of at least two terms,
+    otherwise None
+    """
+    if weight is None: return None
+    prefactors = []
+    combination = None
+    for factor in factors(weight):
+        thiscombination = linearcombination(factor)
+        if combination is None and thiscombination is not None and len(thiscombination) > 1:
+            combination = thiscombination
+        else:
+            prefactors.append(factor)
+    if combination is None: return None
+    return "*".join("({})".format(_) for _ in prefactors) or "1", combination
+
+def weightfactors(weight, selection):
+    #the selection first, so that the weight isn't evaluated for events that fail it
+    result = factors(selection)
+    if weight is not None:
+        result += factors(weight)
+    return result
+
+def fillchunk(args):
+    """
+    Runs in the worker processes.  Fills all the histograms that use one chunk of one tree.
+    histograms is a list of (id, binning, indices of the variables, indices of the factors)
+    Returns a list of (id, histogram).
+    """
+    try:
+        filename, treename, firstentry, nentries, formulas, histograms = args
+        ROOT.gROOT.cd()
+        result = [(id, makehistogram("templatefiller{}".format(id), binning)) for id, binning, variables, factors in histograms]
+        for id, h in result:
+            h.SetDirectory(0)
+
+        vectors = {}
+        for name, typ, values in (
+            ("formulas", "string", formulas),
+            ("histograms", "TH1*", [h for id, h in result]),
+            ("variables", "int", [_ for id, binning, variables, factors in histograms for _ in variables]),
+            ("variableoffsets", "int", offsets([len(variables) for id, binning, variables, factors in histograms])),
+            ("factors", "int", [_ for id, binning, variables, factors in histograms for _ in factors]),
+            ("factoroffsets", "int", offsets([len(factors) for id, binning, variables, factors in histograms])),
+        ):
+            vectors[name] = ROOT.std.vector(typ)()
+            for _ in values: vectors[name].push_back(_)
+
+        with TFile(filename) as f:
+            t = f.Get(treename)
+            ROOT.fillmultiple(t, firstentry, nentries, *(vectors[_] for _ in ("formulas", "histograms", "variables", "variableoffsets", "factors", "factoroffsets")))
+        return result
+    except:
+        raise Exception("".join(traceback.format_exception(*sys.exc_info())))
+
+def streamchunk(args):
+    """
+    Runs in the worker processes.  Fills a group of templates whose weights are prefactor times
+    a linear combination of terms with the StreamingAccumulator.
+    templates is a list of (id, coefficient of each term)
+    Returns a list of (id, histogram).
+    """
+    try:
+        filename, treename, firstentry, nentries, variables, binning, selection, prefactor, terms, templates, batchsize = args
+        accumulator = StreamingAccumulator(binning, [coefficients for id, coefficients in templates])
+
+        with TFile(filename) as f:
+            t = f.Get(treename)
+            branches = list(OrderedDict.fromkeys(variables + [prefactor] + terms))
+            for start in xrange(firstentry, firstentry+nentries, batchsize):
+                stop = min(start + batchsize, firstentry+nentries)
+                arrays = root_numpy.tree2array(t, branches=branches, selection=selection, start=start, stop=stop)
+                accumulator.fill(
+                    numpy.array([arrays[_] for _ in variables], dtype=numpy.float64).reshape(len(variables), -1),
+                    numpy.asarray(arrays[prefactor], dtype=numpy.float64),
+                    numpy.array([arrays[_] for _ in terms], dtype=numpy.float64).reshape(len(terms), -1),
+                )
+
+        ROOT.gROOT.cd()
+        result = []
+        for (id, coefficients), content, squaredweights in izip(templates, accumulator.content, accumulator.sumw2):
+            h = makehistogram("templatefiller{}".format(id), binning)
+            h.SetDirectory(0)
+            #the global bin number is x + (nx+2) * (y + (ny+2) * z), same as in the accumulator
+            contents(h).T.reshape(-1)[...] = content
+            sumw2(h).T.reshape(-1)[...] = squaredweights
+            h.ResetStats()
+            result.append((id, h))
+        return result
+    except:
+        raise Exception("".join(traceback.format_exception(*sys.exc_info())))
+
+def runtask(task):
+    function, args = task
+    return function(args)
+
+def offsets(lengths):
+    result = [0]
+    for _ in lengths:
+        result.append(result[-1] + _)
+    return result
+
+def chunks(jsns, chunksize, skip=()):
+    """
+    Groups the templates of all the jsns, except the ids in skip, by input tree.
+    Yields (fillchunk, arguments) for each chunk of each tree, and (streamchunk, arguments)
+    for each chunk of each group of templates that can be streamed together.
+    The ids of the histograms are (index of the json, index of the template).
+    """
+    trees = OrderedDict()
+    streams = OrderedDict()
+    for i, jsn in enumerate(jsns):
+        for j, template in enumerate(jsn["templates"]):
+            if (i, j) in skip: continue
+            weights = template.get("weight")
+            if weights is None or isinstance(weights, basestring):
+                weights = [weights] * len(template["files"])
+            if len(weights) != len(template["files"]):
+                raise ValueError("{} has {} lists of files and {} weights".format(template["name"], len(template["files"]), len(weights)))
+            for filelist, weight in zip(template["files"], weights):
+                for filename in filelist:
+                    entry = (i, j), template["binning"]["bins"], template["variables"], weightfactors(weight, template["selection"])
+                    linear = linearweight(weight)
+                    if linear is None:
+                        trees.setdefault((filename, template["tree"]), []).append(entry)
+                    else:
+                        prefactor, combination = linear
+                        key = filename, template["tree"], tuple(template["variables"]), tuple(template["binning"]["bins"]), template["selection"], prefactor
+                        streams.setdefault(key, []).append((entry, combination))
+
+    for key, group in streams.iteritems():
+        filename, treename, variables, binning, selection, prefactor = key
+        if len(group) < config.streamingminimumtemplates:
+            trees.setdefault((filename, treename), []).extend(entry for entry, combination in group)
+            continue
+        terms = list(OrderedDict.fromkeys(term for entry, combination in group for term in combination))
+        templates = [(entry[0], [combination.get(term, 0) for term in terms]) for entry, combination in group]
+        with TFile(filename) as f:
+            n = f.Get(treename).GetEntries()
+        for firstentry in xrange(0, n, chunksize):
+            yield streamchunk, (filename, treename, firstentry, min(chunksize, n-firstentry), list(variables), list(binning), selection, prefactor, terms, templates, config.streamingbatchsize)
+
+    for (filename, treename), histograms in trees.iteritems():
+        formulas = OrderedDict()
+        indexed = []
+        for id, binning, variables, factors in histograms:
+            indexed.append((
+                id, binning,
+                [formulas.setdefault(_, len(formulas)) for _ in variables],
+                [formulas.setdefault(_, len(formulas)) for _ in factors],
+            ))
+        with TFile(filename) as f:
+            n = f.Get(treename).GetEntries()
+        for firstentry in xrange(0, n, chunksize):
+            yield fillchunk, (filename, treename, firstentry, min(chunksize, n-firstentry), list(formulas), indexed)
+
+def mirror(h, antisymmetric, axis):
+    """
+    (h +- mirror image of h) / 2, where the mirror image flips the bins of axis.
+    Only the bins in range are changed.
+    """
+    sign = -1 if antisymmetric else 1
+    result = h.Clone()
+    result.SetDirectory(0)
+    content, errors = contents(h).astype(numpy.float64), sumw2(h).astype(numpy.float64)
+
+    bins = [slice(1, -1)] * h.GetDimension()
+    mirrorbins = bins[:]
+    mirrorbins[axis] = slice(-2, 0, -1)
+    bins, mirrorbins = tuple(bins), tuple(mirrorbins)
+    contents(result)[bins] = (content[bins] + sign*content[mirrorbins]) / 2
+    sumw2(result)[bins] = (errors[bins] + errors[mirrorbins]) / 4
+
+    nbins = content.shape[axis] - 2
+    if nbins % 2:
+        #the middle bin is its own mirror image
+        middle = list(bins)
+        middle[axis] = (nbins+1) // 2
+        middle = tuple(middle)
+        sumw2(result)[middle] = 0 if antisymmetric else errors[middle]
+    result.ResetStats()
+    return result
+
+def postprocess(h, postprocessing):
+    for step in postprocessing:
+        if step["type"] == "rescale":
+            h.Scale(step["factor"])
+        elif step["type"] == "floor":
+            content = inrange(contents(h))
+            content[content < step["floorvalue"]] = step["floorvalue"]
+            h.ResetStats()
+        elif step["type"] == "mirror":
+            h = mirror(h, step.get("antisymmetric", False), step.get("axis", 1))
+        else:
+            raise ValueError("Unknown postprocessing {}".format(step["type"]))
+    return h
+
+def filltemplates(jsonfiles, nprocesses=8, chunksize=500000, usecache=True):
+    if isinstance(jsonfiles, basestring): jsonfiles = [jsonfiles]
+    jsns = []
+    for jsonfile in jsonfiles:
+        with open(jsonfile) as f:
+            jsns.append(json.load(f))
+        if not canfill(jsns[-1]):
+            raise ValueError("{} has constraints, use buildTemplates.py".format(jsonfile))
+        nprocesses = min(nprocesses, jsns[-1].get("maxthreads", nprocesses))
+
+    cache = HistogramCache(maxsize=None if usecache else 0)
+    histograms = {}
+    cached = set()
+    for i, jsn in enumerate(jsns):
+        for j, template in enumerate(jsn["templates"]):
+            histograms[i, j] = cache.get(template)
+            if histograms[i, j] is None:
+                histograms[i, j] = makehistogram(template["name"], template["binning"]["bins"])
+                histograms[i, j].SetDirectory(0)
+            else:
+                cached.add((i, j))
+    if cached:
+        print "{} of {} templates are in the cache".format(len(cached), len(histograms))
+
+    arglist = list(chunks(jsns, chunksize, skip=cached))
+    if nprocesses > 1 and len(arglist) > 1:
+        pool = multiprocessing.Pool(processes=min(nprocesses, len(arglist)))
+        try:
+            for result in pool.imap_unordered(runtask, arglist):
+                for id, h in result:
+                    histograms[id].Add(h)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for task in arglist:
+            for id, h in runtask(task):
+                histograms[id].Add(h)
+
+    for (i, j), h in histograms.iteritems():
+        if (i, j) not in cached:
+            cache.set(jsns[i]["templates"][j], h)
+    cache.prune()
+
+    for i, jsn in enumerate(jsns):
+        outputfile = jsn["outputFile"]
+        mkdir_p(os.path.dirname(outputfile))
+        with TFile(outputfile, "recreate", deleteifbad=True) as f:
+            for j, template in enumerate(jsn["templates"]):
+                h = postprocess(histograms[i, j], template.get("postprocessing", []))
+                h.SetName(template["name"])
+                h.SetDirectory(f)
+        with open(outputfile.replace(".root", ".done"), "w"):
+            pass
@@ -16,7 +16,7 @@ import ROOT
 import config
 from enums import AlternateGenerator, AlternateWeight, Analysis, analyses, Channel, channels, Category, categories, EnumItem, flavors, hffhypotheses, HffHypothesis, Hypothesis, MultiEnum, MultiEnumABCMeta, MyEnum, Production, ProductionMode, productions, ShapeSystematic, shapesystematics, TemplateGroup, templategroups, treeshapesystematics
 from samples import ReweightingSample, ReweightingSamplePlus, ReweightingSampleWithPdf, Sample, SampleBasis, SumOfSamples
-from utilities import cache, deprecate, is_almost_integer, JsonDict, jsonloads, TFile, withdiscriminantsfileisvalid
+from utilities import cache, deprecate, is_almost_integer, isfriendfile, JsonDict, jsonloads, TFile, withdiscriminantsfileisvalid
 
 class TemplatesFile(MultiEnum):
     enumname = "templatesfile"
@@ -790,37 +790,11 @@ class TemplatesFile(MultiEnum):
 
     @property
     def treeshapesystematics(self):
-        for _ in self.allshapesystematics:
-            if _ not in treeshapesystematics: continue
-            yield _
+        return treeshapesystematicsfor(self.templategroup, self.category)
 
     @property
     def allshapesystematics(self):
-        for _ in shapesystematics:
-            if not _.appliesto(self.templategroup): continue
-
-            if _ in ("JECUp", "JECDn", "JEC0PMUp", "JEC0PMDn", "JEC0MUp", "JEC0MDn", "JEC0PHUp", "JEC0PHDn", "JEC0L1Up", "JEC0L1Dn", "JEC0L1ZgUp", "JEC0L1ZgDn"):
-                if self.category not in ("VBFtagged", "VHHadrtagged"): continue
-
-            if _.isTHUggH:
-                STXSuncertainties = "Mu", "Res", "Mig01", "Mig12", "VBF2j", "VBF3j", "PT60", "PT120", "qmtop"
-                if self.category == "VBFtagged":
-                    indices = 1, 3, 4, 5, 6, 7, 8
-                elif self.category == "VHHadrtagged":
-                    indices = 3, 6, 7, 8
-                elif self.category == "VBF1jtagged":
-                    indices = 2, 3, 6, 7
-                elif self.category == "VHLepttagged":
-                    indices = 1, 2, 3, 6, 7, 8
-                elif self.category == "Boosted":
-                    indices = 3, 7, 8
-                elif self.category == "Untagged":
-                    indices = ()
-                else:
-                    assert False, self
-                if not any(_ == "THU_ggH_" + STXSuncertainties[index] + direction for index in indices for direction in ("Up", "Dn", "0PMUp", "0PMDn")):
-                    continue
-            yield _
+        return allshapesystematicsfor(self.templategroup, self.category)
 
     @property
     def constraints(self):
@@ -1190,8 +1164,43 @@ class TemplatesFile(MultiEnum):
 def listfromiterator(function):
     return list(function())
 
-@listfromiterator
-def templatesfiles():
+def allshapesystematicsfor(templategroup, category):
+    for _ in shapesystematics:
+        if not _.appliesto(templategroup): continue
+
+        if _ in ("JECUp", "JECDn", "JEC0PMUp", "JEC0PMDn", "JEC0MUp", "JEC0MDn", "JEC0PHUp", "JEC0PHDn", "JEC0L1Up", "JEC0L1Dn", "JEC0L1ZgUp", "JEC0L1ZgDn"):
+            if category not in ("VBFtagged", "VHHadrtagged"): continue
+
+        if _.isTHUggH:
+            STXSuncertainties = "Mu", "Res", "Mig01", "Mig12", "VBF2j", "VBF3j", "PT60", "PT120", "qmtop"
+            if category == "VBFtagged":
+                indices = 1, 3, 4, 5, 6, 7, 8
+            elif category == "VHHadrtagged":
+                indices = 3, 6, 7, 8
+            elif category == "VBF1jtagged":
+                indices = 2, 3, 6, 7
+            elif category == "VHLepttagged":
+                indices = 1, 2, 3, 6, 7, 8
+            elif category == "Boosted":
+                indices = 3, 7, 8
+            elif category == "Untagged":
+                indices = ()
+            else:
+                assert False, (templategroup, category)
+            if not any(_ == "THU_ggH_" + STXSuncertainties[index] + direction for index in indices for direction in ("Up", "Dn", "0PMUp", "0PMDn")):
+                continue
+        yield _
+
+def treeshapesystematicsfor(templategroup, category):
+    for _ in allshapesystematicsfor(templategroup, category):
+        if _ not in treeshapesystematics: continue
+        yield _
+
+def templatesfilekeys():
+    """
+    The enums of each templates file, in the same order as TemplatesFile.enums,
+    without making the TemplatesFile objects
+    """
     for channel in channels:
         for production in productions:
             if channel != "2e2mu" and production.LHE: continue
@@ -1204,12 +1213,83 @@ def templatesfiles():
                     for templategroup in templategroups:
                         if analysis.isdecayonly and templategroup not in ("bkg", "ggh", "DATA"): continue
                         if production.GEN and templategroup in ("tth", "bbh"): continue
-                        nominal = TemplatesFile(channel, templategroup, analysis, production, category)
-                        for shapesystematic in nominal.treeshapesystematics:
+                        for shapesystematic in treeshapesystematicsfor(templategroup, category):
                             if (production.LHE or production.GEN) and shapesystematic != "": continue
                             if category not in ("VBFtagged", "VHHadrtagged") and shapesystematic in ("JECUp", "JECDn", "MINLO_SM"): continue
 
-                            yield TemplatesFile(channel, shapesystematic, templategroup, analysis, production, category)
+                            yield channel, shapesystematic, templategroup, analysis, production, category
+
+class TemplatesFiles(object):
+    """
+    All the templates files, in the same order as the list that this used to be.
+    The keys are enumerated from the enums the first time they're needed, and each
+    TemplatesFile is only made when it's accessed.
+
+    Iterating, len, indexing, and `in` work the same as for the list.
+    select(production=..., analysis=..., category=..., channel=..., templategroup=..., shapesystematic=...)
+    gives only the ones that match, using an index, without making the rest.
+    """
+    def __init__(self, keyfunction):
+        self.__keyfunction = keyfunction
+        self.__keys = None
+        self.__positions = None
+        self.__index = None
+        self.__templatesfiles = {}
+
+    @property
+    def keys(self):
+        if self.__keys is None:
+            self.__keys = list(self.__keyfunction())
+            self.__positions = {key: i for i, key in enumerate(self.__keys)}
+        return self.__keys
+
+    def index(self, enum):
+        """
+        {value of enum: [positions of the templates files that have it]}
+        """
+        if self.__index is None:
+            self.__index = {}
+            for i, key in enumerate(self.keys):
+                for _, value in zip(TemplatesFile.enums, key):
+                    self.__index.setdefault(_, {}).setdefault(value, []).append(i)
+        return self.__index[enum]
+
+    def get(self, i):
+        if i not in self.__templatesfiles:
+            self.__templatesfiles[i] = TemplatesFile(*self.keys[i])
+        return self.__templatesfiles[i]
+
+    def select(self, **kwargs):
+        positions = None
+        for enum in TemplatesFile.enums:
+            if enum.enumname not in kwargs: continue
+            matching = set(self.index(enum).get(enum(kwargs.pop(enum.enumname)), ()))
+            positions = matching if positions is None else positions & matching
+        if kwargs:
+            raise TypeError("Unknown arguments {}".format(kwargs))
+        if positions is None:
+            positions = xrange(len(self))
+        return [self.get(i) for i in sorted(positions)]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.get(i)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.get(i) for i in xrange(*item.indices(len(self)))]
+        if item < 0: item += len(self)
+        if not 0 <= item < len(self): raise IndexError(item)
+        return self.get(item)
+
+    def __contains__(self, templatesfile):
+        self.keys
+        return templatesfile.items in self.__positions
+
+templatesfiles = TemplatesFiles(templatesfilekeys)
 
 
 class TemplateBase(object):
@@ -1776,6 +1856,12 @@ class Template(TemplateBase, MultiEnum):
             result.append("(" + " || ".join("{} == {}".format(self.categoryname, c) for c in idnumbers) + ")")
         if self.productionmode == "data" and not config.showblinddistributions:
             result.insert(0, "0")
+        friend = {isfriendfile(sample.withdiscriminantsfile()) for samples in self.reweightfrom() for sample in samples}
+        if True in friend:
+            #the other entries are only there so that the CJLST tree can be a friend
+            if False in friend:
+                raise ValueError("Some of the input files for {} were made with step2 --friend and some weren't.  Remake them the same way.".format(self))
+            result.append("step2selected")
         return " && ".join(result)
 
     @property
@@ -4,6 +4,7 @@ from array import array
 from collections import Counter, Iterator
 import inspect
 from itertools import chain, izip, izip_longest
+import logging
 from math import sqrt
 import os
 import resource
@@ -16,16 +17,18 @@ import categorization
 import CJLSTscripts
 import config
 import constants
+import constanttables
 import discriminants
 import enums
 import STXS
 import xrd
 import ZX
 from enums import ggZZoffshellproductionmodes
-from gconstants import gconstant
+from constanttables import gconstant
 from leptonscalefactor import fixleptonscalefactor
 from makesystematics import MakeBtagSystematics, MakeJetSystematics, MakeSystematics
 from samples import ReweightingSample, ReweightingSamplePlus, Sample
+from sourcedependencies import usednames
 from utilities import cache_instancemethod, callclassinitfunctions, deprecate, Fake_LSF_creating, getmembernames, MultiplyCounter, product, TFile, tlvfromptetaphim
 
 resource.setrlimit(resource.RLIMIT_STACK, (2**29,-1))
@@ -34,6 +37,9 @@ sys.setrecursionlimit(100000)
 #to pass to the category code when there are no jets
 dummyfloatstar = array('f', [0])
 
+#read with getattr, so their names don't appear anywhere in this file
+m4lsystematics = ["p_m4l_{}_{}{}".format(a, b, c) for a in ("SIG", "BKG") for b in ("Scale", "Res") for c in ("Up", "Down")]
+
 class TreeWrapperBase(Iterator):
     def __init__(self, treesample, minevent=0, maxevent=None):
         self.treesample = treesample
@@ -1536,40 +1542,26 @@ class TreeWrapper(TreeWrapperBase):
         return super(TreeWrapper, self).isdummy
 
     def __iter__(self):
-        self.__i = 0                               #at the beginning of next self.__i and self.__treeentry are
-        self.__treeentry = self.minevent-1         # incremented, so they start at 1 and self.minevent
-        return super(TreeWrapper, self).__iter__() # for the first entry
+        self.__i = 0                               #incremented at the beginning of next, so it starts at 1
+        self.__entries = self.selectedentries()
+        return super(TreeWrapper, self).__iter__()
 
     def next(self):
-        while True:
-            self.__i += 1
-            self.__treeentry += 1
-            i, t = self.__i, self.tree
-            t.GetEntry(self.__treeentry)
-            if i > len(self):
-                raise StopIteration
-            if i % self.printevery == 0 or i == len(self):
-                print i, "/", len(self)
-                #raise StopIteration
-
-            if self.isdata:
-                self.overallEventWeight = 1
-            elif self.isZX:
-                CRflag = t.CRflag
-                if CRflag and ZX.test_bit(CRflag, ZX.CRZLLss):
-                    self.overallEventWeight = 1
-                else:
-                    self.overallEventWeight = 0
-            else:
-                self.overallEventWeight = t.overallEventWeight
-
-            if self.doSIP and max(t.LepSIP) > 4: self.overallEventWeight = 0
-            if self.doZ2Mass and t.Z2Mass < 4: self.overallEventWeight = 0
-
-            self.flavor = abs(t.Z1Flav*t.Z2Flav)
+        self.__i += 1
+        i, t = self.__i, self.tree
+        if i > len(self):
+            raise StopIteration
+        t.GetEntry(self.__entries[i-1])
+        if i % self.printevery == 0 or i == len(self):
+            print i, "/", len(self)
+
+        #the selection is in selectedentries
+        if self.isdata or self.isZX:
+            self.overallEventWeight = 1
+        else:
+            self.overallEventWeight = t.overallEventWeight
 
-            if self.overallEventWeight:
-                break
+        self.flavor = abs(t.Z1Flav*t.Z2Flav)
 
         #I prefer this to defining __getattr__ because it's faster
         self.ZZMass = t.ZZMass
@@ -1577,20 +1569,17 @@ class TreeWrapper(TreeWrapperBase):
         self.ZZEta = t.ZZEta
         Hvector = tlvfromptetaphim(self.ZZPt, self.ZZEta, t.ZZPhi, self.ZZMass)
 
-        self.cconstantforDbkgkin = CJLSTscripts.getDbkgkinConstant(self.flavor, self.ZZMass)
-        self.cconstantforDbkg = CJLSTscripts.getDbkgConstant(self.flavor, self.ZZMass)
-        self.cconstantforD2jet = CJLSTscripts.getDVBF2jetsConstant_shiftWP(self.ZZMass, config.useQGTagging, 0.5)
-        self.cconstantforDHadWH = CJLSTscripts.getDWHhConstant_shiftWP(self.ZZMass, config.useQGTagging, 0.5)
-        self.cconstantforDHadZH = CJLSTscripts.getDZHhConstant_shiftWP(self.ZZMass, config.useQGTagging, 0.5)
+        self.cconstantforDbkgkin = constanttables.cconstantforDbkgkin(self.flavor, self.ZZMass)
+        self.cconstantforDbkg = constanttables.cconstantforDbkg(self.flavor, self.ZZMass)
+        self.cconstantforD2jet = constanttables.cconstantforD2jet(self.ZZMass)
+        self.cconstantforDHadWH = constanttables.cconstantforDHadWH(self.ZZMass)
+        self.cconstantforDHadZH = constanttables.cconstantforDHadZH(self.ZZMass)
 
         self.p_m4l_BKG = t.p_m4l_BKG
         self.p_m4l_SIG = t.p_m4l_SIG
 
-        for a in "SIG", "BKG":
-            for b in "Scale", "Res":
-                for c in "Up", "Down":
-                    attr = "p_m4l_{}_{}{}".format(a, b, c)
-                    setattr(self, attr, getattr(t, attr))
+        for attr in m4lsystematics:
+            setattr(self, attr, getattr(t, attr))
 
         #express in terms of |M|^2, this will make life easier
         self.M2qqZZ = t.p_QQB_BKG_MCFM
@@ -2369,8 +2358,12 @@ class TreeWrapper(TreeWrapperBase):
 
         return self
 
+    @property
     @cache_instancemethod
-    def __len__(self):
+    def nentries(self):
+        """
+        Number of entries in the tree between minevent and maxevent, before the selection
+        """
         if self.isdummy:
             return 0
         elif self.maxevent is None or self.maxevent >= self.tree.GetEntries():
@@ -2378,9 +2371,88 @@ class TreeWrapper(TreeWrapperBase):
         else:
             return self.maxevent - self.minevent + 1
 
+    @cache_instancemethod
+    def selectedentries(self):
+        """
+        Entry numbers of the events between minevent and maxevent that pass the selection,
+        except for the blinding, which is done in next().
+        This uses TTree::Draw, which only reads the branches in the selection,
+        so that next() only has to GetEntry the events that pass.
+        """
+        if not self.nentries:
+            return []
+
+        cuts = []
+        if self.isZX:
+            cuts.append("(CRflag >> {}) & 1".format(ZX.CRZLLss))
+        elif not self.isdata:
+            cuts.append("overallEventWeight != 0")
+        if self.doSIP: cuts.append("!(Max$(LepSIP) > 4)")
+        if self.doZ2Mass: cuts.append("!(Z2Mass < 4)")
+        selection = " && ".join("({})".format(_) for _ in cuts) or "1"
+
+        #make the TEntryList in memory, not in whatever file is open
+        bkpdirectory = ROOT.gDirectory.GetDirectory(ROOT.gDirectory.GetPath())
+        ROOT.gROOT.cd()
+        try:
+            name = "selectedentries_{}".format(id(self))
+            self.tree.Draw(">>"+name, selection, "entrylist", self.nentries, self.minevent)
+            entrylist = ROOT.gDirectory.Get(name)
+            result = [entrylist.GetEntry(i) for i in xrange(entrylist.GetN())]
+            ROOT.SetOwnership(entrylist, True)
+            del entrylist
+        finally:
+            bkpdirectory.cd()
+
+        print "{} out of {} entries pass the selection".format(len(result), self.nentries)
+        return result
+
+    @cache_instancemethod
+    def __len__(self):
+        """
+        Number of events that pass the selection (before the blinding)
+        """
+        return len(self.selectedentries())
+
     def Show(self, *args, **kwargs):
         self.tree.Show(*args, **kwargs)
 
+    @cache_instancemethod
+    def inputbranches(self, names=None):
+        """
+        The branches of the input tree that the discriminants in names (default all of them) read while iterating,
+        directly or through the statements of next() that set up their variables (see sourcedependencies.py),
+        plus the ones whose names are built on the fly.
+        """
+        if names is None: names = self.toaddtotree + self.toaddtotree_int + self.toaddtotree_float
+        words = usednames(type(self), tuple(names))
+        words.update(self.kfactors)
+        words.update(m4lsystematics)
+        return sorted(branch.GetName() for branch in self.tree.GetListOfBranches() if branch.GetName() in words)
+
+    def prunebranches(self, names=None):
+        """
+        Only read inputbranches(names) on GetEntry, with a TTreeCache big enough for one cluster of them.
+        Don't call this if you need all the branches, e.g. to clone the tree.
+        """
+        t = self.tree
+        branches = self.inputbranches(None if names is None else tuple(names))
+        t.SetBranchStatus("*", 0)
+        for branch in branches:
+            t.SetBranchStatus(branch, 1)
+
+        nentries = max(t.GetEntries(), 1)
+        entriespercluster = t.GetAutoFlush()
+        if entriespercluster <= 0 or entriespercluster > nentries: entriespercluster = nentries
+        zipbytes = sum(t.GetBranch(branch).GetZipBytes() for branch in branches)
+        t.SetCacheSize(max(int(1.2 * zipbytes * entriespercluster / nentries), 1000000))
+        for branch in branches:
+            t.AddBranchToCache(branch, True)
+        t.StopCacheLearningPhase()
+
+        print "reading {} out of {} branches from {}".format(len(branches), t.GetListOfBranches().GetEntries(), self.filename)
+        logging.debug("branches: " + " ".join(branches))
+
 ##########
 #Category#
 ##########
@@ -2603,6 +2675,7 @@ class TreeWrapper(TreeWrapperBase):
             "initcategoryfunctions",
             "initlists",
             "initsystematics",
+            "inputbranches",
             "isdata",
             "isdummy",
             "isggZZoffshell",
@@ -2610,6 +2683,7 @@ class TreeWrapper(TreeWrapperBase):
             "kfactors",
             "maxevent",
             "minevent",
+            "nentries",
             "nevents",
             "nevents2e2mu",
             "next",
@@ -2617,6 +2691,8 @@ class TreeWrapper(TreeWrapperBase):
             "per_event_scale_factor",
             "printevery",
             "productionmode",
+            "prunebranches",
+            "selectedentries",
             "toaddtotree",
             "toaddtotree_float",
             "toaddtotree_int",
@@ -2773,10 +2849,12 @@ class TreeWrapper(TreeWrapperBase):
 
     passesblindcut = config.blindcut
 
-def TreeWrapperFactory(treesample, minevent=0, maxevent=None, LSF=Fake_LSF_creating()):
+def TreeWrapperFactory(treesample, minevent=0, maxevent=None, LSF=Fake_LSF_creating(), nprocesses=1, nsmearings=None, smearingseed=0):
+    """
+    nprocesses is the number of processes to calculate the MELA probabilities in, for LHE samples
+    nsmearings and smearingseed are for LHE samples too, see LHEWrapper
+    """
     if treesample.production.LHE:
         from lhewrapper import LHEWrapper
-        cls = LHEWrapper
-    else:
-        cls = TreeWrapper
-    return cls(treesample, minevent=minevent, maxevent=maxevent, LSF=LSF)
+        return LHEWrapper(treesample, minevent=minevent, maxevent=maxevent, nprocesses=nprocesses, nsmearings=nsmearings, smearingseed=smearingseed)
+    return TreeWrapper(treesample, minevent=minevent, maxevent=maxevent, LSF=LSF)
@@ -1077,8 +1077,23 @@ def withdiscriminantsfileisvalid(filename):
   with TFile(filename) as f:
     if (not f) or (f.candTree.GetEntries() == 0):
       return False
+    #written with step2_adddiscriminants.py --friend: the CJLST tree has to be there too
+    friends = f.candTree.GetListOfFriends()
+    if friends and not all(friend.GetTree() for friend in friends):
+      return False
   return True
 
+@cache
+def isfriendfile(filename):
+  """
+  Written with step2_adddiscriminants.py --friend: it has an entry for every entry in the CJLST tree,
+  and only the ones with step2selected pass the step2 selection
+  """
+  if not os.path.exists(filename):
+    return False
+  with TFile(filename) as f:
+    return bool(f.Get("candTree") and f.candTree.GetBranch("step2selected"))
+
 class WriteOnceDict(dict):
     def __init__(self, messagefmt="{key} has already been set"):
         self.messagefmt = messagefmt
@@ -216,7 +216,42 @@ class YieldSystematicValue(MultiEnum, JsonDict):
             return None
         return type(self)(*kwargs.itervalues())
 
-def count(fromsamples, tosamples, categorizations, alternateweights):
+def categoryhistograms(t, GEN, categorizations, alternateweights, chunksize=100000):
+    """
+    Recalculates the categories with batchcategorization instead of using the category branches
+    from step 2, reading the tree once in chunks.  Returns {(categorization, alternateweight): h},
+    where h is filled with category:abs(Z1Flav*Z2Flav) the same way as the TTree::Draw in count.
+    """
+    from batchcategorization import BatchCategorization
+    from columnar import CategoryVariables, ChunkReader
+
+    result = {}
+    for categorization, alternateweight in itertools.product(categorizations, alternateweights):
+        if alternateweight.issystematic and categorization.issystematic: continue
+        h = result[categorization, alternateweight] = ROOT.TH2F(
+            "h_{}_{}".format(categorization.category_function_name, alternateweight), "",
+            200, 0, 200, len(categories), -0.5, len(categories)-0.5,
+        )
+        h.SetDirectory(0)
+        h.Sumw2()
+
+    length = t.GetEntries()
+    for start in xrange(0, length, chunksize):
+        reader = ChunkReader(t, start, min(start+chunksize, length))
+        flavor = np.asarray(abs(reader["Z1Flav"]*reader["Z2Flav"]), dtype=np.float64)
+        batch = BatchCategorization(CategoryVariables(reader.__getitem__, len(reader), GEN))
+        for (categorization, alternateweight), h in result.iteritems():
+            category = np.asarray(batch[categorization], dtype=np.float64)
+            weight = np.asarray(reader["MC_weight_nominal*(ZZMass>{} && ZZMass<{})*{}".format(config.m4lmin, config.m4lmax, alternateweight.weightname)], dtype=np.float64)
+            h.FillN(len(reader), flavor, category, weight)
+
+    return result
+
+def count(fromsamples, tosamples, categorizations, alternateweights, recalculatecategories=False):
+    """
+    If recalculatecategories is True, the categories are calculated again with batchcategorization
+    (see categoryhistograms) instead of being read from the category branches written in step 2.
+    """
     assert len(tosamples) == 1
     GEN = {_.production.GEN for _ in fromsamples}
     assert len(GEN) == 1
@@ -230,6 +265,9 @@ def count(fromsamples, tosamples, categorizations, alternateweights):
         t.Add(fromsample.withdiscriminantsfile())
     length = t.GetEntries()
     result = MultiplyCounter()
+    if recalculatecategories:
+        #before the branch statuses are set, because this needs the inputs of the categorizations
+        histograms = categoryhistograms(t, GEN, categorizations, alternateweights)
     t.SetBranchStatus("*", 0)
     t.SetBranchStatus("category_*", 1)
     t.SetBranchStatus("MC_weight_*", 1)
@@ -262,8 +300,11 @@ def count(fromsamples, tosamples, categorizations, alternateweights):
         try:
             if productionmode == "WH" and tosample.hypothesis == "L1Zg": continue
             if alternateweight.issystematic and categorization.issystematic: continue
-            t.Draw(categorization.category_function_name+":abs(Z1Flav*Z2Flav)", "MC_weight_nominal*(ZZMass>{} && ZZMass<{})*{}".format(config.m4lmin, config.m4lmax, alternateweight.weightname), "LEGO")
-            h = c.FindObject("htemp")
+            if recalculatecategories:
+                h = histograms[categorization, alternateweight]
+            else:
+                t.Draw(categorization.category_function_name+":abs(Z1Flav*Z2Flav)", "MC_weight_nominal*(ZZMass>{} && ZZMass<{})*{}".format(config.m4lmin, config.m4lmax, alternateweight.weightname), "LEGO")
+                h = c.FindObject("htemp")
             t.GetEntry(0)
             if not isinstance(h, ROOT.TH1):
                 if productionmode == "TTWW": continue
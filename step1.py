@@ -68,3 +68,10 @@ except ImportError:
   print "Installing uncertainties..."
   with utilities.cd("CMSSW_10_2_5"):
     subprocess.check_call("eval $(scram ru -sh) && pip install --user uncertainties", shell=True)
+
+try:
+  import root_numpy
+except ImportError:
+  print "Installing root_numpy..."
+  with utilities.cd("CMSSW_10_2_5"):
+    subprocess.check_call("eval $(scram ru -sh) && pip install --user root_numpy", shell=True)
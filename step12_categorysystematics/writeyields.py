@@ -11,6 +11,7 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("--productionmode", action="append", type=__ProductionMode)
   parser.add_argument("--production", action="append", type=__Production)
+  parser.add_argument("--recalculatecategories", action="store_true", help="calculate the categories again with batchcategorization instead of using the category branches from step 2")
   args = parser.parse_args()
 
 from collections import namedtuple
@@ -38,7 +39,7 @@ from categorysystematics import findsystematic
 
 SampleCount = namedtuple("SampleCount", "productionmode samples")
 
-def writeyields(productionmodelist=None, productionlist=None):
+def writeyields(productionmodelist=None, productionlist=None, recalculatecategories=False):
   for production in sorted({_.productionforrate for _ in productions if not _.LHE}):
     if productionlist and production not in productionlist: continue
     print "Finding yields and category systematics for", production
@@ -122,7 +123,7 @@ def writeyields(productionmodelist=None, productionlist=None):
         tmpresults = []
         for tosample in usesamples:
           usealternateweights = Sample(tosample, production).alternateweights
-          tmpresults.append(count({Sample(tosample, production)}, {tosample}, categorizations, usealternateweights))
+          tmpresults.append(count({Sample(tosample, production)}, {tosample}, categorizations, usealternateweights, recalculatecategories=recalculatecategories))
 
         try:
           result += MultiplyCounter({
@@ -416,4 +417,4 @@ def writeyields_LHE():
 
 if __name__ == "__main__":
   writeyields_LHE()
-  writeyields(productionmodelist=args.productionmode, productionlist=args.production)
+  writeyields(productionmodelist=args.productionmode, productionlist=args.production, recalculatecategories=args.recalculatecategories)
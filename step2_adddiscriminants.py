@@ -12,27 +12,58 @@ if __name__ == "__main__":
   p.add_argument("--submitjobs", action="store_true")
   p.add_argument("--filter", type=stringandlambda, default=None)
   p.add_argument("--skipxcheck", dest="doxcheck", action="store_false")
+  p.add_argument("--engine", choices=("legacy", "kernel", "columnar"), default="legacy", help="kernel: calculate all the discriminants in one generated function (helperstuff/kernel.py), not validated on full samples yet, check with --validatekernel first.  columnar: read the tree in chunks and calculate the discriminants as numpy arrays, check with --validatecolumnar first")
+  p.add_argument("--chunksize", type=int, default=10000, help="number of entries per chunk for --engine columnar")
+  p.add_argument("--friend", action="store_true", help="only write the new branches, with the CJLST tree as a friend (MC only, data is always written in full)")
+  p.add_argument("--incremental", action="store_true", help="for files that already exist, only calculate discriminants that are missing or whose code changed")
+  p.add_argument("--nshards", type=int, default=1, help="split each sample into this many event ranges, which can run in separate jobs or processes and are merged at the end")
+  p.add_argument("--nprocesses", type=int, default=1, help="number of local processes to run the shards of a sample in, or for LHE samples, to calculate the MELA probabilities in")
+  p.add_argument("--validatecolumnar", type=int, metavar="NEVENTS", help="instead of making the files, compare the columnar and legacy discriminants for the first NEVENTS entries of each sample")
+  p.add_argument("--validatekernel", type=int, metavar="NEVENTS", help="instead of making the files, compare the kernel and legacy discriminants for the first NEVENTS entries of each sample")
+  p.add_argument("--nsmearings", type=int, help="for LHE samples: smear each event this many times in one pass, with a smearingreplica branch to tell them apart.  The files get a _smearings suffix.")
+  p.add_argument("--smearingseed", type=int, default=0, help="seed for --nsmearings")
   args = p.parse_args()
+  if args.nsmearings is not None and args.submitjobs:
+    p.error("--nsmearings only works locally")
 
 from array import array
 from collections import OrderedDict
+from itertools import izip
 from helperstuff import config
+from helperstuff import sourcedependencies
 from helperstuff import xrd
+from helperstuff.hadd import hadd
 from helperstuff.enums import hffhypotheses, ProductionMode, productions, pythiasystematics
 from helperstuff.samples import allsamples, Sample
 from helperstuff.submitjob import submitjob
 from helperstuff.treewrapper import TreeWrapper, TreeWrapperFactory
-from helperstuff.utilities import cdtemp_slurm, cleanupscratchdir, deletemelastuff, KeepWhileOpenFile, LSB_JOBID, LSF_creating, mkdir_p
+from helperstuff.utilities import cdtemp_slurm, cleanupscratchdir, deletemelastuff, KeepWhileOpenFile, LSB_JOBID, LSF_creating, mkdir_p, TFile
+import functools
+import json
+import multiprocessing
 import os
 import pipes
 import ROOT
 import sys
+import traceback
 
-def adddiscriminants(*args):
+def adddiscriminants(*args, **kwargs):
+  engine = kwargs.pop("engine", "legacy")
+  chunksize = kwargs.pop("chunksize", 10000)
+  nshards = kwargs.pop("nshards", 1)
+  nprocesses = kwargs.pop("nprocesses", 1)
+  friend = kwargs.pop("friend", False)
+  incremental = kwargs.pop("incremental", False)
+  nsmearings = kwargs.pop("nsmearings", None)
+  smearingseed = kwargs.pop("smearingseed", 0)
+  assert not kwargs, kwargs
 
   sample = Sample(*args)
 
   newfilename = sample.withdiscriminantsfile()
+  if nsmearings is not None:
+    if not sample.production.LHE: return
+    newfilename = smearingsfilename(newfilename, nsmearings, smearingseed)
   print newfilename
   mkdir_p(os.path.dirname(newfilename))
 
@@ -41,6 +72,132 @@ def adddiscriminants(*args):
       raise ValueError("{} exists, why not use it?".format(sample.CJLSTfile()))
     return
 
+  if nsmearings is not None:
+    return makefile(sample, newfilename, engine=engine, nprocesses=nprocesses, nsmearings=nsmearings, smearingseed=smearingseed)
+
+  if incremental and os.path.exists(newfilename):
+    return updatefile(sample, newfilename, engine=engine, chunksize=chunksize)
+
+  if nshards > 1:
+    shards = eventranges(sample, nshards)
+    if shards is not None:
+      return addshardeddiscriminants(sample, shards, engine=engine, chunksize=chunksize, nprocesses=nprocesses, friend=friend)
+
+  makefile(sample, newfilename, engine=engine, chunksize=chunksize, friend=friend, nprocesses=nprocesses)
+
+def smearingsfilename(newfilename, nsmearings, smearingseed):
+  return newfilename.replace(".root", "_{}smearings_seed{}.root".format(nsmearings, smearingseed))
+
+def makebranches(newt, treewrapper, names=None):
+  """
+  Makes a branch in newt for each discriminant of treewrapper (or only the ones in names).
+  Returns an OrderedDict of name: buffer and a list of the branches.
+  """
+  discriminants = OrderedDict()
+  branches = []
+  for lst, typecode, leaftype in (
+    (treewrapper.toaddtotree, 'd', "D"),
+    (treewrapper.toaddtotree_int, 'i', "I"),
+    (treewrapper.toaddtotree_float, 'f', "F"),
+  ):
+    for discriminant in lst:
+      if names is not None and discriminant not in names: continue
+      discriminants[discriminant] = array(typecode, [0])
+      branches.append(newt.Branch(discriminant, discriminants[discriminant], discriminant + "/" + leaftype))
+  return discriminants, branches
+
+def iterdiscriminants(treewrapper, discriminants, engine, chunksize):
+  """
+  Sets the buffers in discriminants for each event that passes the selection
+  and yields the entry number in the CJLST tree
+  """
+  if engine == "columnar":
+    from helperstuff.columnar import ColumnarTreeWrapper
+    for entry in ColumnarTreeWrapper(treewrapper, chunksize=chunksize).iterfill(discriminants):
+      yield entry
+    return
+
+  if engine == "kernel" and isinstance(treewrapper, TreeWrapper):
+    from helperstuff.kernel import Kernel
+    kernel = None
+    buffers = discriminants.values()
+    for _ in treewrapper:
+      if kernel is None:
+        kernel = Kernel(treewrapper, discriminants)
+      try:
+        values = kernel(treewrapper)
+      except:
+        #find which one it was
+        for discriminant in discriminants:
+          try:
+            getattr(treewrapper, discriminant)()
+          except:
+            print "Error while calculating", discriminant
+            raise
+        raise
+      for buffer, value in izip(buffers, values):
+        buffer[0] = value
+      yield treewrapper.tree.GetReadEntry()
+    return
+
+  for _ in treewrapper:
+    for discriminant in discriminants:
+      try:
+        discriminants[discriminant][0] = getattr(treewrapper, discriminant)()
+      except:
+        print "Error while calculating", discriminant
+        raise
+    yield treewrapper.tree.GetReadEntry() if isinstance(treewrapper, TreeWrapper) else None
+
+def fillskipped(fill, discriminants, selected, nskipped):
+  """
+  For friend trees: fill entries for the events in the CJLST tree that were skipped,
+  with everything (including MC_weight_nominal) set to 0
+  """
+  if nskipped <= 0: return
+  values = [(buffer, buffer[0]) for buffer in discriminants.values()]
+  for buffer in discriminants.values():
+    buffer[0] = 0
+  selected[0] = 0
+  for i in xrange(nskipped):
+    fill()
+  for buffer, value in values:
+    buffer[0] = value
+  selected[0] = 1
+
+def filltree(treewrapper, discriminants, fill, engine, chunksize, selected=None, touch=None):
+  """
+  Calls fill() for each event, after setting the discriminants.
+  For friend trees, selected is the step2selected buffer, and the events that are skipped are filled too.
+  Returns the number of times fill() was called.
+  """
+  nextentry = treewrapper.minevent
+  nfilled = 0
+  for i, entry in enumerate(iterdiscriminants(treewrapper, discriminants, engine, chunksize), start=1):
+    if selected is not None:
+      fillskipped(fill, discriminants, selected, entry - nextentry)
+      nfilled += max(entry - nextentry, 0)
+      nextentry = entry + 1
+    fill()
+    nfilled += 1
+    if i % 50000 == 0 and LSB_JOBID() and touch is not None:
+      with open(touch): pass                   #access it, hopefully preventing tmp from being deleted
+      with open("touch.txt", "w") as f: pass  #touch another file, same idea
+  if selected is not None:
+    nskipped = treewrapper.minevent + treewrapper.nentries - nextentry
+    fillskipped(fill, discriminants, selected, nskipped)
+    nfilled += max(nskipped, 0)
+  return nfilled
+
+def sourcehash(treewrapper, name):
+  """
+  Hash of the code that calculates a discriminant: the function, whatever it calls or refers to,
+  the config settings and other globals it uses, and the parts of next() that set up its variables.
+  See helperstuff/sourcedependencies.py.
+  """
+  return sourcedependencies.sourcehash(type(treewrapper), name)
+
+def makefile(sample, newfilename, engine="legacy", chunksize=10000, minevent=0, maxevent=None, friend=False, nprocesses=1, nsmearings=None, smearingseed=0):
   inputfiles = []
   if xrd.exists(sample.CJLSTfile()): inputfiles.append(sample.CJLSTfile())
 
@@ -52,7 +209,16 @@ def adddiscriminants(*args):
 
     with LSF_creating(newfilename, ignorefailure=True, inputfiles=inputfiles) as LSF:
 
-      treewrapper = TreeWrapperFactory(sample, LSF=LSF)
+      treewrapper = TreeWrapperFactory(sample, minevent=minevent, maxevent=maxevent, LSF=LSF, nprocesses=nprocesses, nsmearings=nsmearings, smearingseed=smearingseed)
+      if engine == "columnar" and not isinstance(treewrapper, TreeWrapper):
+        print "The columnar engine doesn't work for {}, using the legacy one".format(type(treewrapper).__name__)
+        engine = "legacy"
+      if friend and (not isinstance(treewrapper, TreeWrapper) or treewrapper.isdummy or treewrapper.isdata):
+        print "Writing the full tree for {}".format(sample)
+        friend = False
+      if friend:
+        #for the full tree, every branch is read anyway to copy it
+        treewrapper.prunebranches()
 
       if os.path.exists(newfilename):
         return
@@ -60,34 +226,27 @@ def adddiscriminants(*args):
       failed = False
       try:
         newf = ROOT.TFile.Open(LSF.basename(newfilename), "recreate")
-        if isinstance(treewrapper, TreeWrapper):
+        if friend:
+          #one entry for every entry in the CJLST tree, so that it can be a friend without an index
+          newt = ROOT.TTree("candTree", "candTree")
+          CJLSTtree = "{}/candTree".format(sample.TDirectoryname())
+          ROOT.TNamed("CJLSTfile", sample.CJLSTfile()).Write()
+          ROOT.TNamed("CJLSTtree", CJLSTtree).Write()
+          if minevent == 0 and maxevent is None:
+            #for shards, this happens when they're merged
+            newt.AddFriend("CJLST="+CJLSTtree, sample.CJLSTfile())
+          selected = array('i', [1])
+          newt.Branch("step2selected", selected, "step2selected/I")
+        elif isinstance(treewrapper, TreeWrapper):
           newt = treewrapper.tree.CloneTree(0)
         else:
           newt = ROOT.TTree("candTree", "candTree")
 
-        discriminants = OrderedDict()
-        for discriminant in treewrapper.toaddtotree:
-          discriminants[discriminant] = array('d', [0])
-          newt.Branch(discriminant, discriminants[discriminant], discriminant + "/D")
-        for discriminant in treewrapper.toaddtotree_int:
-          discriminants[discriminant] = array('i', [0])
-          newt.Branch(discriminant, discriminants[discriminant], discriminant + "/I")
-        for discriminant in treewrapper.toaddtotree_float:
-          discriminants[discriminant] = array('f', [0])
-          newt.Branch(discriminant, discriminants[discriminant], discriminant + "/F")
+        discriminants, branches = makebranches(newt, treewrapper)
+        ROOT.TNamed("step2sourcehashes", json.dumps({name: sourcehash(treewrapper, name) for name in discriminants})).Write()
 
         try:
-          for i, entry in enumerate(treewrapper, start=1):
-            for discriminant in discriminants:
-              try:
-                discriminants[discriminant][0] = getattr(treewrapper, discriminant)()
-              except:
-                print "Error while calculating", discriminant
-                raise
-            newt.Fill()
-            if i % 50000 == 0 and LSB_JOBID():
-              with open(LSF.basename(newfilename)): pass #access it, hopefully preventing tmp from being deleted
-              with open("touch.txt", "w") as f:     pass #touch another file, same idea
+          filltree(treewrapper, discriminants, newt.Fill, engine, chunksize, selected=selected if friend else None, touch=LSF.basename(newfilename))
         except:
           treewrapper.Show()
           raise
@@ -102,15 +261,191 @@ def adddiscriminants(*args):
           failed = True
         if failed:
           try:
-            os.remove(newfilename)
+            os.remove(LSF.basename(newfilename))
           except:
             pass
 
-def submitjobs(filter=None, doxcheck=True):
+def updatefile(sample, newfilename, engine="legacy", chunksize=10000):
+  """
+  Adds the discriminants that are missing from newfilename, and replaces the ones
+  whose source hash changed.  The rest of the file is copied without decompressing it.
+  """
+  inputfiles = [newfilename]
+  if xrd.exists(sample.CJLSTfile()): inputfiles.append(sample.CJLSTfile())
+
+  with cdtemp_slurm(), KeepWhileOpenFile(newfilename+".tmp") as kwof:
+    if not kwof:
+      return
+
+    with LSF_creating(newfilename, inputfiles=inputfiles) as LSF:
+      treewrapper = TreeWrapperFactory(sample, LSF=LSF)
+      if engine == "columnar" and not isinstance(treewrapper, TreeWrapper):
+        engine = "legacy"
+
+      with TFile(LSF.basename(newfilename)) as f:
+        t = f.candTree
+        existing = {branch.GetName() for branch in t.GetListOfBranches()}
+        friend = bool(f.Get("CJLSTfile"))
+        oldhashes = json.loads(f.step2sourcehashes.GetTitle()) if f.Get("step2sourcehashes") else {}
+
+        hashes = {}
+        tocalculate = []
+        for name in treewrapper.toaddtotree + treewrapper.toaddtotree_int + treewrapper.toaddtotree_float:
+          hashes[name] = sourcehash(treewrapper, name)
+          if name not in existing:
+            tocalculate.append(name)
+          elif hashes[name] != oldhashes.get(name, hashes[name]):
+            #if there's no hash stored, assume the branch is up to date
+            tocalculate.append(name)
+
+        if not tocalculate and hashes == oldhashes:
+          return
+        print "calculating", ", ".join(tocalculate) if tocalculate else "nothing, only updating the hashes"
+
+        if isinstance(treewrapper, TreeWrapper) and not treewrapper.isdummy:
+          #the rest of the file is copied from newfilename, so only the inputs of these have to be read
+          treewrapper.prunebranches(tocalculate)
+
+        updatedfilename = LSF.basename(newfilename).replace(".root", "_incremental.root")
+        try:
+          for name in tocalculate:
+            if name in existing:
+              t.SetBranchStatus(name, 0)
+          with TFile(updatedfilename, "recreate") as newf:
+            newt = t.CloneTree(-1, "fast")
+            for name in "CJLSTfile", "CJLSTtree":
+              if f.Get(name): f.Get(name).Clone().Write()
+            if friend and not newt.GetListOfFriends():
+              newt.AddFriend("CJLST="+f.CJLSTtree.GetTitle(), f.CJLSTfile.GetTitle())
+            ROOT.TNamed("step2sourcehashes", json.dumps(hashes)).Write()
+
+            discriminants, branches = makebranches(newt, treewrapper, tocalculate)
+            def fill():
+              for branch in branches:
+                branch.Fill()
+            try:
+              nfilled = filltree(treewrapper, discriminants, fill, engine, chunksize, selected=array('i', [1]) if friend else None, touch=LSF.basename(newfilename))
+            except:
+              treewrapper.Show()
+              raise
+            if tocalculate and nfilled != newt.GetEntries():
+              raise ValueError("{} has {} entries, but {} events were selected now.  Did the selection change?".format(newfilename, newt.GetEntries(), nfilled))
+          os.rename(updatedfilename, LSF.basename(newfilename))
+        except:
+          try:
+            os.remove(updatedfilename)
+          except OSError:
+            pass
+          raise
+
+def eventranges(sample, nshards):
+  """
+  Splits the sample's tree into nshards (minevent, maxevent) ranges.
+  Returns None if the sample can't be split, in which case it's done in one go.
+  """
+  if sample.production.LHE or not xrd.exists(sample.CJLSTfile()):
+    return None
+  with TFile(sample.CJLSTfile()) as f:
+    t = f.Get("{}/candTree".format(sample.TDirectoryname()))
+    if not t:
+      return None
+    nentries = t.GetEntries()
+  boundaries = [nentries * i // nshards for i in range(nshards+1)]
+  return [(minevent, maxevent-1) for minevent, maxevent in zip(boundaries[:-1], boundaries[1:])]
+
+def shardfilename(sample, shard, nshards):
+  newfilename = sample.withdiscriminantsfile()
+  return os.path.join(os.path.dirname(newfilename), "shards", os.path.basename(newfilename).replace(".root", "_{}of{}.root".format(shard+1, nshards)))
+
+def makeshard(shardargs, **kwargs):
+  try:
+    sample, shard, nshards, minevent, maxevent = shardargs
+    makefile(sample, shardfilename(sample, shard, nshards), minevent=minevent, maxevent=maxevent, **kwargs)
+  except:
+    raise Exception("".join(traceback.format_exception(*sys.exc_info())))
+
+def addshardeddiscriminants(sample, shards, nprocesses=1, **kwargs):
+  newfilename = sample.withdiscriminantsfile()
+  if os.path.exists(newfilename):
+    return
+
+  nshards = len(shards)
+  shardfilenames = [shardfilename(sample, shard, nshards) for shard in range(nshards)]
+  mkdir_p(os.path.dirname(shardfilenames[0]))
+
+  arglist = [(sample, shard, nshards, minevent, maxevent) for shard, (minevent, maxevent) in enumerate(shards) if not os.path.exists(shardfilenames[shard])]
+  if nprocesses > 1 and len(arglist) > 1:
+    pool = multiprocessing.Pool(processes=min(nprocesses, len(arglist)))
+    try:
+      pool.map(functools.partial(makeshard, **kwargs), arglist)
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+  else:
+    for shardargs in arglist:
+      makeshard(shardargs, **kwargs)
+
+  if not shardsfinished(shardfilenames):
+    #some are still running in other jobs, the last one to finish will merge
+    return
+
+  if mergeshards(newfilename, shardfilenames):
+    for _ in shardfilenames:
+      os.remove(_)
+
+def shardsfinished(shardfilenames):
+  """
+  Outside of batch jobs the shards are written in place, so a shard can exist
+  while another process is still writing it.  It's only finished once its lock is free.
+  """
+  return all(os.path.exists(_) and KeepWhileOpenFile(_+".tmp").wouldbevalid for _ in shardfilenames)
+
+def mergeshards(newfilename, shardfilenames):
+  """
+  hadds the shards into a temporary file and then renames it,
+  so that newfilename is never there until it's complete
+  """
+  with cdtemp_slurm(), KeepWhileOpenFile(newfilename+".tmp") as kwof:
+    if not kwof:
+      return False
+    if os.path.exists(newfilename):
+      return False
+    if not shardsfinished(shardfilenames):
+      return False
+
+    with LSF_creating(newfilename, inputfiles=shardfilenames) as LSF:
+      mergedfilename = LSF.basename(newfilename).replace(".root", "_merging.root")
+      try:
+        if os.path.exists(mergedfilename): os.remove(mergedfilename)
+        hadd(mergedfilename, *(LSF.basename(_) for _ in shardfilenames))
+        with TFile(mergedfilename, "update") as f:
+          if f.Get("CJLSTfile"):
+            t = f.candTree
+            t.AddFriend("CJLST="+f.CJLSTtree.GetTitle(), f.CJLSTfile.GetTitle())
+            t.Write("", ROOT.TObject.kOverwrite)
+        os.rename(mergedfilename, LSF.basename(newfilename))
+      except:
+        try:
+          os.remove(mergedfilename)
+        except OSError:
+          pass
+        raise
+
+  return True
+
+def submitjobs(filter=None, doxcheck=True, engine="legacy", chunksize=10000, nshards=1, friend=False):
   njobs = 0
   for sample in allsamples(doxcheck=doxcheck):
     if filter and not filter.function(sample): continue
-    if not os.path.exists(sample.withdiscriminantsfile()) and KeepWhileOpenFile(sample.withdiscriminantsfile()+".tmp").wouldbevalid:
+    if os.path.exists(sample.withdiscriminantsfile()): continue
+    if nshards > 1 and not sample.copyfromothersample and eventranges(sample, nshards) is not None:
+      njobs += sum(
+        1 for shard in range(nshards)
+          if not os.path.exists(shardfilename(sample, shard, nshards))
+          and KeepWhileOpenFile(shardfilename(sample, shard, nshards)+".tmp").wouldbevalid
+      )
+    elif KeepWhileOpenFile(sample.withdiscriminantsfile()+".tmp").wouldbevalid:
       njobs += 1
   for i in range(njobs):
     submitjobkwargs = {"jobname": str(i), "jobtime": "1-0:0:0"}
@@ -121,23 +456,43 @@ def submitjobs(filter=None, doxcheck=True):
     job = ["unbuffer", os.path.join(config.repositorydir, "step2_adddiscriminants.py")]
     if filter:
       job += ["--filter", filter.string]
+    if engine != "legacy":
+      job += ["--engine", engine]
+    if engine == "columnar":
+      job += ["--chunksize", str(chunksize)]
+    if nshards > 1:
+      job += ["--nshards", str(nshards)]
+    if friend:
+      job += ["--friend"]
     job = " ".join(pipes.quote(_) for _ in job)
     submitjob(job, **submitjobkwargs)
 
 if __name__ == '__main__':
   cleanupscratchdir()
-  if args.submitjobs:
-    submitjobs(filter=args.filter, doxcheck=args.doxcheck)
+  if args.validatecolumnar:
+    from helperstuff.columnar import validatecolumnar
+    for sample in allsamples(doxcheck=args.doxcheck):
+      if args.filter and not args.filter.function(sample): continue
+      if sample.copyfromothersample or sample.production.LHE: continue
+      validatecolumnar(sample, nevents=args.validatecolumnar, chunksize=args.chunksize)
+  elif args.validatekernel:
+    from helperstuff.kernel import validatekernel
+    for sample in allsamples(doxcheck=args.doxcheck):
+      if args.filter and not args.filter.function(sample): continue
+      if sample.copyfromothersample or sample.production.LHE: continue
+      validatekernel(sample, nevents=args.validatekernel)
+  elif args.submitjobs:
+    submitjobs(filter=args.filter, doxcheck=args.doxcheck, engine=args.engine, chunksize=args.chunksize, nshards=args.nshards, friend=args.friend)
   else:
     try:
       for sample in allsamples(doxcheck=args.doxcheck):
         if sample.productionmode == "ggZZ" and sample.flavor == "4tau" and not sample.copyfromothersample:
-          adddiscriminants(sample)
+          adddiscriminants(sample, engine=args.engine, chunksize=args.chunksize, nshards=args.nshards, nprocesses=args.nprocesses, friend=args.friend, incremental=args.incremental, nsmearings=args.nsmearings, smearingseed=args.smearingseed)
       for sample in allsamples(doxcheck=args.doxcheck):
         if args.filter and not args.filter.function(sample): continue
         while sample.copyfromothersample:
           sample = sample.copyfromothersample
-        adddiscriminants(sample)
+        adddiscriminants(sample, engine=args.engine, chunksize=args.chunksize, nshards=args.nshards, nprocesses=args.nprocesses, friend=args.friend, incremental=args.incremental, nsmearings=args.nsmearings, smearingseed=args.smearingseed)
     finally:
       if not any(KeepWhileOpenFile(sample.withdiscriminantsfile()+".tmp").wouldbevalid for sample in allsamples(doxcheck=args.doxcheck)):
         deletemelastuff()
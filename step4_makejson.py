@@ -11,14 +11,18 @@ if __name__ == "__main__":
     p.add_argument("--overwrite", help="redo the json files that already exist", action="store_false", dest="keep")
     p.add_argument("--submitjobs", help="submit jobs", metavar="FILES_PER_JOB", type=int)
     p.add_argument("--filter", type=stringandlambda, default=None)
+    p.add_argument("--nprocesses", type=int, default=1, help="make the json files in this many local processes")
     args = p.parse_args()
 
 import datetime
-import json
+import multiprocessing
 import os
 import pipes
+import sys
+import traceback
 
 from helperstuff import config
+from helperstuff.dependencies import writejson
 from helperstuff.submitjob import submitjob
 from helperstuff.templates import TemplatesFile, templatesfiles
 from helperstuff.utilities import KeepWhileOpenFile, LSB_JOBID, mkdir_p
@@ -31,10 +35,52 @@ def makejson(*args):
     with KeepWhileOpenFile(filename+".tmp") as f:
         if not f: return
         print templatesfile, datetime.datetime.now()
+        writejson(templatesfile)
 
-        jsonstring = json.dumps(templatesfile.getjson(), sort_keys=True, indent=4, separators=(',', ': '))
-        with open(filename, "w") as f:
-            f.write(jsonstring)
+def warmcaches(templatesfile):
+    """
+    Calculates the things that getjson needs that are shared between templates files
+    (the inverted matrices, templatesandfactors, reweightfrom), so that they're cached
+    before the worker processes are forked instead of being recalculated in each one.
+    """
+    for template in templatesfile.templates():
+        template.reweightfrom()
+    for template in templatesfile.inttemplates():
+        template.templatesandfactors
+        template.reweightfrom()
+
+#set before the pool is made, so that the workers get it from the fork
+tomake = []
+
+def makejsonworker(i):
+    try:
+        makejson(tomake[i])
+    except:
+        raise Exception("".join(traceback.format_exception(*sys.exc_info())))
+
+def makejsons(nprocesses, filter=None, keep=True):
+    """
+    Makes the json files in a pool of nprocesses processes.  Files that are being made
+    by another job are skipped, same as in makejson.
+    """
+    for templatesfile in templatesfiles:
+        if filter and not filter.function(templatesfile): continue
+        if keep and os.path.exists(templatesfile.jsonfile()): continue
+        if templatesfile.copyfromothertemplatesfile is not None: continue
+        if not KeepWhileOpenFile(templatesfile.jsonfile()+".tmp").wouldbevalid: continue
+        tomake.append(templatesfile)
+    if not tomake: return
+
+    for templatesfile in tomake:
+        warmcaches(templatesfile)
+
+    pool = multiprocessing.Pool(processes=min(nprocesses, len(tomake)))
+    try:
+        for _ in pool.imap_unordered(makejsonworker, range(len(tomake))): pass
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 def submitjobs(filesperjob, filter=stringandlambda("lambda x: True")):
     i = 0
@@ -57,6 +103,8 @@ def submitjobs(filesperjob, filter=stringandlambda("lambda x: True")):
 if __name__ == "__main__":
     if args.submitjobs:
         list(submitjobs(args.submitjobs, args.filter))
+    elif args.nprocesses > 1:
+        makejsons(args.nprocesses, args.filter, args.keep)
     else:
         for templatesfile in templatesfiles:
             if args.filter and not args.filter.function(templatesfile): continue
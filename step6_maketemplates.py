@@ -13,12 +13,17 @@ if __name__ == "__main__":
   p.add_argument("--nthreads", type=int, default=8)
   p.add_argument("--on-queue", action="store_true", help=argparse.SUPPRESS)
   p.add_argument("--queue")
+  p.add_argument("--native", action="store_true", help="fill the templates in this process (helperstuff/templatefiller.py) instead of with buildTemplates.py, for the jsons that don't have constraints")
+  p.add_argument("--plan", action="store_true", help="print which json and templates files are missing or out of date, and do nothing else")
+  p.add_argument("--rebuild-stale", action="store_true", help="rewrite the json files and remove the templates files that are out of date before making the templates")
+  p.add_argument("--record-existing", action="store_true", help="record the inputs of existing templates files that don't have a record yet, as if they're up to date")
   args = p.parse_args()
   if args.on_queue:
     args.jsontoo = None
     args.removefiles = args.waitids = ()
     args.submitjobs = False
     args.extrajobs = 0
+    args.rebuild_stale = args.record_existing = False
   if args.jsontoo and not args.submitjobs:
     raise ValueError("--jsontoo doesn't make sense without --submitjobs")
   if args.removefiles and not args.submitjobs:
@@ -27,8 +32,11 @@ if __name__ == "__main__":
     raise ValueError("--waitids doesn't make sense without --submitjobs")
   if args.extrajobs and not args.submitjobs:
     raise ValueError("--extrajobs doesn't make sense without --submitjobs")
+  if args.native and args.start_with_bin:
+    raise ValueError("--start-with-bin only works with buildTemplates.py, not --native")
 
 from array import array
+import json
 import os
 import pipes
 import ROOT
@@ -37,6 +45,7 @@ import sys
 from time import sleep
 
 from helperstuff import config
+from helperstuff.dependencies import Dependencies, RebuildPlan
 from helperstuff.discriminants import discriminants
 from helperstuff.enums import Production, TemplateGroup
 from helperstuff.samples import Sample
@@ -44,14 +53,34 @@ from helperstuff.submitjob import submitjob
 from helperstuff.templates import DataTree, datatrees, TemplatesFile, templatesfiles
 from helperstuff.utilities import cd, KeepWhileOpenFile, KeepWhileOpenFiles, LSB_JOBID, mkdir_p, TFile
 
+def callbuildtemplates(jsonfiles, morebuildtemplatesargs, native=False, nthreads=8):
+  """
+  With native, the jsons that templatefiller can do are filled in this process,
+  and only the rest go to buildTemplates.py
+  """
+  if native:
+    from helperstuff.templatefiller import canfill, filltemplates
+    native, rest = [], []
+    for jsonfile in jsonfiles:
+      with open(jsonfile) as f:
+        (native if canfill(json.load(f)) else rest).append(jsonfile)
+    if native:
+      #all together, so that each input tree is only read once
+      filltemplates(native, nprocesses=nthreads)
+    jsonfiles = rest
+  if jsonfiles:
+    subprocess.check_call(["buildTemplates.py", "--use-existing-templates"] + jsonfiles + morebuildtemplatesargs)
+
 def buildtemplates(*args, **kwargs):
   morebuildtemplatesargs = kwargs.pop("morebuildtemplatesargs", [])
+  native = kwargs.pop("native", False)
+  nthreads = kwargs.pop("nthreads", 8)
   assert not kwargs, kwargs
 
   if len(args) == 2:
     tg = TemplateGroup(args[0])
     production = Production(args[1])
-    tfs = [tf for tf in templatesfiles if tf.templategroup == tg and tf.production == production and not (os.path.exists(tf.templatesfile()) and os.path.exists(tf.templatesfile().replace(".root", ".done")))]
+    tfs = [tf for tf in templatesfiles.select(templategroup=tg, production=production) if not (os.path.exists(tf.templatesfile()) and os.path.exists(tf.templatesfile().replace(".root", ".done")))]
     if tg in ("ggh", "vbf", "zh", "wh", "vh"):
       tfs = [tf for tf in tfs if tf.shapesystematic != ""]
     if not tfs: return
@@ -59,26 +88,29 @@ def buildtemplates(*args, **kwargs):
     sys.setrecursionlimit(max(sys.getrecursionlimit(), 5000))
     with KeepWhileOpenFiles(*(_.templatesfile()+".tmp" for _ in tfs)) as kwofs:
       if not all(kwofs): return
-      subprocess.check_call(["buildTemplates.py", "--use-existing-templates"] + [_.jsonfile() for _ in tfs] + morebuildtemplatesargs)
+      callbuildtemplates([_.jsonfile() for _ in tfs], morebuildtemplatesargs, native=native, nthreads=nthreads)
+      for tf in tfs:
+        Dependencies(tf).record()
       return
     return
 
   templatesfile = TemplatesFile(*args)
   if "Ulascan" in str(templatesfile.production): return
   if templatesfile.templategroup in ("background", "DATA", "tth", "bbh") or templatesfile.shapesystematic != "":
-    return buildtemplates(templatesfile.templategroup, templatesfile.production)
+    return buildtemplates(templatesfile.templategroup, templatesfile.production, morebuildtemplatesargs=morebuildtemplatesargs, native=native, nthreads=nthreads)
   print templatesfile
   if templatesfile.copyfromothertemplatesfile is not None: return
   with KeepWhileOpenFile(templatesfile.templatesfile() + ".tmp") as f:
-    scriptname = ["buildTemplates.py", "--use-existing-templates"] + morebuildtemplatesargs
     if f:
+      built = False
       if (
         not os.path.exists(templatesfile.templatesfile())
         or not os.path.exists(templatesfile.templatesfile().replace(".root", ".done"))
       ):
+        built = True
         if not os.path.exists(templatesfile.templatesfile(firststep=True)):
           mkdir_p(os.path.dirname(templatesfile.templatesfile(firststep=True)))
-          subprocess.check_call(scriptname + [templatesfile.jsonfile()])
+          callbuildtemplates([templatesfile.jsonfile()], morebuildtemplatesargs, native=native, nthreads=nthreads)
       if (
         os.path.exists(templatesfile.templatesfile(firststep=True))
         and not os.path.exists(templatesfile.templatesfile())
@@ -99,6 +131,8 @@ def buildtemplates(*args, **kwargs):
 
       if not os.path.exists(templatesfile.templatesfile()):
         raise RuntimeError("Something is wrong!  {} was not created.".format(templatesfile.templatesfile()))
+      if built:
+        Dependencies(templatesfile).record()
 
 def copydata(*args):
   if len(args) == 1 and isinstance(args[0], DataTree):
@@ -206,8 +240,21 @@ def submitjobs(args):
     for i in range(njobs):
       submitjob("unbuffer "+os.path.join(config.repositorydir, "step6_maketemplates.py")+" --on-queue " + " ".join(pipes.quote(_) for _ in sys.argv[1:]), jobname=str(i), jobtime="2-0:0:0", docd=True, waitids=waitids, memory="{}M".format(args.nthreads*6000), nthreads=args.nthreads, queue=args.queue)
 
+def planrebuild(args):
+  with cd(config.repositorydir):
+    plan = RebuildPlan(tf for tf in templatesfiles if args.filter(tf))
+    if args.record_existing and not args.plan:
+      plan.recorduntracked()
+    print plan
+    if args.rebuild_stale and not args.plan:
+      plan.execute()
+
 if __name__ == "__main__":
-  if args.submitjobs:
+  if args.plan or args.rebuild_stale or args.record_existing:
+    planrebuild(args)
+  if args.plan:
+    pass  #only print it
+  elif args.submitjobs:
     submitjobs(args)
   else:
     morebuildtemplatesargs = []
@@ -216,7 +263,7 @@ if __name__ == "__main__":
     for templatesfile in templatesfiles:
       if not args.filter(templatesfile): continue
       with cd(config.repositorydir):
-        buildtemplates(templatesfile, morebuildtemplatesargs=morebuildtemplatesargs)
+        buildtemplates(templatesfile, morebuildtemplatesargs=morebuildtemplatesargs, native=args.native, nthreads=args.nthreads)
       #and copy data
     #for datatree in datatrees:
     #  copydata(datatree)
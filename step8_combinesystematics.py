@@ -7,15 +7,17 @@ if __name__ == "__main__":
     return Analysis(*args, **kwargs)
   parser = argparse.ArgumentParser()
   parser.add_argument("analysis", type=__Analysis, nargs="?")
+  parser.add_argument("--nprocesses", type=int, default=1, help="do the combinations in this many local processes")
   args = parser.parse_args()
 
-import itertools, os
+import itertools, multiprocessing, os, sys, traceback
 
 import numpy as np
 
 from helperstuff import config
 
 from helperstuff.combinehelpers import getrate
+from helperstuff.customsmoothing.histogramarrays import contents, inrange
 from helperstuff.enums import analyses, categories, channels, ProductionMode, productions, ShapeSystematic
 from helperstuff.templates import IntTemplate, Template, TemplatesFile
 from helperstuff.utilities import KeepWhileOpenFile, TFile
@@ -23,6 +25,12 @@ from helperstuff.utilities import KeepWhileOpenFile, TFile
 STXSuncertainties = "Mu", "Res", "Mig01", "Mig12", "VBF2j", "VBF3j", "PT60", "PT120", "qmtop"
 
 def combinesystematics(channel, analysis, production, category, productionmode):
+  """
+  Returns a list of messages for the bins with huge or tiny ratios.
+  The systematics that have any aren't written.
+  """
+  problems = []
+  rate = None  #only looked up if it's needed
   templategroup = str(productionmode).lower()
   tfnominal = TemplatesFile(channel, analysis, production, category, templategroup)
 
@@ -52,16 +60,21 @@ def combinesystematics(channel, analysis, production, category, productionmode):
           ratio = numerator.Clone("ratio")
           ratio.Divide(denominator)
 
-          for x, y, z in itertools.product(xrange(1, ratio.GetNbinsX()+1), xrange(1, ratio.GetNbinsY()+1), xrange(1, ratio.GetNbinsZ()+1)):
-            if np.isclose(denominator.GetBinContent(x, y, z), 1e-10) or np.isclose(numerator.GetBinContent(x, y, z), 1e-10):
-              ratio.SetBinContent(x, y, z, 1)
-            if ratio.GetBinContent(x, y, z) > threshold or ratio.GetBinContent(x, y, z) < 1/threshold:
-              expectednevents = getrate(channel, analysis, production, category, productionmode, "fordata") * denominator.GetBinContent(x, y, z) / denominator.Integral()
-              if expectednevents < expectedeventsthreshold:
-                ratio.SetBinContent(x, y, z, 1)
-              else:
-                raise ValueError("Huge or tiny ratio for ({}) / ({}) bin {} {} {}:\n{} / {} = {}\nexpected yield: {}".format(Template(tfsyst, productionmode, hypothesis), Template(tfnominal, productionmode, hypothesis), x, y, z, numerator.GetBinContent(x, y, z), denominator.GetBinContent(x, y, z), ratio.GetBinContent(x, y, z), expectednevents))
-
+          numeratorcontent = inrange(contents(numerator))
+          denominatorcontent = inrange(contents(denominator))
+          ratiocontent = inrange(contents(ratio))
+
+          ratiocontent[np.isclose(denominatorcontent, 1e-10) | np.isclose(numeratorcontent, 1e-10)] = 1
+          outsidethreshold = (ratiocontent > threshold) | (ratiocontent < 1/threshold)
+          if np.any(outsidethreshold):
+            if rate is None: rate = getrate(channel, analysis, production, category, productionmode, "fordata")
+            expectednevents = rate * denominatorcontent / denominator.Integral()
+            ratiocontent[outsidethreshold & (expectednevents < expectedeventsthreshold)] = 1
+            bad = outsidethreshold & (expectednevents >= expectedeventsthreshold)
+            if np.any(bad):
+              for x, y, z in np.argwhere(bad) + 1:
+                problems.append("Huge or tiny ratio for ({}) / ({}) bin {} {} {}:\n{} / {} = {}\nexpected yield: {}".format(Template(tfsyst, productionmode, hypothesis), Template(tfnominal, productionmode, hypothesis), x, y, z, numerator.GetBinContent(x, y, z), denominator.GetBinContent(x, y, z), ratio.GetBinContent(x, y, z), expectednevents[x-1, y-1, z-1]))
+              continue
 
           newsyst = ShapeSystematic(str(syst).replace("Up", hypothesis.combinename+"Up").replace("Dn", hypothesis.combinename+"Dn").replace("Down", hypothesis.combinename+"Down"))
           assert newsyst != syst, (syst, newsyst)
@@ -84,10 +97,18 @@ def combinesystematics(channel, analysis, production, category, productionmode):
                 cache.append(newtemplate)
             del cache
 
-if __name__ == "__main__":
+  return problems
+
+def combinesystematicsworker(args):
+  try:
+    return combinesystematics(*args)
+  except:
+    raise Exception("".join(traceback.format_exception(*sys.exc_info())))
+
+def combinations(analysisfilter=None):
   for production in productions:
     for analysis in analyses:
-      if analysis != args.analysis is not None: continue
+      if analysis != analysisfilter is not None: continue
       for channel in channels:
         for category in categories:
           for productionmode in ("ggH", "VBF", "VH", "ttH", "bbH"):
@@ -96,4 +117,22 @@ if __name__ == "__main__":
             if category != "Untagged" and analysis.isdecayonly: continue
             if category == "Boosted" and not analysis.useboosted: continue
             if category in ("VBF1jtagged", "VHLepttagged") and not analysis.usemorecategories: continue
-            combinesystematics(channel, analysis, production, category, productionmode)
+            yield channel, analysis, production, category, productionmode
+
+if __name__ == "__main__":
+  tocombine = list(combinations(args.analysis))
+  problems = []
+  if args.nprocesses > 1:
+    pool = multiprocessing.Pool(processes=args.nprocesses)
+    try:
+      for _ in pool.imap_unordered(combinesystematicsworker, tocombine): problems += _
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+  else:
+    for _ in tocombine:
+      problems += combinesystematics(*_)
+
+  if problems:
+    raise ValueError("{} bins with huge or tiny ratios, those systematics were not written:\n\n".format(len(problems)) + "\n\n".join(problems))